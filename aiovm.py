@@ -0,0 +1,131 @@
+# 能暂停、能接着跑的ir_eval，给asyncio里同时跑很多个程序用
+# ir_eval的状态就是pc、操作数栈sp和ctx，Call的时候靠Python递归再开一层ir_eval，停不下来。
+# 这里把每一层的(buf, pc, sp, ctx)放进一个显式的帧栈，Call不递归，只是压一帧，跑完再弹出来，
+# 所以任何一条指令之后都能停，下次从帧栈顶上接着跑。
+# 分派表和处理函数都是ir_eval的，只换了Call。
+#
+# 每一片最多跑budget条指令，指令循环是 for _ in range(budget)，循环本身就是计数，不再每条指令判断预算。
+# 跑到buf末尾、Halt和Call都不在循环里判断：Halt返回的HALT_PC、跑过末尾的pc、Call返回的_SWITCH_PC
+# 都会让下一次buf[pc]抛IndexError，在循环外面接住再看是哪一种；处理函数自己抛的IndexError这时pc还在buf里面，原样抛出去。
+# run()每跑完一片就await asyncio.sleep(0)让别的协程跑，燃料(最多执行多少条指令)和墙钟截止时间也是每片查一次。
+import asyncio
+import time
+from operator import length_hint
+
+from demo2 import HALT_PC, IR_DISPATCH, EvalContext, Ir, IrOpCode
+
+# Call返回这个pc，表示要换到被调过程那一帧
+_SWITCH_PC = HALT_PC + 1
+
+class OutOfFuel(RuntimeError):
+    pass
+
+class DeadlineExceeded(RuntimeError):
+    pass
+
+class Frame:
+    buf  : list[Ir]
+    pc   : int
+    sp   : list
+    ctx  : EvalContext
+    # 被调过程的名字，主程序是None；弹出时按_ir_call的样子交给ctx.out
+    name : str | None
+
+    def __init__(self, buf: list[Ir], ctx: EvalContext, name: str | None = None):
+        self.buf = buf
+        self.pc = 0
+        self.sp = []
+        self.ctx = ctx
+        self.name = name
+
+class ResumableEval:
+    frames   : list[Frame]
+    ctx      : EvalContext
+    # 一共执行了多少条指令
+    steps    : int
+    dispatch : list
+    # Call处理函数留给循环外面的：(过程名, 过程体, 新帧的ctx, 返回地址)
+    pending  : tuple[str, list[Ir], EvalContext, int] | None
+
+    def __init__(self, buf: list[Ir], ctx: EvalContext):
+        self.frames = [Frame(buf, ctx)]
+        self.ctx = ctx
+        self.steps = 0
+        self.dispatch = IR_DISPATCH[:]
+        self.dispatch[IrOpCode.Call] = self._call
+        self.pending = None
+
+    @property
+    def done(self) -> bool:
+        return not self.frames
+
+    # 最多执行budget条指令，返回实际执行了几条；跑完了就少于budget
+    def step(self, budget: int) -> int:
+        left = budget
+        dispatch = self.dispatch
+        while left > 0 and self.frames:
+            f = self.frames[-1]
+            buf, sp, ctx, pc = f.buf, f.sp, f.ctx, f.pc
+            it = iter(range(left))
+            try:
+                for _ in it:
+                    ir = buf[pc]
+                    pc = dispatch[ir.op](ir, sp, ctx, pc + 1)
+            except IndexError:
+                if pc < len(buf):
+                    f.pc = pc
+                    raise
+                # 抛异常的那一圈从it里拿了一个数但没执行指令
+                left = length_hint(it) + 1
+            except BaseException:
+                f.pc = pc
+                raise
+            else:
+                left = 0
+                # 片正好用完在Call、Halt或者末尾上也在这里处理掉，片和片之间栈顶那一帧的pc一定在自己的buf里面；
+                # 下面的帧停在返回地址上，Call是最后一条的话就是len(buf)，接着跑的时候一回来就弹掉
+                if pc < len(buf):
+                    f.pc = pc
+                    continue
+
+            if pc == _SWITCH_PC:
+                name, body, callee, f.pc = self.pending
+                self.pending = None
+                self.frames.append(Frame(body, callee, name))
+            else:
+                self.frames.pop()
+                if f.name is not None:
+                    self.frames[-1].ctx.out.call(f.name, f.buf)
+        executed = budget - left
+        self.steps += executed
+        return executed
+
+    # 和_ir_call一样找过程、开新帧，只是不在这里跑
+    def _call(self, ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+        found = ctx.lookup_proc(ir.args)
+        if found is None:
+            raise RuntimeError('call procedure before definition')
+        body, owner = found
+        self.pending = (ir.args, body, EvalContext({}, {}, {}, owner, ctx.out), pc)
+        return _SWITCH_PC
+
+    # 一片一片地跑到结束，返回主程序的ctx
+    # fuel是最多执行多少条指令，deadline是time.monotonic()的截止时刻，超了分别抛OutOfFuel/DeadlineExceeded，
+    # 抛出来之后状态还在，放宽限制再run一次就能接着跑
+    async def run(self, fuel: int | None = None, deadline: float | None = None, slice: int = 1000) -> EvalContext:
+        while self.frames:
+            budget = slice
+            if fuel is not None:
+                budget = min(budget, fuel - self.steps)
+                if budget <= 0:
+                    raise OutOfFuel('out of fuel after %d instructions' % self.steps)
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeadlineExceeded('deadline exceeded after %d instructions' % self.steps)
+            self.step(budget)
+            await asyncio.sleep(0)
+        return self.ctx
+
+async def run_program(buf: list[Ir], ctx: EvalContext, fuel: int | None = None,
+                      timeout: float | None = None, slice: int = 1000) -> EvalContext:
+    deadline = None if timeout is None else time.monotonic() + timeout
+    return await ResumableEval(buf, ctx).run(fuel, deadline, slice)
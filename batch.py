@@ -0,0 +1,65 @@
+# 编译一次、跑很多遍：同一个程序配上成千上万组初始变量，分给进程池去跑
+# 源码只在主进程里编译一次，Image按cache的格式序列化成bytes，每个worker启动时收一次、解出来留在全局里，
+# 之后每个任务只传一组组初始值。任务按chunksize切块提交，哪块先跑完哪块先交回来，
+# 同时在跑的块不超过workers的两倍，初始值是个生成器也不会一下子全读进内存。
+# 每组初始值在worker里是一次vm.VM(image).run(init)，跑出错的那一组单独记下错误(异常类型和消息)，不影响别的。
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from typing import Iterable, Iterator, NamedTuple
+
+from cache import dump_image, load_image, source_hash
+from vm import VM, Image, compile_program, frame_vars
+
+class JobResult(NamedTuple):
+    # 这组初始值在输入里的下标
+    index : int
+    vars  : dict[str, int | None] | None
+    error : str | None
+
+# worker进程里的Image，_init_worker填上
+_image: Image | None = None
+
+def _init_worker(data: bytes, digest: bytes):
+    global _image
+    _image = load_image(data, digest)
+
+def _run_one(image: Image, index: int, init: dict[str, int]) -> JobResult:
+    try:
+        return JobResult(index, frame_vars(VM(image).run(init)), None)
+    except Exception as e:
+        # 除了VM的RuntimeError，合法的程序也会跑出别的错，比如'/'得到小数之后再odd就是TypeError
+        return JobResult(index, None, '%s: %s' % (type(e).__name__, e))
+
+def _run_chunk(start: int, inits: list[dict[str, int]]) -> list[JobResult]:
+    return [_run_one(_image, start + i, init) for i, init in enumerate(inits)]
+
+# 按块产出结果，块内按下标排好，块和块之间按完成的先后；workers是None就用全部CPU
+def run_batch(src: str, inits: Iterable[dict[str, int]], workers: int | None = None,
+              chunksize: int = 256, optimize: bool = True) -> Iterator[list[JobResult]]:
+    digest = source_hash(src)
+    data = dump_image(compile_program(src, optimize), digest)
+    workers = workers or os.cpu_count() or 1
+    it = iter(inits)
+    start = 0
+
+    with ProcessPoolExecutor(workers, initializer = _init_worker, initargs = (data, digest)) as pool:
+        window = 2 * workers
+        pending = set()
+        while True:
+            while len(pending) < window:
+                chunk = list(islice(it, chunksize))
+                if not chunk:
+                    break
+                pending.add(pool.submit(_run_chunk, start, chunk))
+                start += len(chunk)
+            if not pending:
+                return
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+# 同样的事在当前进程里一组一组地跑，给run_batch当对照
+def run_serial(src: str, inits: Iterable[dict[str, int]], optimize: bool = True) -> list[JobResult]:
+    image = compile_program(src, optimize)
+    return [_run_one(image, i, init) for i, init in enumerate(inits)]
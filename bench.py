@@ -0,0 +1,902 @@
+# PL/0 编译器各个阶段的基准测试
+# 用法: python bench.py lex [-n 2000]
+#       python bench.py vm [-n 100000]
+#       python bench.py mem [-n 2000]
+#       python bench.py cache [-n 20000]
+#       python bench.py peephole
+#       python bench.py fuse [-n 100000]
+#       python bench.py closure [-n 20000]
+#       python bench.py transpile [-n 100000]
+#       python bench.py jit [-n 100000] [--threshold 50]
+#       python bench.py regvm [-n 100000]
+#       python bench.py profile [-n 20000] [--limit 20] [--json out.json]
+#       python bench.py sample [-n 200000] [--interval 0.001] [--limit 10]
+#       python bench.py sink [-n 20000]
+#       python bench.py batch [--jobs 20000] [--workers 1,2,4,8] [--chunksize 256]
+#       python bench.py lanes [--lanes 100,1000,10000]
+#       python bench.py async [-n 100000] [--slices 100,1000,10000] [--jobs 8]
+#       python bench.py snapshot [-n 100000] [--every 1000,10000,100000]
+#       python bench.py incr [--size 10000] [--procs 300] [--seed 0] [--text 1234567890]
+#       python bench.py sweep [--knob size] [--values 100,200,400,800] [--seed 0] [--plot out.png]
+#       python bench.py suite [--json out.json] [--baseline base.json] [--tolerance 0.10] [--min-time 0.002] [--scale 1.0]
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import aiovm
+import batch
+import cache
+import closure
+import demo2
+import incr
+import irprof
+import jit
+import opt
+import regvm
+import sampler
+import snapshot
+import synth
+import transpile
+import vm
+
+from demo2 import (TEST_PROGRAM, BufferedSink, EvalContext, Expression, Factor, Ir, Lexer, NullSink, Parser,
+                   PrintSink, Term, Token, TokenKind, TokenStream, ir_eval, tokenize)
+
+
+# 常量和恒等式比较多的程序，给优化遍用
+FOLD_PROGRAM = """
+const n = 10, step = 1;
+var i, s, t;
+begin
+    i := 0; s := 0;
+    while i < n * 2 - 10 do
+    begin
+        i := i + step * 1;
+        t := (2 + 3) * i + 0;
+        if 1 = 1 then s := s + t - 0;
+        if odd 4 then s := 0
+    end
+end.
+"""
+
+
+# 造一个足够大的合法程序：把TEST_PROGRAM主体里的语句重复n遍
+def make_source(n: int) -> str:
+    stmt = '''
+    i := 0;
+    while i < 5 do
+    begin
+        i := i + 1;
+        s := s + i * i
+    end;
+    if odd s then s := s - 1'''
+    return 'var i, s;\nbegin\n    s := 0;' + ';'.join([stmt] * n) + '\nend.\n'
+
+
+class CountingLexer(Lexer):
+    lexed: int
+    # LegacyParser把它当TokenStream用，Parser.statement要记位置，这里不记，span总是None
+    pos = 0
+
+    def __init__(self, src: str):
+        super().__init__(src)
+        self.lexed = 0
+
+    def next(self) -> Token:
+        self.lexed += 1
+        return super().next()
+
+    def span(self, mark: int) -> tuple[int, int] | None:
+        return None
+
+
+# 改之前Parser的写法：check/term/expression先lex一个token，不匹配再把lx.i拨回去，
+# 留在这里只是为了数出旧写法一共lex了多少次
+class LegacyParser(Parser):
+    lx : CountingLexer
+
+    def __init__(self, lx: CountingLexer):
+        # 其它方法只会调ts.next()，直接交给Lexer
+        self.lx = lx
+        self.ts = lx
+
+    def check(self, ty, val) -> bool:
+        p = self.lx.i
+        tk = self.lx.next()
+        if tk.ty == ty and tk.val == val:
+            return True
+        self.lx.i = p
+        return False
+
+    def term(self):
+        fac1 = self.factor()
+        if self.check(TokenKind.Op, '.'):
+            return Factor(fac1)
+        fac_list = []
+        p = self.lx.i
+        token = self.lx.next()
+        while token.val == '*' or token.val == '/':
+            fac_list.append((token.val, self.factor()))
+            p = self.lx.i
+            token = self.lx.next()
+        self.lx.i = p
+        return Term(fac1, fac_list)
+
+    def expression(self):
+        p = self.lx.i
+        token = self.lx.next()
+        if token.val == '+' or token.val == '-':
+            te = self.term()
+            mod = token.val
+        else:
+            self.lx.i = p
+            mod = ''
+            te = self.term()
+        term_list = []
+        p = self.lx.i
+        ttoken = self.lx.next()
+        while ttoken.val == '+' or ttoken.val == '-':
+            term_list.append((ttoken.val, self.term()))
+            p = self.lx.i
+            ttoken = self.lx.next()
+        self.lx.i = p
+        return Expression(mod, te, term_list)
+
+
+def timeit(fn, repeat: int = 3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def bench_lex(args):
+    for name, src in [('TEST_PROGRAM', TEST_PROGRAM), ('make_source(%d)' % args.n, make_source(args.n))]:
+        toks = tokenize(src)
+        ntok = len(toks) - 1
+
+        legacy = CountingLexer(src)
+        LegacyParser(legacy).program()
+
+        lx = CountingLexer(src)
+        Parser(lx).program()
+
+        t_lexer = timeit(lambda: Parser(Lexer(src)).program())
+        t_tokens = timeit(lambda: Parser(TokenStream(buf = tokenize(src))).program())
+
+        print('%s: %d source tokens' % (name, ntok))
+        print('  lexed per token   before %.2f   after %.2f' % (legacy.lexed / ntok, lx.lexed / ntok))
+        print('  parse time        Lexer %.4fs   tokenize %.4fs' % (t_lexer, t_tokens))
+
+
+# TEST_PROGRAM里的循环只跑5圈，把上界换成n让它变成真正的热循环
+def loop_program(n: int) -> str:
+    return TEST_PROGRAM.replace('i < 5', 'i < %d' % n)
+
+
+def compile_source(src: str) -> list[Ir]:
+    buf = []
+    Parser(TokenStream(buf = tokenize(src))).program().gen(buf)
+    return buf
+
+
+# 临时把分派表里的每个处理函数包一层计数，数出一次运行一共执行了多少条指令
+def count_steps(table: list, run) -> int:
+    saved = table[:]
+    steps = 0
+
+    def counted(fn):
+        def wrapper(*args):
+            nonlocal steps
+            steps += 1
+            return fn(*args)
+        return wrapper
+
+    table[:] = [counted(fn) for fn in saved]
+    try:
+        quiet(run)
+    finally:
+        table[:] = saved
+    return steps
+
+
+# Call会把被调过程的指令打出来，计时的时候丢掉
+def quiet(fn):
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        return fn()
+
+
+def bench_vm(args):
+    buf = compile_source(loop_program(args.n))
+    image = vm.compile_ir(buf)
+    engines = [
+        ('ir_eval', demo2.IR_DISPATCH, lambda: ir_eval(buf, EvalContext({}, {}, {}))),
+        ('vm.VM',   vm.VM_DISPATCH,    lambda: vm.VM(image).run()),
+    ]
+    print('TEST_PROGRAM, i < %d' % args.n)
+    for name, table, run in engines:
+        steps = count_steps(table, run)
+        t = timeit(lambda: quiet(run))
+        print('  %-8s %9d instructions  %.4fs  %.0f instructions/s' % (name, steps, t, steps / t))
+
+
+# 在tracemalloc底下造一遍，看新分配了多少字节还留着
+def allocated(build) -> tuple[object, int]:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return obj, size
+
+
+def bench_mem(args):
+    image = vm.compile_ir(compile_source(make_source(args.n)))
+    irs, ir_bytes = allocated(lambda: list(image.code))
+    code, code_bytes = allocated(lambda: vm.CodeObject.of(irs))
+    n = len(irs)
+    print('make_source(%d): %d linked instructions' % (args.n, n))
+    print('  list[Ir]    %9d bytes  %6.1f bytes/instruction' % (ir_bytes, ir_bytes / n))
+    print('  CodeObject  %9d bytes  %6.1f bytes/instruction' % (code_bytes, code_bytes / n))
+
+
+def bench_cache(args):
+    src = make_source(args.n)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'big.pl0')
+        with open(path, 'w') as f:
+            f.write(src)
+        cpath = cache.cache_path(path)
+
+        def cold():
+            if os.path.exists(cpath):
+                os.remove(cpath)
+            return cache.load_source(path)
+
+        t_cold = timeit(cold)
+        cache.load_source(path)
+        t_warm = timeit(lambda: cache.load_source(path))
+        size = os.path.getsize(cpath)
+
+    print('make_source(%d): %d bytes of source, %d bytes cached' % (args.n, len(src), size))
+    print('  cold compile  %.4fs' % t_cold)
+    print('  warm load     %.4fs  (%.1fx)' % (t_warm, t_cold / t_warm))
+
+
+def bench_peephole(args):
+    print('%-16s %8s %8s %10s %10s' % ('program', 'static', 'after', 'executed', 'after'))
+    for name, src in [('TEST_PROGRAM', TEST_PROGRAM), ('FOLD_PROGRAM', FOLD_PROGRAM), ('make_source(50)', make_source(50))]:
+        buf = compile_source(src)
+        obuf = opt.peephole(buf)
+        steps = count_steps(demo2.IR_DISPATCH, lambda: ir_eval(buf, EvalContext({}, {}, {})))
+        osteps = count_steps(demo2.IR_DISPATCH, lambda: ir_eval(obuf, EvalContext({}, {}, {})))
+        print('%-16s %8d %8d %10d %10d' % (name, len(buf), len(obuf), steps, osteps))
+
+
+def bench_fuse(args):
+    print('%-16s %8s %8s %10s %10s %9s %9s' % ('program', 'static', 'fused', 'dispatch', 'fused', 'time', 'fused'))
+    for name, src in [('TEST_PROGRAM', loop_program(args.n)), ('FOLD_PROGRAM', FOLD_PROGRAM), ('make_source(50)', make_source(50))]:
+        procs = vm.resolve(opt.peephole(compile_source(src)))
+        before = vm.link(procs)
+        after = vm.link([p._replace(code = opt.fuse(p.code)) for p in procs])
+        steps = count_steps(vm.VM_DISPATCH, lambda: vm.VM(before).run())
+        fsteps = count_steps(vm.VM_DISPATCH, lambda: vm.VM(after).run())
+        t = timeit(lambda: vm.VM(before).run())
+        ft = timeit(lambda: vm.VM(after).run())
+        print('%-16s %8d %8d %10d %10d %8.4fs %8.4fs' % (name, len(before.code), len(after.code), steps, fsteps, t, ft))
+
+
+def bench_closure(args):
+    prog = Parser(TokenStream(buf = tokenize(loop_program(args.n)))).program()
+    run = closure.compile_program(prog)
+    t_eval = timeit(lambda: quiet(lambda: prog.eval(EvalContext({}, {}, {}))))
+    t_compile = timeit(lambda: closure.compile_program(prog))
+    t_run = timeit(lambda: quiet(lambda: run(EvalContext({}, {}, {}))))
+    print('TEST_PROGRAM, i < %d' % args.n)
+    print('  Program.eval       %.4fs' % t_eval)
+    print('  closure compile    %.4fs' % t_compile)
+    print('  closure run        %.4fs  (%.1fx)' % (t_run, t_eval / t_run))
+
+
+def bench_transpile(args):
+    src = loop_program(args.n)
+    image = vm.compile_program(src, optimize = True)
+    main = transpile.compile_program(Parser(TokenStream(buf = tokenize(src))).program())
+    t_vm = timeit(lambda: vm.VM(image).run())
+    t_py = timeit(main)
+    print('TEST_PROGRAM, i < %d' % args.n)
+    print('  vm.VM (optimized)  %.4fs' % t_vm)
+    print('  transpiled Python  %.4fs  (%.1fx)' % (t_py, t_vm / t_py))
+
+
+def bench_jit(args):
+    buf = compile_source(loop_program(args.n))
+    t_interp = timeit(lambda: quiet(lambda: ir_eval(buf, EvalContext({}, {}, {}))))
+    t_jit = timeit(lambda: quiet(lambda: jit.jit_eval(buf, EvalContext({}, {}, {}), args.threshold)))
+    stats = quiet(lambda: jit.jit_eval(buf, EvalContext({}, {}, {}), args.threshold))
+    print('TEST_PROGRAM, i < %d, threshold %d' % (args.n, args.threshold))
+    print('  ir_eval    %.4fs' % t_interp)
+    print('  jit_eval   %.4fs  (%.1fx)' % (t_jit, t_interp / t_jit))
+    for line in stats.report().splitlines():
+        print('  ' + line)
+
+
+def bench_regvm(args):
+    print('%-16s %-8s %10s %10s' % ('program', 'engine', 'executed', 'time'))
+    for name, src in [('TEST_PROGRAM', loop_program(args.n)), ('FOLD_PROGRAM', FOLD_PROGRAM), ('make_source(200)', make_source(200))]:
+        buf = compile_source(src)
+        image = vm.compile_ir(buf)
+        rimage = regvm.compile_program(src)
+        engines = [
+            ('ir_eval', demo2.IR_DISPATCH,   lambda: ir_eval(buf, EvalContext({}, {}, {}))),
+            ('vm.VM',   vm.VM_DISPATCH,      lambda: vm.VM(image).run()),
+            ('RegVM',   regvm.REG_DISPATCH,  lambda: regvm.RegVM(rimage).run()),
+        ]
+        for ename, table, run in engines:
+            steps = count_steps(table, run)
+            t = timeit(lambda: quiet(run))
+            print('%-16s %-8s %10d %9.4fs' % (name, ename, steps, t))
+
+
+# 剖析TEST_PROGRAM的循环，顺便看剖析本身拖慢多少；ir_eval自己不受影响
+def bench_profile(args):
+    buf = compile_source(loop_program(args.n))
+    t_plain = timeit(lambda: quiet(lambda: ir_eval(buf, EvalContext({}, {}, {}))))
+    t_prof = timeit(lambda: quiet(lambda: irprof.profile_eval(buf, EvalContext({}, {}, {}))))
+    prof = quiet(lambda: irprof.profile_eval(buf, EvalContext({}, {}, {})))
+    print('TEST_PROGRAM, i < %d' % args.n)
+    print('  ir_eval        %.4fs' % t_plain)
+    print('  Profiler.eval  %.4fs  (%.1fx slower)' % (t_prof, t_prof / t_plain))
+    print()
+    print(prof.table(args.limit))
+    if args.json:
+        prof.dump_json(args.json)
+        print('\nwrote %s' % args.json)
+
+
+# 采样剖析TEST_PROGRAM的循环：热的行，以及开着采样比不开慢多少
+def bench_sample(args):
+    src = loop_program(args.n)
+    buf, spans, lines = sampler.compile_source(src)
+    t_plain = timeit(lambda: quiet(lambda: ir_eval(buf, EvalContext({}, {}, {}))))
+
+    def sampled():
+        with sampler.Sampler(spans, lines, args.interval):
+            ir_eval(buf, EvalContext({}, {}, {}))
+    t_sampled = timeit(lambda: quiet(sampled))
+    s = quiet(lambda: sampler.sample_eval(src, args.interval))
+    print('TEST_PROGRAM, i < %d, interval %gs' % (args.n, args.interval))
+    print('  ir_eval           %.4fs' % t_plain)
+    print('  ir_eval, sampled  %.4fs  (%+.1f%%)' % (t_sampled, 100 * (t_sampled / t_plain - 1)))
+    print('  %d samples' % s.samples)
+    print()
+    print(s.report(src, args.limit))
+
+
+# 同一个程序换不同的ctx.out：Program.eval每次赋值都输出，ir_eval每次Call都输出指令清单
+def bench_sink(args):
+    src = loop_program(args.n)
+    prog = Parser(TokenStream(buf = tokenize(src))).program()
+    calls = compile_source(nested_procs_program(6, args.n // 20))
+    sinks = [
+        ('PrintSink',          PrintSink),
+        ('BufferedSink',       BufferedSink),
+        ('BufferedSink calls', lambda: BufferedSink(calls = True)),
+        ('NullSink',           NullSink),
+    ]
+    print('%-20s %14s %14s' % ('sink', 'Program.eval', 'ir_eval calls'))
+    for name, make in sinks:
+        def run(fn):
+            out = make()
+            fn(EvalContext({}, {}, {}, None, out))
+            out.flush()
+        t_eval = timeit(lambda: quiet(lambda: run(prog.eval)))
+        t_ir = timeit(lambda: quiet(lambda: run(lambda ctx: ir_eval(calls, ctx))))
+        print('%-20s %13.4fs %13.4fs' % (name, t_eval, t_ir))
+
+
+# 读初始值n的程序，给batch用
+BATCH_PROGRAM = """
+var n, s, i;
+begin
+    s := 0; i := 0;
+    while i < n do
+    begin
+        i := i + 1;
+        s := s + i * i
+    end
+end.
+"""
+
+
+# 同一个程序配很多组初始值：每组重新编译一遍串行跑、编译一次串行跑、进程池里不同的worker数
+def bench_batch(args):
+    inits = [{'n': k % 100} for k in range(args.jobs)]
+
+    def recompile():
+        for init in inits[:args.jobs // 10]:
+            vm.VM(vm.compile_program(BATCH_PROGRAM)).run(init)
+
+    def pool(workers: int):
+        for _ in batch.run_batch(BATCH_PROGRAM, inits, workers, args.chunksize):
+            pass
+
+    print('%d jobs, %d CPUs' % (args.jobs, os.cpu_count() or 1))
+    print('%-20s %10s %12s' % ('', 'time', 'jobs/s'))
+    t = timeit(recompile, 1) * 10
+    print('%-20s %9.4fs %12.0f  (extrapolated from %d jobs)' % ('compile per job', t, args.jobs / t, args.jobs // 10))
+    t = timeit(lambda: batch.run_serial(BATCH_PROGRAM, inits), 1)
+    print('%-20s %9.4fs %12.0f' % ('compile once', t, args.jobs / t))
+    for workers in [int(w) for w in args.workers.split(',')]:
+        t = timeit(lambda: pool(workers), 1)
+        print('%-20s %9.4fs %12.0f' % ('%d workers' % workers, t, args.jobs / t))
+
+
+# BATCH_PROGRAM跑很多个n：ir_eval和vm.VM一个一个跑，lanes.LaneVM一次全跑完
+def bench_lanes(args):
+    try:
+        import lanes
+    except ImportError:
+        print('numpy is not installed, skipping')
+        return
+
+    buf = compile_source(BATCH_PROGRAM)
+    image = vm.compile_program(BATCH_PROGRAM, True)
+    print('%-8s %12s %12s %12s' % ('lanes', 'ir_eval', 'vm.VM', 'LaneVM'))
+    for n in [int(x) for x in args.lanes.split(',')]:
+        ns = [k % 100 for k in range(n)]
+        # ir_eval没法传初始值，每个n编一份在开头赋值的程序，编译不算时间
+        bufs = [compile_source(BATCH_PROGRAM.replace('s := 0;', 'n := %d; s := 0;' % k)) for k in ns]
+
+        def serial_ir():
+            for b in bufs:
+                ir_eval(b, EvalContext({}, {}, {}))
+
+        def serial_vm():
+            for k in ns:
+                vm.VM(image).run({'n': k})
+
+        t_ir = timeit(serial_ir, 1)
+        t_vm = timeit(serial_vm, 1)
+        t_lanes = timeit(lambda: lanes.run_lanes(buf, n, {'n': ns}), 1)
+        print('%-8d %11.4fs %11.4fs %11.4fs  (%.1fx over ir_eval)' % (n, t_ir, t_vm, t_lanes, t_ir / t_lanes))
+
+
+# 分片跑比ir_eval一口气跑完慢多少；再在一个事件循环里同时跑jobs个程序，外加一个死循环靠燃料停下
+def bench_async(args):
+    buf = compile_source(loop_program(args.n))
+    t_plain = timeit(lambda: quiet(lambda: ir_eval(buf, EvalContext({}, {}, {}))))
+    print('TEST_PROGRAM, i < %d' % args.n)
+    print('  %-22s %.4fs' % ('ir_eval', t_plain))
+    slices = [int(x) for x in args.slices.split(',')]
+    for size in slices:
+        t = timeit(lambda: quiet(lambda: asyncio.run(aiovm.run_program(buf, EvalContext({}, {}, {}), slice = size))))
+        print('  %-22s %.4fs  (%+.1f%%)' % ('slice %d' % size, t, 100 * (t / t_plain - 1)))
+
+    runaway = compile_source('var i; begin i := 0; while 1 = 1 do i := i + 1 end.')
+    fuel = args.n * 10
+
+    async def together():
+        jobs = [aiovm.run_program(buf, EvalContext({}, {}, {}), slice = slices[0]) for _ in range(args.jobs)]
+        jobs.append(aiovm.run_program(runaway, EvalContext({}, {}, {}), fuel = fuel, slice = slices[0]))
+        return await asyncio.gather(*jobs, return_exceptions = True)
+
+    start = time.perf_counter()
+    results = quiet(lambda: asyncio.run(together()))
+    elapsed = time.perf_counter() - start
+    print()
+    print('%d programs plus one runaway loop (fuel %d), slice %d: %.4fs' % (args.jobs, fuel, slices[0], elapsed))
+    print('  finished %d, runaway: %r' % (sum(isinstance(r, EvalContext) for r in results), results[-1]))
+
+
+def bench_snapshot(args):
+    # 快照的大小和时间只看活着的状态：程序长短差很多、递归深度差很多的几个程序，都停在同一步上存一次
+    print('%-28s %8s %8s %10s %10s' % ('program', 'ir', 'frames', 'bytes', 'dump+load'))
+    for name, src, depth in (('loop, i < %d' % args.n, loop_program(args.n), 0),
+                             ('make_source(50)', make_source(50), 0),
+                             ('make_source(1000)', make_source(1000), 0),
+                             ('deep_recursion(50)', deep_recursion_program(50, 1), 50),
+                             ('deep_recursion(500)', deep_recursion_program(500, 1), 500)):
+        buf = compile_source(src)
+        table = snapshot.CodeTable(buf)
+        r = aiovm.ResumableEval(buf, EvalContext({}, {}, {}, None, NullSink()))
+        # 循环的程序停在第1000条，递归的停在最深的地方
+        if not depth:
+            r.step(1000)
+        while len(r.frames) <= depth:
+            r.step(1)
+        data = snapshot.dump_snapshot(r, table)
+        t = timeit(lambda: snapshot.load_snapshot(snapshot.dump_snapshot(r, table), table, NullSink()), repeat = 20)
+        print('%-28s %8d %8d %10d %8.1fus' % (name, sum(len(c) for c in table.codes), len(r.frames), len(data), t * 1e6))
+
+    buf = compile_source(loop_program(args.n))
+    table = snapshot.CodeTable(buf)
+    t_plain = timeit(lambda: ir_eval(buf, EvalContext({}, {}, {}, None, NullSink())))
+    print()
+    print('TEST_PROGRAM, i < %d' % args.n)
+    print('  %-22s %.4fs' % ('ir_eval', t_plain))
+    for every in [int(x) for x in args.every.split(',')]:
+        saved = []
+        t = timeit(lambda: snapshot.run_checkpointed(aiovm.ResumableEval(buf, EvalContext({}, {}, {}, None, NullSink())),
+                                                     table, every, saved.append))
+        print('  %-22s %.4fs  (%+.1f%%)  %d snapshots per run' % ('every %d' % every, t, 100 * (t / t_plain - 1), len(saved) // 3))
+
+
+# 整条流水线的基准套件：每个程序分别计lex、parse、gen、eval、ir_eval的时间，
+# 结果写成JSON，也可以和存下来的基线比，慢了超过tolerance的算回退，退出码是1
+def deep_recursion_program(depth: int, rounds: int) -> str:
+    return """
+var d, k;
+procedure down;
+begin
+    if d > 0 then
+    begin
+        d := d - 1;
+        call down;
+        d := d + 1
+    end
+end;
+begin
+    k := 0;
+    while k < %d do
+    begin
+        d := %d;
+        call down;
+        k := k + 1
+    end
+end.
+""" % (rounds, depth)
+
+
+# 一层套一层的过程，每层有自己的变量，最里层去改最外层的x
+def nested_procs_program(depth: int, rounds: int) -> str:
+    head = []
+    tail = []
+    for lvl in range(1, depth + 1):
+        head.append('procedure p%d;\nvar v%d;\n' % (lvl, lvl))
+        if lvl == depth:
+            body = 'begin v%d := x; x := v%d + 1 end' % (lvl, lvl)
+        else:
+            body = 'begin v%d := x; call p%d; x := x + v%d - v%d end' % (lvl, lvl + 1, lvl, lvl)
+        tail.append(body + ';\n')
+    procs = ''.join(head) + ''.join(reversed(tail))
+    return 'var x, k;\n%sbegin\n    x := 0; k := 0;\n    while k < %d do begin call p1; k := k + 1 end\nend.\n' % (procs, rounds)
+
+
+# 一个循环里算一条很长的表达式
+def wide_expr_program(width: int, rounds: int) -> str:
+    terms = []
+    for j in range(width):
+        terms.append('%s i * %d' % ('+' if j % 2 == 0 else '-', j % 7 + 1))
+    expr = 'i ' + ' '.join(terms)
+    return 'var i, s;\nbegin\n    i := 0;\n    while i < %d do\n    begin\n        s := %s;\n        i := i + 1\n    end\nend.\n' % (rounds, expr)
+
+
+def suite_corpus(scale: float) -> dict[str, str]:
+    def n(x: int) -> int:
+        return max(1, int(x * scale))
+    return {
+        'tight_loop'     : loop_program(n(20000)),
+        'deep_recursion' : deep_recursion_program(100, n(100)),
+        'nested_procs'   : nested_procs_program(20, n(200)),
+        'wide_expr'      : wide_expr_program(200, n(200)),
+        'large_source'   : make_source(n(2000)),
+    }
+
+
+def lex_all(src: str) -> list[Token]:
+    lx = Lexer(src)
+    toks = []
+    tk = lx.next()
+    while tk.ty != TokenKind.Eof:
+        toks.append(tk)
+        tk = lx.next()
+    toks.append(tk)
+    return toks
+
+
+# 每一段都单独计时，后一段用前一段的结果，不把前面的时间算进来
+def time_stages(src: str, repeat: int) -> dict[str, float]:
+    toks = lex_all(src)
+    prog = Parser(TokenStream(buf = toks)).program()
+    buf = []
+    prog.gen(buf)
+
+    def gen():
+        prog.gen([])
+
+    return {
+        'lex'     : timeit(lambda: lex_all(src), repeat),
+        'parse'   : timeit(lambda: Parser(TokenStream(buf = toks)).program(), repeat),
+        'gen'     : timeit(gen, repeat),
+        'eval'    : timeit(lambda: quiet(lambda: prog.eval(EvalContext({}, {}, {}))), repeat),
+        'ir_eval' : timeit(lambda: quiet(lambda: ir_eval(buf, EvalContext({}, {}, {}))), repeat),
+    }
+
+
+# 比基线慢了超过tolerance、而且绝对值多出来min_time以上才算回退，太短的阶段全是噪声
+def compare(results: dict, baseline: dict, tolerance: float, min_time: float) -> list[str]:
+    regressions = []
+    print('%-16s %-8s %10s %10s %8s' % ('program', 'stage', 'baseline', 'now', 'ratio'))
+    for name, stages in results.items():
+        for stage, t in stages.items():
+            old = baseline.get(name, {}).get(stage)
+            if old is None:
+                print('%-16s %-8s %10s %9.4fs %8s' % (name, stage, '-', t, 'new'))
+                continue
+            ratio = t / old if old > 0 else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance and t - old > min_time:
+                flag = '  REGRESSION'
+                regressions.append('%s/%s' % (name, stage))
+            print('%-16s %-8s %9.4fs %9.4fs %7.2fx%s' % (name, stage, old, t, ratio, flag))
+    return regressions
+
+
+def bench_suite(args):
+    results = {}
+    sizes = {}
+    for name, src in suite_corpus(args.scale).items():
+        sizes[name] = len(src)
+        results[name] = time_stages(src, args.repeat)
+
+    if args.baseline is None:
+        print('%-16s %8s %8s %8s %8s %8s %8s' % ('program', 'bytes', 'lex', 'parse', 'gen', 'eval', 'ir_eval'))
+        for name, stages in results.items():
+            print('%-16s %8d %s' % (name, sizes[name], ' '.join('%8.4f' % stages[s] for s in stages)))
+
+    if args.json is not None:
+        report = {
+            'python'  : platform.python_version(),
+            'scale'   : args.scale,
+            'repeat'  : args.repeat,
+            'sizes'   : sizes,
+            'results' : results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != args.scale:
+            print('warning: baseline was recorded with --scale %s' % baseline.get('scale'))
+        regressions = compare(results, baseline['results'], args.tolerance, args.min_time)
+        if regressions:
+            print('%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+# 用synth生成的程序扫一个旋钮，看Lexer、Parser、ir_eval的吞吐量随规模怎么变
+def sweep_row(src: str, repeat: int) -> dict[str, float]:
+    toks = lex_all(src)
+    buf = []
+    Parser(TokenStream(buf = toks)).program().gen(buf)
+    steps = count_steps(demo2.IR_DISPATCH, lambda: ir_eval(buf, EvalContext({}, {}, {})))
+    t_lex = timeit(lambda: lex_all(src), repeat)
+    t_parse = timeit(lambda: Parser(TokenStream(buf = toks)).program(), repeat)
+    t_run = timeit(lambda: quiet(lambda: ir_eval(buf, EvalContext({}, {}, {}))), repeat)
+    return {
+        'bytes'        : len(src),
+        'tokens'       : len(toks),
+        'instructions' : steps,
+        'lex'          : len(toks) / t_lex,
+        'parse'        : len(toks) / t_parse,
+        'ir_eval'      : steps / t_run,
+    }
+
+
+def plot_sweep(knob: str, rows: list[tuple[int, dict]], path: str):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is not installed, skipping --plot')
+        return
+
+    fig, axes = plt.subplots(1, 3, figsize = (15, 4))
+    for ax, stage, unit in zip(axes, ('lex', 'parse', 'ir_eval'), ('tokens/s', 'tokens/s', 'instructions/s')):
+        ax.plot([r['bytes'] for _, r in rows], [r[stage] for _, r in rows], marker = 'o')
+        ax.set_xscale('log')
+        ax.set_xlabel('source bytes (%s swept)' % knob)
+        ax.set_ylabel(unit)
+        ax.set_title(stage)
+    fig.tight_layout()
+    fig.savefig(path)
+    print('wrote %s' % path)
+
+
+def bench_sweep(args):
+    rows = []
+    for v in [int(x) for x in args.values.split(',')]:
+        knobs = synth.Knobs()._replace(**{args.knob: v})
+        rows.append((v, sweep_row(synth.generate(args.seed, knobs), args.repeat)))
+
+    print('%-8s %9s %8s %12s %12s %12s %12s' % (args.knob, 'bytes', 'tokens', 'executed', 'lex tok/s', 'parse tok/s', 'ir_eval ins/s'))
+    for v, r in rows:
+        print('%-8d %9d %8d %12d %12.0f %12.0f %12.0f' % (v, r['bytes'], r['tokens'], r['instructions'], r['lex'], r['parse'], r['ir_eval']))
+
+    # 没有matplotlib也能看个大概：每一段相对最快那次的比例画成一条横杠
+    for stage in ('lex', 'parse', 'ir_eval'):
+        best = max(r[stage] for _, r in rows)
+        print('%s throughput relative to best' % stage)
+        for v, r in rows:
+            print('  %-8d %s %.2f' % (v, '#' * int(40 * r[stage] / best), r[stage] / best))
+
+    if args.plot is not None:
+        plot_sweep(args.knob, rows, args.plot)
+
+
+# 编辑器里打字：在源码正中间往后第一条赋值的表达式里，紧跟着一个数字字面量一个字一个字打进text，再一个字一个字删掉，
+# 每一下从改完文本到AST和指令都好了的时间，增量的Document对整体重新lex/parse/gen。
+# 默认的text全是数字，打到一半也只是字面量变长，每一下都能parse过；
+# 延迟按Document.last分开报，出错那几下只是SyntaxError提前退出，不算在重新parse/gen里面
+def bench_incr(args):
+    src = synth.generate(args.seed, synth.Knobs(size = args.size, procs = args.procs))
+    start = time.perf_counter()
+    doc = incr.Document(src)
+    t_open = time.perf_counter() - start
+    print('synth size %d, %d procedures: %d bytes, %d tokens, open %.4fs' % (args.size, args.procs, len(src), len(doc.toks), t_open))
+
+    literal = re.compile(r':=[^;\n]*?(?<!\w)\d+')
+    pos = (literal.search(src, len(src) // 2) or literal.search(src)).end()
+    text = args.text
+    edits = [(pos + k, pos + k, text[k]) for k in range(len(text))]
+    edits += [(pos + k, pos + k + 1, '') for k in reversed(range(len(text)))]
+
+    lat = {}
+    for a, b, t in edits:
+        start = time.perf_counter()
+        try:
+            doc.edit(a, b, t)
+        except (SyntaxError, RuntimeError):
+            pass
+        lat.setdefault(doc.last, []).append(time.perf_counter() - start)
+
+    # 整体重新编译太慢，只挑开头、中间、结尾三个时刻的源码各编一次
+    full = []
+    texts = [src[:pos] + text[:k] + src[pos:] for k in (1, len(text) // 2, len(text))]
+    for s in texts:
+        start = time.perf_counter()
+        try:
+            incr.compile_full(s)
+        except (SyntaxError, RuntimeError):
+            pass
+        full.append(time.perf_counter() - start)
+
+    t_full = sorted(full)[len(full) // 2]
+    line = src.count('\n', 0, pos) + 1
+    print('%d keystrokes typing then deleting %r at line %d: %s' % (len(edits), text, line, src.split('\n')[line - 1].strip()))
+    print('  %-18s %9.3fms' % ('full recompile', t_full * 1e3))
+    print('  %-18s %5s %10s %10s %8s' % ('incremental path', 'count', 'median', 'max', 'speedup'))
+    for path in ('stmt', 'proc', 'full', 'lex', 'tokens', 'error'):
+        ts = sorted(lat.get(path, []))
+        if ts:
+            med = ts[len(ts) // 2]
+            print('  %-18s %5d %8.3fms %8.3fms %7.0fx' % (path, len(ts), med * 1e3, ts[-1] * 1e3, t_full / med))
+    prog, buf = incr.compile_full(doc.src)
+    print('  back to the original source, matches a full compile: %s' % (doc.src == src and doc.prog == prog and doc.buf == buf))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest = 'cmd', required = True)
+
+    p = sub.add_parser('lex', help = 'tokens lexed per source token, before/after the token buffer')
+    p.add_argument('-n', type = int, default = 2000)
+    p.set_defaults(fn = bench_lex)
+
+    p = sub.add_parser('vm', help = 'instructions per second of each VM on the TEST_PROGRAM loop')
+    p.add_argument('-n', type = int, default = 100000)
+    p.set_defaults(fn = bench_vm)
+
+    p = sub.add_parser('mem', help = 'memory per instruction, list[Ir] against CodeObject')
+    p.add_argument('-n', type = int, default = 2000)
+    p.set_defaults(fn = bench_mem)
+
+    p = sub.add_parser('cache', help = 'startup time, cold compile against a warm bytecode cache')
+    p.add_argument('-n', type = int, default = 20000)
+    p.set_defaults(fn = bench_cache)
+
+    p = sub.add_parser('peephole', help = 'instruction counts before/after opt.peephole')
+    p.set_defaults(fn = bench_peephole)
+
+    p = sub.add_parser('fuse', help = 'VM dispatches and time before/after opt.fuse superinstructions')
+    p.add_argument('-n', type = int, default = 100000)
+    p.set_defaults(fn = bench_fuse)
+
+    p = sub.add_parser('closure', help = 'Program.eval against the closure-compiled AST')
+    p.add_argument('-n', type = int, default = 20000)
+    p.set_defaults(fn = bench_closure)
+
+    p = sub.add_parser('transpile', help = 'optimized VM against the PL/0 -> Python transpiler')
+    p.add_argument('-n', type = int, default = 100000)
+    p.set_defaults(fn = bench_transpile)
+
+    p = sub.add_parser('jit', help = 'ir_eval against the hot-loop JIT, with JIT counters')
+    p.add_argument('-n', type = int, default = 100000)
+    p.add_argument('--threshold', type = int, default = 50)
+    p.set_defaults(fn = bench_jit)
+
+    p = sub.add_parser('regvm', help = 'instructions executed and time, stack machines against the register VM')
+    p.add_argument('-n', type = int, default = 100000)
+    p.set_defaults(fn = bench_regvm)
+
+    p = sub.add_parser('profile', help = 'per-opcode/pc/procedure profile of ir_eval on the TEST_PROGRAM loop')
+    p.add_argument('-n', type = int, default = 20000)
+    p.add_argument('--limit', type = int, default = 20, help = 'rows of the per-pc table')
+    p.add_argument('--json', help = 'also dump the profile to this file')
+    p.set_defaults(fn = bench_profile)
+
+    p = sub.add_parser('sample', help = 'SIGPROF sampling profile of ir_eval mapped back to PL/0 source lines')
+    p.add_argument('-n', type = int, default = 200000)
+    p.add_argument('--interval', type = float, default = 0.001, help = 'seconds of CPU time between samples')
+    p.add_argument('--limit', type = int, default = 10)
+    p.set_defaults(fn = bench_sample)
+
+    p = sub.add_parser('sink', help = 'Program.eval/ir_eval with each output sink on ctx.out')
+    p.add_argument('-n', type = int, default = 20000)
+    p.set_defaults(fn = bench_sink)
+
+    p = sub.add_parser('batch', help = 'jobs per second running one program over many initial values, by worker count')
+    p.add_argument('--jobs', type = int, default = 20000)
+    p.add_argument('--workers', default = '1,2,4,8')
+    p.add_argument('--chunksize', type = int, default = 256)
+    p.set_defaults(fn = bench_batch)
+
+    p = sub.add_parser('lanes', help = 'one program over many inputs: serial ir_eval/vm.VM against the NumPy LaneVM')
+    p.add_argument('--lanes', default = '100,1000,10000')
+    p.set_defaults(fn = bench_lanes)
+
+    p = sub.add_parser('async', help = 'ir_eval against the sliced asyncio runner, and many programs in one event loop')
+    p.add_argument('-n', type = int, default = 100000)
+    p.add_argument('--slices', default = '100,1000,10000')
+    p.add_argument('--jobs', type = int, default = 8)
+    p.set_defaults(fn = bench_async)
+
+    p = sub.add_parser('snapshot', help = 'snapshot size/time by live state, and checkpointing overhead of the resumable VM')
+    p.add_argument('-n', type = int, default = 100000)
+    p.add_argument('--every', default = '1000,10000,100000')
+    p.set_defaults(fn = bench_snapshot)
+
+    p = sub.add_parser('incr', help = 'edit-to-ready latency of incremental reparse/recompile against a full recompile')
+    p.add_argument('--size', type = int, default = 10000)
+    p.add_argument('--procs', type = int, default = 300)
+    p.add_argument('--seed', type = int, default = 0)
+    p.add_argument('--text', default = '1234567890')
+    p.set_defaults(fn = bench_incr)
+
+    p = sub.add_parser('sweep', help = 'throughput of Lexer/Parser/ir_eval while sweeping one synth.Knobs knob')
+    p.add_argument('--knob', default = 'size', choices = synth.Knobs._fields)
+    p.add_argument('--values', default = '100,200,400,800,1600')
+    p.add_argument('--seed', type = int, default = 0)
+    p.add_argument('--repeat', type = int, default = 3)
+    p.add_argument('--plot', help = 'save a throughput/size plot here (needs matplotlib)')
+    p.set_defaults(fn = bench_sweep)
+
+    p = sub.add_parser('suite', help = 'time lex/parse/gen/eval/ir_eval over a corpus, JSON output and baseline comparison')
+    p.add_argument('--json', help = 'write results to this file')
+    p.add_argument('--baseline', help = 'compare against results written earlier with --json')
+    p.add_argument('--tolerance', type = float, default = 0.10, help = 'slowdown allowed before flagging a regression')
+    p.add_argument('--min-time', type = float, default = 0.002, help = 'absolute slowdown in seconds below which nothing is flagged')
+    p.add_argument('--scale', type = float, default = 1.0, help = 'multiply the iteration counts and source sizes')
+    p.add_argument('--repeat', type = int, default = 3)
+    p.set_defaults(fn = bench_suite)
+
+    args = ap.parse_args()
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    main()
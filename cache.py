@@ -0,0 +1,164 @@
+# 编译结果的磁盘缓存，和.pyc一个意思
+# 同一份源码跑很多次时，只要缓存还新鲜就跳过lex/parse/gen/resolve/link，直接把Image读回来。
+#
+# 文件格式(全部小端)：
+#   头      magic 'PL0C', 版本号 u16, 保留 u16, 源码的sha256 32字节
+#   名字池  u32个数, 每个是 u32长度 + utf-8
+#   常量池  u32个数, 每个是 u32长度 + 有符号大端整数
+#   代码    u32条数, 然后是ops/args/vals三列各 条数*4 字节
+#   过程表  u32个数, 每个是 名字, u32层数, u32变量个数 + 每个变量名
+import hashlib
+import os
+import struct
+import sys
+from array import array
+
+from vm import CodeObject, Image, Proc, compile_program
+
+CACHE_MAGIC = b'PL0C'
+# IrOpCode的编号或者上面的格式一变就要加一，旧缓存会被当成过期
+CACHE_VERSION = 1
+CACHE_SUFFIX = '.pl0c'
+
+_HEADER = struct.Struct('<4sHH32s')
+U32 = struct.Struct('<I')
+
+def source_hash(src: str) -> bytes:
+    return hashlib.sha256(src.encode('utf-8')).digest()
+
+# 源码foo.pl0的缓存放在同目录的__pl0cache__/foo.pl0.pl0c
+def cache_path(path: str) -> str:
+    head, tail = os.path.split(path)
+    return os.path.join(head, '__pl0cache__', tail + CACHE_SUFFIX)
+
+# 名字和整数的编码，读回来用Reader；snapshot的格式也用这一套
+def put_str(out: list[bytes], s: str):
+    b = s.encode('utf-8')
+    out.append(U32.pack(len(b)))
+    out.append(b)
+
+def put_int(out: list[bytes], v: int):
+    b = v.to_bytes((v.bit_length() + 8) // 8, 'big', signed = True)
+    out.append(U32.pack(len(b)))
+    out.append(b)
+
+def _put_column(out: list[bytes], col: array):
+    if sys.byteorder != 'little':
+        col = array(col.typecode, col)
+        col.byteswap()
+    out.append(col.tobytes())
+
+def dump_image(image: Image, digest: bytes) -> bytes:
+    code = image.code
+    out = [_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, 0, digest)]
+
+    out.append(U32.pack(len(code.names)))
+    for name in code.names:
+        put_str(out, name)
+
+    out.append(U32.pack(len(code.consts)))
+    for v in code.consts:
+        if not isinstance(v, int):
+            raise RuntimeError('only linked code can be cached')
+        put_int(out, v)
+
+    out.append(U32.pack(len(code)))
+    for col in (code.ops, code.args, code.vals):
+        _put_column(out, col)
+
+    out.append(U32.pack(len(image.procs)))
+    for proc in image.procs:
+        put_str(out, proc.name)
+        out.append(U32.pack(proc.level))
+        out.append(U32.pack(len(proc.names) - 1))
+        for name in proc.names[1:]:
+            put_str(out, name)
+
+    return b''.join(out)
+
+class Reader:
+    data : bytes
+    pos  : int
+
+    def __init__(self, data: bytes, pos: int):
+        self.data = data
+        self.pos = pos
+
+    def take(self, n: int) -> bytes:
+        if self.pos + n > len(self.data):
+            raise ValueError('truncated data')
+        b = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return b
+
+    def u32(self) -> int:
+        return U32.unpack(self.take(4))[0]
+
+    def text(self) -> str:
+        return self.take(self.u32()).decode('utf-8')
+
+    def integer(self) -> int:
+        return int.from_bytes(self.take(self.u32()), 'big', signed = True)
+
+    def column(self, n: int) -> array:
+        col = array('i')
+        col.frombytes(self.take(n * col.itemsize))
+        if sys.byteorder != 'little':
+            col.byteswap()
+        return col
+
+# 头不对、版本不对、源码变了都返回None，调用方重新编译就行
+def load_image(data: bytes, digest: bytes) -> Image | None:
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, _, stored = _HEADER.unpack_from(data)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION or stored != digest:
+        return None
+
+    rd = Reader(data, _HEADER.size)
+    code = CodeObject()
+    code.names = [rd.text() for _ in range(rd.u32())]
+    code.consts = [rd.integer() for _ in range(rd.u32())]
+    n = rd.u32()
+    code.ops = rd.column(n)
+    code.args = rd.column(n)
+    code.vals = rd.column(n)
+
+    procs = []
+    for _ in range(rd.u32()):
+        name = rd.text()
+        level = rd.u32()
+        names = [name] + [rd.text() for _ in range(rd.u32())]
+        procs.append(Proc(name, level, names, []))
+
+    return Image(code, procs)
+
+# 先写临时文件再改名，别的进程不会读到写了一半的缓存
+def write_cache(path: str, image: Image, digest: bytes):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(dump_image(image, digest))
+    os.replace(tmp, path)
+
+# 有新鲜的缓存就直接用，没有就编译一遍顺手写进去
+def compile_cached(src: str, path: str) -> Image:
+    digest = source_hash(src)
+    try:
+        with open(path, 'rb') as f:
+            image = load_image(f.read(), digest)
+    except (OSError, ValueError):
+        image = None
+
+    if image is None:
+        image = compile_program(src)
+        try:
+            write_cache(path, image, digest)
+        except OSError:
+            pass
+    return image
+
+def load_source(path: str) -> Image:
+    with open(path, encoding = 'utf-8') as f:
+        src = f.read()
+    return compile_cached(src, cache_path(path))
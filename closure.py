@@ -0,0 +1,276 @@
+# 闭包编译：把AST走一遍，每个节点变成一个专门的Python闭包，运行时只调根上的那个闭包
+# Program.eval每次访问节点都要重新isinstance、比较运算符字符串、走assert；
+# 这里这些都在编译时决定好：运算符直接换成operator里的函数，
+# 名字在编译时按词法作用域解析成(往外跳几层, 变量还是常量)，常量直接换成值。
+# 运行时的帧还是EvalContext，静态链、ctx.out上的输出、报错信息都和Program.eval一样，
+# 跑完之后ctx里的东西也一样，可以直接和Program.eval的结果对照。
+# 和Program.eval一样，传进来的应该是一个空的EvalContext。
+import operator
+from typing import Callable, NamedTuple
+
+from demo2 import (Assign, Begin, Block, Call, Condition, EvalContext, Expression, Factor, If, OddCondition,
+                   Program, Statement, Term, While)
+
+Thunk = Callable[[EvalContext], object]
+
+_ARITH = {
+    '*' : operator.mul,
+    '+' : operator.add,
+    '-' : operator.sub,
+}
+
+_CMP = {
+    '='  : operator.eq,
+    '#'  : operator.ne,
+    '<'  : operator.lt,
+    '<=' : operator.le,
+    '>'  : operator.gt,
+    '>=' : operator.ge,
+}
+
+# 编译时的作用域，一层对应运行时的一帧：syms里变量是('var', None)，常量是('const', 值)；
+# procs里是过程编译出来的闭包，放在一个单元素list里，递归调用时自己还没编译完也能先引用上
+class Scope(NamedTuple):
+    parent : 'Scope | None'
+    syms   : dict[str, tuple[str, int | None]]
+    procs  : dict[str, list[Thunk | None]]
+
+    # 返回(往外跳几层, 'var'或'const', 常量的值)
+    def lookup(self, name: str) -> tuple[int, str, int | None] | None:
+        scope, depth = self, 0
+        while scope is not None:
+            if name in scope.syms:
+                return (depth,) + scope.syms[name]
+            scope, depth = scope.parent, depth + 1
+        return None
+
+    def lookup_proc(self, name: str) -> tuple[int, list[Thunk | None]] | None:
+        scope, depth = self, 0
+        while scope is not None:
+            if name in scope.procs:
+                return depth, scope.procs[name]
+            scope, depth = scope.parent, depth + 1
+        return None
+
+def compile_program(prog: Program) -> Thunk:
+    return _compile_block(prog.block, None)
+
+def _fail(msg: str) -> Thunk:
+    def fail(ctx: EvalContext):
+        raise RuntimeError(msg)
+    return fail
+
+# 往外跳depth层拿到那一帧，0层和1层最常见，单独展开
+def _frame(depth: int) -> Callable[[EvalContext], EvalContext]:
+    if depth == 0:
+        return lambda ctx: ctx
+    if depth == 1:
+        return lambda ctx: ctx.parent
+
+    def frame(ctx: EvalContext) -> EvalContext:
+        for _ in range(depth):
+            ctx = ctx.parent
+        return ctx
+    return frame
+
+def _compile_block(block: Block, parent: Scope | None) -> Thunk:
+    scope = Scope(parent, {}, {})
+    for const in block.const:
+        scope.syms.setdefault(const.name, ('const', const.value))
+    for var in block.vars:
+        scope.syms.setdefault(var.name, ('var', None))
+    # 同名过程后定义的覆盖先定义的，和Procedure.eval往ctx.procs里写一样
+    for proc in block.procs:
+        scope.procs[proc.name] = [None]
+    for proc in block.procs:
+        scope.procs[proc.name][0] = _compile_block(proc.body, scope)
+
+    consts = [(c.name, c.value) for c in block.const]
+    names = [v.name for v in block.vars]
+    procs = [(p.name, p.body) for p in block.procs]
+    stmt = _compile_stmt(block.stmt, scope)
+
+    # 定义部分照Block.eval的顺序在运行时做，重复定义的报错时机也一样
+    def run(ctx: EvalContext):
+        for key, value in consts:
+            if key not in ctx.consts and key not in ctx.vars:
+                ctx.consts[key] = [value, 0, False]
+            else:
+                raise RuntimeError('multiple definition const')
+        for key in names:
+            if key not in ctx.vars and key not in ctx.consts:
+                ctx.vars[key] = [None, 0, False]
+            else:
+                raise RuntimeError('multiple definition var')
+        for key, body in procs:
+            ctx.procs[key] = body
+        stmt(ctx)
+    return run
+
+def _compile_stmt(node, scope: Scope) -> Thunk:
+    if isinstance(node, Statement):
+        return _compile_stmt(node.stmt, scope)
+
+    elif isinstance(node, Assign):
+        return _compile_assign(node, scope)
+
+    elif isinstance(node, Call):
+        found = scope.lookup_proc(node.name)
+        if found is None:
+            return _fail('call procedure before definition')
+        depth, target = found
+        owner = _frame(depth)
+
+        def call(ctx: EvalContext):
+            # 新帧只装被调过程自己的定义，静态链指向定义它的那一帧
+            target[0](EvalContext({}, {}, {}, owner(ctx), ctx.out))
+        return call
+
+    elif isinstance(node, Begin):
+        body = [_compile_stmt(s, scope) for s in node.body]
+
+        def begin(ctx: EvalContext):
+            for stmt in body:
+                stmt(ctx)
+        return begin
+
+    elif isinstance(node, If):
+        cond = _compile_cond(node.cond, scope)
+        then = _compile_stmt(node.then, scope)
+
+        def if_(ctx: EvalContext):
+            if cond(ctx) != 0:
+                then(ctx)
+        return if_
+
+    elif isinstance(node, While):
+        cond = _compile_cond(node.cond, scope)
+        do = _compile_stmt(node.do, scope)
+
+        def while_(ctx: EvalContext):
+            while cond(ctx) != 0:
+                do(ctx)
+        return while_
+
+    else:
+        return _fail('invalid statement')
+
+def _compile_assign(node: Assign, scope: Scope) -> Thunk:
+    expr = _compile_expr(node.expr, scope)
+    name = node.name
+    sym = scope.lookup(name)
+
+    # 表达式照样先算，报错的先后和Assign.eval一样
+    if sym is None or sym[1] == 'const':
+        msg = 'assign before definite' if sym is None else 'assign a const is not permitted'
+
+        def bad_assign(ctx: EvalContext):
+            expr(ctx)
+            raise RuntimeError(msg)
+        return bad_assign
+
+    depth = sym[0]
+    if depth == 0:
+        def assign(ctx: EvalContext):
+            v = expr(ctx)
+            ctx.vars[name][0] = v
+            ctx.out.value(name, v)
+    else:
+        frame = _frame(depth)
+
+        def assign(ctx: EvalContext):
+            v = expr(ctx)
+            frame(ctx).vars[name][0] = v
+            ctx.out.value(name, v)
+    return assign
+
+def _compile_cond(node: Condition, scope: Scope) -> Thunk:
+    cond = node.cond
+    if isinstance(cond, OddCondition):
+        expr = _compile_expr(cond.expr, scope)
+        return lambda ctx: expr(ctx) & 1
+
+    if cond.op not in _CMP:
+        return _fail('invalid op type (%s)' % cond.op)
+    cmp = _CMP[cond.op]
+    lhs = _compile_expr(cond.lhs, scope)
+    rhs = _compile_expr(cond.rhs, scope)
+    return lambda ctx: 1 if cmp(lhs(ctx), rhs(ctx)) else 0
+
+def _compile_expr(node: Expression, scope: Scope) -> Thunk:
+    if node.mod not in {'', '+', '-'}:
+        return _fail('invalid expression sign')
+
+    ret = _compile_term(node.term, scope)
+    if node.mod == '-':
+        term = ret
+        ret = lambda ctx: -term(ctx)
+
+    for op, rhs in node.rhs:
+        if op not in {'+', '-'}:
+            return _fail('invalid expression operator')
+        ret = _binary(_ARITH[op], ret, _compile_term(rhs, scope))
+    return ret
+
+def _compile_term(node: Term, scope: Scope) -> Thunk:
+    # Parser.term在碰到'.'时会返回一个Factor
+    if isinstance(node, Factor):
+        return _compile_factor(node, scope)
+
+    ret = _compile_factor(node.lhs, scope)
+    for op, rhs in node.rhs:
+        if op == '*':
+            ret = _binary(_ARITH[op], ret, _compile_factor(rhs, scope))
+        elif op == '/':
+            ret = _div(ret, _compile_factor(rhs, scope))
+        else:
+            return _fail('invalid expression operator')
+    return ret
+
+def _binary(fn, lhs: Thunk, rhs: Thunk) -> Thunk:
+    return lambda ctx: fn(lhs(ctx), rhs(ctx))
+
+def _div(lhs: Thunk, rhs: Thunk) -> Thunk:
+    def div(ctx: EvalContext):
+        a = lhs(ctx)
+        b = rhs(ctx)
+        if b == 0:
+            raise RuntimeError('div 0 error')
+        return a / b
+    return div
+
+def _compile_factor(node: Factor, scope: Scope) -> Thunk:
+    value = node.value
+    if isinstance(value, int):
+        return lambda ctx: value
+
+    elif isinstance(value, str):
+        sym = scope.lookup(value)
+        if sym is None:
+            return _fail('undefined symbol: ' + value)
+        depth, kind, const = sym
+        if kind == 'const':
+            return lambda ctx: const
+
+        msg = 'variable %s referenced before initialize' % value
+        if depth == 0:
+            def load(ctx: EvalContext):
+                v = ctx.vars[value][0]
+                if v is None:
+                    raise RuntimeError(msg)
+                return v
+        else:
+            frame = _frame(depth)
+
+            def load(ctx: EvalContext):
+                v = frame(ctx).vars[value][0]
+                if v is None:
+                    raise RuntimeError(msg)
+                return v
+        return load
+
+    elif isinstance(value, Expression):
+        return _compile_expr(value, scope)
+
+    else:
+        return _fail('invalid factor value')
@@ -397,6 +397,7 @@ class Parser:
         self.expect(TokenKind.Op, '.')
         return Program(block)
         
-parser = Parser(Lexer(TEST_PROGRAM))
-prog = parser.program()
-print(prog)
+if __name__ == '__main__':
+    parser = Parser(Lexer(TEST_PROGRAM))
+    prog = parser.program()
+    print(prog)
@@ -1,7 +1,10 @@
+import bisect
 from enum import IntEnum
 from typing import NamedTuple
 import string
-import copy
+import re
+import sys
+from typing import TextIO
 
 TEST_PROGRAM ="""
 var i, s;
@@ -154,6 +157,157 @@ class Lexer:
         else:
             raise SyntaxError('invalid character' + repr(self.s[self.i]))
 
+# 一次性扫描整个源码的版本：空白在每个token前面直接吞掉，靠分组区分token种类，
+# 最后补一个Eof，产出的Token和报的SyntaxError都和Lexer.next一致
+TOKEN_PATTERN = re.compile(r'''
+    \s*
+    (?:
+        (?P<num>\d+)
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<op>:=|[<>]=?|[=\#+\-*/,.;()])
+      | (?P<colon>:)
+      | (?P<bad>\S)
+    )
+''', re.VERBOSE)
+
+# TOKEN_PATTERN一次匹配的几个分组 -> Token，colon和bad是lex错误
+def make_token(num: str, name: str, op: str, colon: str, bad: str) -> Token:
+    if num:
+        return Token.num(int(num))
+    elif name in KEYWORD_SET:
+        return Token.keyword(name)
+    elif name:
+        return Token.name(name)
+    elif op:
+        return Token.op(op)
+    elif colon:
+        raise SyntaxError('"=" expected')
+    else:
+        raise SyntaxError('invalid character' + repr(bad))
+
+# offs不是None的话，每个token在源码里的[开始, 结束)偏移按顺序追加进去，Eof是(len(src), len(src))
+def tokenize(src: str, offs: list[tuple[int, int]] | None = None) -> list[Token]:
+    toks = []
+    append = toks.append
+    # Token是不可变的，同一段文本只造一次，后面直接复用
+    seen = {}
+    # bad能吃掉任何非空白字符，所以findall不会跳过东西，只有结尾的空白匹配不上
+    if offs is None:
+        matches = TOKEN_PATTERN.findall(src)
+    else:
+        # 要位置就换成finditer，慢一点，不要位置的时候不受影响
+        matches = []
+        for m in TOKEN_PATTERN.finditer(src):
+            matches.append(m.groups())
+            offs.append(m.span(m.lastindex))
+        offs.append((len(src), len(src)))
+    for num, name, op, colon, bad in matches:
+        text = num or name or op
+        tk = seen.get(text)
+
+        if tk is None:
+            tk = seen[text] = make_token(num, name, op, colon, bad)
+
+        append(tk)
+
+    append(Token.eof())
+    return toks
+
+# 给Parser用的token缓冲区：按下标peek/next，lex过的token都留在buf里，
+# 向前看不用回滚Lexer，每个token只扫一次
+# offs和buf一一对应，是每个token在源码里的[开始, 结束)，None就是不记位置；
+# 整体lex的时候由tokenize(src, offs)填好，边解析边lex的时候在这里跟着填
+class TokenStream:
+    lx   : Lexer | None
+    buf  : list[Token]
+    pos  : int
+    offs : list[tuple[int, int]] | None
+
+    def __init__(self, lx: Lexer | None = None, buf: list[Token] | None = None,
+                 offs: list[tuple[int, int]] | None = None):
+        self.lx = lx
+        self.buf = [] if buf is None else buf
+        self.pos = 0
+        self.offs = offs
+
+    def peek(self) -> Token:
+        if self.pos < len(self.buf):
+            return self.buf[self.pos]
+        # buf用完了才去找Lexer要，没有Lexer说明已经整体lex过了，后面都是Eof
+        if self.lx is None:
+            return Token.eof()
+        if self.offs is not None:
+            # 先把空白吃掉，Lexer.i就是这个token的开头
+            self.lx._skip_blank()
+            start = self.lx.i
+            tk = self.lx.next()
+            self.offs.append((start, self.lx.i))
+        else:
+            tk = self.lx.next()
+        self.buf.append(tk)
+        return tk
+
+    def next(self) -> Token:
+        tk = self.peek()
+        self.pos += 1
+        return tk
+
+    # 从下标为mark的token到刚吃掉的那个token，在源码里占的[开始, 结束)；不记位置就是None
+    def span(self, mark: int) -> tuple[int, int] | None:
+        offs = self.offs
+        if offs is None or not offs or self.pos <= mark:
+            return None
+        last = min(self.pos, len(offs)) - 1
+        return offs[min(mark, last)][0], offs[last][1]
+
+# 源码偏移 -> (行, 列)，都从1开始：先记下每一行开头的偏移，查的时候二分
+class LineTable:
+    starts : list[int]
+
+    def __init__(self, src: str):
+        starts = [0]
+        i = src.find('\n')
+        while i >= 0:
+            starts.append(i + 1)
+            i = src.find('\n', i + 1)
+        self.starts = starts
+
+    def locate(self, off: int) -> tuple[int, int]:
+        line = bisect.bisect_right(self.starts, off) - 1
+        return line + 1, off - self.starts[line] + 1
+
+# gen顺手产出的 pc -> 源码区间 表：每段指令(主程序和每个过程体各是一段)一个和它一样长的list，
+# 第pc项是生成这条指令的最内层语句的[开始, 结束)，没有语句的指令(定义、Halt)是None
+# 按id(指令list)查，code里留着引用，免得id被别的list复用
+class SpanTable:
+    spans : dict[int, list[tuple[int, int] | None]]
+    code  : list[list['Ir']]
+
+    def __init__(self):
+        self.spans = {}
+        self.code = []
+
+    def of(self, buf: list['Ir']) -> list[tuple[int, int] | None]:
+        spans = self.spans.get(id(buf))
+        if spans is None:
+            spans = self.spans[id(buf)] = []
+            self.code.append(buf)
+        return spans
+
+    def lookup(self, buf: list['Ir'], pc: int) -> tuple[int, int] | None:
+        spans = self.spans.get(id(buf))
+        if spans is None or not 0 <= pc < len(spans):
+            return None
+        return spans[pc]
+
+    # buf里还没有区间的指令，从start开始都记成span；内层语句先gen先记，外层只补剩下的
+    def mark(self, buf: list['Ir'], start: int, span: tuple[int, int] | None):
+        spans = self.of(buf)
+        spans.extend([None] * (len(buf) - len(spans)))
+        for pc in range(start, len(buf)):
+            if spans[pc] is None:
+                spans[pc] = span
+
 # lx = Lexer(TEST_PROGRAM)
 # tk = lx.next()
 # while tk.ty != TokenKind.Eof:
@@ -184,6 +338,25 @@ class IrOpCode(IntEnum):
     DefLit  = 18
     DefProc = 19
     Call    = 20
+    # 下面这些是vm.resolve把名字解析成槽位之后才会出现的
+    LoadLocal  = 21
+    StoreLocal = 22
+    LoadOuter  = 23
+    StoreOuter = 24
+    # vm.link把所有过程体摊平到一个数组之后，过程体末尾用Ret返回
+    Ret        = 25
+    # opt.fuse把resolve之后常见的指令序列合并成的超级指令，只有vm.VM认识
+    IncLocal      = 26  # LoadLocal s; LoadLit k; Add; StoreLocal s   args=s, value=k
+    AddLocals     = 27  # LoadLocal a; LoadLocal b; Add                args=a, value=b
+    SubLocals     = 28
+    MulLocals     = 29
+    AddStoreLocal = 30  # Add; StoreLocal s                            args=s
+    CmpEqBrFalse  = 31  # Eq; BrFalse t                                args=t
+    CmpNeBrFalse  = 32
+    CmpLtBrFalse  = 33
+    CmpLteBrFalse = 34
+    CmpGtBrFalse  = 35
+    CmpGteBrFalse = 36
     Halt    = 255
 
 # N元操作符
@@ -193,10 +366,105 @@ class Ir(NamedTuple):
     value : int | list['Ir'] | None = None
 
 # 怎么想到这些数据结构的？
+# 一个EvalContext就是一个过程的一次调用(一帧)，只装这一层自己定义的东西，
+# parent是静态链，指向定义这个过程的那一层，外层的名字顺着链往外找
+# 程序往外输出的东西都交给EvalContext.out：Assign.eval赋的值，ir_eval的Call调到的过程的指令清单
+# Sink本身什么都不做，也就是null sink；PrintSink和原来一样每次直接print，是默认的；
+# BufferedSink攒起来一次写出去，Call的清单默认不写；TraceSink不写文本，把事件记成元组
+# 攒着的要记得调flush
+class Sink:
+    def value(self, name: str, v):
+        pass
+
+    def call(self, name: str, body: list['Ir']):
+        pass
+
+    def flush(self):
+        pass
+
+NullSink = Sink
+
+class PrintSink(Sink):
+    def value(self, name: str, v):
+        print(v)
+
+    def call(self, name: str, body: list['Ir']):
+        for index in range(0, len(body)):
+            print(index, end=' ')
+            print(body[index])
+
+# 写出去的文本和PrintSink一字不差，攒够limit行或者flush的时候才写一次
+class BufferedSink(Sink):
+    file  : 'TextIO | None'
+    calls : bool
+    limit : int
+    lines : list[str]
+
+    # file是None就写到flush时的sys.stdout，calls决定要不要Call的指令清单
+    def __init__(self, file: 'TextIO | None' = None, calls: bool = False, limit: int = 65536):
+        self.file = file
+        self.calls = calls
+        self.limit = limit
+        self.lines = []
+
+    def value(self, name: str, v):
+        self.lines.append(str(v))
+        if len(self.lines) >= self.limit:
+            self.flush()
+
+    def call(self, name: str, body: list['Ir']):
+        if self.calls:
+            self.lines.extend('%d %s' % (index, ir) for index, ir in enumerate(body))
+            if len(self.lines) >= self.limit:
+                self.flush()
+
+    def flush(self):
+        if self.lines:
+            (self.file or sys.stdout).write('\n'.join(self.lines) + '\n')
+            self.lines.clear()
+
+# 事件是('assign', 变量名, 值)和('call', 过程名, 指令条数)
+class TraceSink(Sink):
+    events : list[tuple[str, str, object]]
+
+    def __init__(self):
+        self.events = []
+
+    def value(self, name: str, v):
+        self.events.append(('assign', name, v))
+
+    def call(self, name: str, body: list['Ir']):
+        self.events.append(('call', name, len(body)))
+
+STDOUT = PrintSink()
+
 class EvalContext(NamedTuple):
     vars   : dict[str, list[int | None, int, bool]]
     procs  : dict[str, 'Block | list[Ir]']
     consts : dict[str, list[int, int, bool]]
+    parent : 'EvalContext | None' = None
+    # 新帧都沿用调用者的out
+    out    : Sink = STDOUT
+
+    # 返回(那一项, 是不是常量)，内层的同名定义挡住外层的
+    def lookup(self, key: str) -> tuple[list, bool] | None:
+        ctx = self
+        while ctx is not None:
+            if key in ctx.vars:
+                return ctx.vars[key], False
+            if key in ctx.consts:
+                return ctx.consts[key], True
+            ctx = ctx.parent
+        return None
+
+    # 返回(过程体, 定义它的那一帧)，后者就是被调过程新帧的静态链
+    def lookup_proc(self, key: str) -> tuple['Block | list[Ir]', 'EvalContext'] | None:
+        ctx = self
+        while ctx is not None:
+            if key in ctx.procs:
+                return ctx.procs[key], ctx
+            ctx = ctx.parent
+        return None
 
 class Const(NamedTuple):
     name    : str
@@ -210,13 +478,9 @@ class Const(NamedTuple):
         key = self.name
         value = self.value
         
+        # 外层的同名定义在别的帧里，这里只管这一层有没有重复
         if key not in ctx.consts and key not in ctx.vars:
             ctx.consts[key] = [value, 0, False]
-        elif key in ctx.vars and ctx.vars[key][1] != 0:
-            ctx.consts[key] = [value, 0, False]
-            del ctx.vars[key]
-        elif key in ctx.consts and ctx.consts[key][1] != 0:
-            ctx.consts[key] = [value, 0, False]
         else:
             raise RuntimeError('multiple definition const')
 
@@ -238,20 +502,17 @@ class Factor(NamedTuple):
             return self.value
 
         elif isinstance(self.value, str):
-            if self.value in ctx.vars:
-                key = self.value
-                ret = ctx.vars[key][0]
-
-                if ret is None:
-                    raise RuntimeError('variable %s referenced before initialize' % key)
-                else:
-                    return ret
-            
-            elif self.value in ctx.consts:
-                return ctx.consts[self.value][0]
-                
+            key = self.value
+            found = ctx.lookup(key)
+
+            if found is None:
+                raise RuntimeError('undefined symbol: ' + key)
+
+            ret = found[0][0]
+            if ret is None:
+                raise RuntimeError('variable %s referenced before initialize' % key)
             else:
-                raise RuntimeError('undefined symbol: ' + self.value)
+                return ret
 
         elif isinstance(self.value, Expression):
             val = self.value.eval(ctx)
@@ -357,23 +618,24 @@ class Assign(NamedTuple):
     def eval(self, ctx: EvalContext) -> int | None:
         expr = self.expr.eval(ctx)
         assert expr is not None, 'invalid assignment'
-        if self.name in ctx.consts:
+        found = ctx.lookup(self.name)
+        if found is None:
+            raise RuntimeError('assign before definite')
+        elif found[1]:
             raise RuntimeError('assign a const is not permitted')
-        elif self.name in ctx.vars:
-            ctx.vars[self.name][0] = expr
         else:
-            raise RuntimeError('assign before definite')
+            found[0][0] = expr
         
-        print(expr)
+        ctx.out.value(self.name, expr)
 
 class Procedure(NamedTuple):
     name    : str
     body    : 'Block'
 
-    def gen(self, buf: list[Ir]):
+    def gen(self, buf: list[Ir], spans: SpanTable | None = None):
         pir = []
         if isinstance(self.name, str):
-            self.body.gen(pir)
+            self.body.gen(pir, spans)
             buf.append(Ir(IrOpCode.DefProc, self.name, pir))
         else:
             raise RuntimeError('invalid definition of procedure name')
@@ -400,33 +662,19 @@ class Call(NamedTuple):
         
         key = self.name
 
-        if key not in ctx.procs:
+        found = ctx.lookup_proc(key)
+        if found is None:
             raise RuntimeError('call procedure before definition')
-        tctx = copy.deepcopy(ctx)
-        ctx = EvalContext({}, {}, {})
-        for each in tctx.vars:
-            ctx.vars[each] = [tctx.vars[each][0], tctx.vars[each][1]+1, False]
-        for each in tctx.consts:
-            ctx.consts[each] = [tctx.consts[each][0], tctx.consts[each][1]+1, False]
-        for each in tctx.procs:
-            ctx.procs[each] = tctx.procs[each]
-        # 此处我的理解是sp不用变换
-        ctx.procs[key].eval(ctx)
-        for each in tctx.vars:
-            # 在下一层修改了一个全局变量
-            if each in ctx.vars and ctx.vars[each][1] == tctx.vars[each][1]+1 and ctx.vars[each][2] == True:
-                tctx.vars[each] = [tctx.vars[each][0], tctx.vars[each][1], True]
-            # 在下一层定义了与全局变量同名的局部变量，在下一层没有修改全局变量，在下一层去掉了这个变量
-            else:
-                continue
-        ctx = copy.deepcopy(tctx)
+        # 新帧只装被调过程自己的定义，外层变量顺着静态链去改，返回时什么都不用拷回来
+        body, owner = found
+        body.eval(EvalContext({}, {}, {}, owner, ctx.out))
 
 class Begin(NamedTuple):
     body    : list['Statement']
 
-    def gen(self, buf: list[Ir]):
+    def gen(self, buf: list[Ir], spans: SpanTable | None = None):
         for body in self.body:
-            body.gen(buf)
+            body.gen(buf, spans)
 
     def eval(self, ctx: EvalContext) -> int | None:
         for body in self.body:
@@ -503,11 +751,11 @@ class If(NamedTuple):
     cond    : Condition
     then    : 'Statement'
 
-    def gen(self, buf: list[Ir]):
+    def gen(self, buf: list[Ir], spans: SpanTable | None = None):
         self.cond.gen(buf)
         i = len(buf)
         buf.append(Ir(IrOpCode.BrFalse))
-        self.then.gen(buf)
+        self.then.gen(buf, spans)
         buf[i] = Ir(IrOpCode.BrFalse, len(buf)) # 太妙了，就是跳到的位置是最后的位置
 
     def eval(self, ctx: EvalContext) -> int | None:
@@ -521,12 +769,12 @@ class While(NamedTuple):
     cond    : Condition
     do      : 'Statement'
 
-    def gen(self, buf: list[Ir]):
+    def gen(self, buf: list[Ir], spans: SpanTable | None = None):
         i = len(buf)
         self.cond.gen(buf)
         j = len(buf)
         buf.append(Ir(IrOpCode.BrFalse))
-        self.do.gen(buf)
+        self.do.gen(buf, spans)
         buf[j] = Ir(IrOpCode.BrFalse, len(buf)+1)
         buf.append(Ir(IrOpCode.Jump, i))
 
@@ -541,9 +789,19 @@ class While(NamedTuple):
 
 class Statement(NamedTuple):
     stmt: Assign | Call | Begin | If | While
-
-    def gen(self, buf: list[Ir]):
-        self.stmt.gen(buf)
+    # 这条语句在源码里的[开始, 结束)偏移，Parser不记位置的时候是None
+    span: tuple[int, int] | None = None
+
+    def gen(self, buf: list[Ir], spans: SpanTable | None = None):
+        if spans is None:
+            self.stmt.gen(buf)
+            return
+        start = len(buf)
+        if isinstance(self.stmt, (Begin, If, While)):
+            self.stmt.gen(buf, spans)
+        else:
+            self.stmt.gen(buf)
+        spans.mark(buf, start, self.span)
 
     def eval(self, ctx: EvalContext) -> int | None:
         self.stmt.eval(ctx)
@@ -556,16 +814,9 @@ class Var(NamedTuple):
 
     def eval(self, ctx: EvalContext) -> int | None:
         key = self.name
-        # 在上一层以及之前都没定义过
+        # 这一层没定义过就行，上一层定义过的在别的帧里，会被这个挡住
         if key not in ctx.vars and key not in ctx.consts:
             ctx.vars[key] = [None, 0, False]
-        # 在上一层的变量里定义过
-        elif key in ctx.vars and ctx.vars[key][1] != 0:
-            ctx.vars[key] = [None, 0, False]
-        # 在上一层的常量里定义过
-        elif key in ctx.consts and ctx.consts[key][1] != 0:
-            ctx.vars[key] = [None, 0, False]
-            del ctx.consts[key]
         else:
             raise RuntimeError('multiple definition var')
 
@@ -575,14 +826,14 @@ class Block(NamedTuple):
     procs   : list[Procedure]
     stmt    : Statement
 
-    def gen(self, buf: list[Ir]):
+    def gen(self, buf: list[Ir], spans: SpanTable | None = None):
         for const in self.const:
             const.gen(buf)
         for var in self.vars:
             var.gen(buf)
         for proc in self.procs:
-            proc.gen(buf)
-        self.stmt.gen(buf)
+            proc.gen(buf, spans)
+        self.stmt.gen(buf, spans)
 
     def eval(self, ctx: EvalContext) -> int | None:
         for const in self.const:
@@ -596,9 +847,11 @@ class Block(NamedTuple):
 class Program(NamedTuple):
     block   : 'Block'
 
-    def gen(self, buf: list[Ir]):
-        self.block.gen(buf)
+    def gen(self, buf: list[Ir], spans: SpanTable | None = None):
+        self.block.gen(buf, spans)
         buf.append(Ir(IrOpCode.Halt))
+        if spans is not None:
+            spans.mark(buf, len(buf), None)
 
     def eval(self, ctx: EvalContext) -> int | None:
         return self.block.eval(ctx)
@@ -607,25 +860,28 @@ class Program(NamedTuple):
 # {}:0-*
 
 class Parser:
-    lx : Lexer
+    ts : TokenStream
     
-    def __init__(self, lx : Lexer):
-        self.lx = lx
+    # 传Lexer就边解析边lex，传TokenStream(buf = tokenize(src))就是先整体lex好再解析
+    def __init__(self, lx : Lexer | TokenStream):
+        if isinstance(lx, TokenStream):
+            self.ts = lx
+        else:
+            self.ts = TokenStream(lx)
 
-    # 看下一个token是不是这个，是的话就吃掉，不是的话就返回false，算是支持反复检查的回滚操作
+    # 看下一个token是不是这个，是的话就吃掉，不是的话就返回false，只是peek所以不用回滚
     def check(self, ty : TokenKind, val : str | int) -> bool:
-        p = self.lx.i
-        tk = self.lx.next()
+        tk = self.ts.peek()
         
         if tk.ty == ty and tk.val == val:
+            self.ts.next()
             return True
         
-        self.lx.i = p
         return False
 
     # 下一个token必须是啥
     def expect(self, ty : TokenKind, val: str | int | None = None):
-        tk = self.lx.next()
+        tk = self.ts.next()
         tty, tval = tk.ty, tk.val
         
         if tty != ty:
@@ -636,7 +892,7 @@ class Parser:
                 raise SyntaxError('"%s" expected, got "%s"' % (val, tval))
     
     def factor(self) -> Factor:
-        ident = self.lx.next()
+        ident = self.ts.next()
         if ident.ty == TokenKind.Name:
             return Factor(ident.val)
         elif ident.ty == TokenKind.Num:
@@ -653,34 +909,29 @@ class Parser:
         if self.check(TokenKind.Op, '.'):
             return Factor(fac1)
         fac_list = []
-        p = self.lx.i
-        token = self.lx.next()
+        token = self.ts.peek()
         while token.val == '*' or token.val == '/':
+            self.ts.next()
             fac_list.append((token.val, self.factor()))
-            p = self.lx.i
-            token = self.lx.next()
+            token = self.ts.peek()
         
-        self.lx.i = p
         return Term(fac1, fac_list)
 
     def expression(self) -> Expression:
-        p = self.lx.i
-        token = self.lx.next()
+        token = self.ts.peek()
         if token.val == '+' or token.val == '-':
+            self.ts.next()
             te = self.term()
             mod = token.val
         else:
-            self.lx.i = p
             mod = ''
             te = self.term()
         term_list = []
-        p = self.lx.i
-        ttoken = self.lx.next()
+        ttoken = self.ts.peek()
         while ttoken.val == '+' or ttoken.val == '-':
+            self.ts.next()
             term_list.append((ttoken.val, self.term()))
-            p = self.lx.i
-            ttoken = self.lx.next()
-        self.lx.i = p
+            ttoken = self.ts.peek()
         return Expression(mod, te, term_list)
 
     def condition(self) -> Condition:
@@ -689,7 +940,7 @@ class Parser:
             return Condition(OddCondition(expr))
         else:
             expr1 = self.expression()
-            token = self.lx.next()
+            token = self.ts.next()
             if token.val not in ['=', '#', '<', '>', '<=', '>=']:
                 raise SyntaxError('condition syntax error')
             expr2 = self.expression()
@@ -698,17 +949,17 @@ class Parser:
     def begin(self) -> Begin:
         stat_list = []
         stat_list.append(self.statement())
-        token = self.lx.next()
+        token = self.ts.next()
         while token.val == ';':
             stat_list.append(self.statement())
-            token = self.lx.next()
+            token = self.ts.next()
         if token.val == 'end':
             return Begin(stat_list)
         else:
             raise SyntaxError('end is expected')
 
     def call(self) -> Call:
-        ident = self.lx.next()
+        ident = self.ts.next()
         if ident.ty != TokenKind.Name:
             raise SyntaxError('name expected')
         else:
@@ -731,7 +982,7 @@ class Parser:
             raise SyntaxError("do is expected")
 
     def assign(self) -> Assign:
-        ident = self.lx.next()
+        ident = self.ts.next()
         if ident.ty != TokenKind.Name:
             raise SyntaxError('assign ident name error')
         self.expect(TokenKind.Op, ':=')
@@ -739,23 +990,25 @@ class Parser:
         return Assign(ident.val, expr)
 
     def statement(self) -> Statement:
+        mark = self.ts.pos
         if self.check(TokenKind.Keyword, 'call'):
-            return Statement(self.call())
+            stmt = self.call()
         elif self.check(TokenKind.Keyword, 'begin'):
-            return Statement(self.begin())
+            stmt = self.begin()
         elif self.check(TokenKind.Keyword, 'if'):
-            return Statement(self.if_())
+            stmt = self.if_()
         elif self.check(TokenKind.Keyword, 'while'):
-            return Statement(self.while_())
+            stmt = self.while_()
         else:
-            return Statement(self.assign())
+            stmt = self.assign()
+        return Statement(stmt, self.ts.span(mark))
 
     def const(self) -> Const:
-        ident = self.lx.next()
+        ident = self.ts.next()
         if ident.ty != TokenKind.Name:
             raise SyntaxError('const ident name error')
         if self.check(TokenKind.Op, '='):
-            num = self.lx.next()
+            num = self.ts.next()
             if num.ty != TokenKind.Num:
                 raise SyntaxError('const num error')
             return Const(ident.val, num.val)
@@ -763,14 +1016,14 @@ class Parser:
             raise SyntaxError('const = is expected')
 
     def var(self) -> Var:
-        ident = self.lx.next()
+        ident = self.ts.next()
         if ident.ty != TokenKind.Name:
             raise SyntaxError('var ident type error')
         else:
             return Var(ident.val)
 
     def procedure(self) -> Procedure:
-        ident = self.lx.next()
+        ident = self.ts.next()
         if ident.ty != TokenKind.Name:
             raise SyntaxError('pro ident type error')
         self.expect(TokenKind.Op, ';')
@@ -785,18 +1038,18 @@ class Parser:
 
         if self.check(TokenKind.Keyword, 'const'):
             const_list.append(self.const())
-            token = self.lx.next()
+            token = self.ts.next()
             while token.val != ';' and token.val == ',':
                 const_list.append(self.const())
-                token = self.lx.next()
+                token = self.ts.next()
             if token.val != ';':
                 raise SyntaxError('invalid line end syntax')
         if self.check(TokenKind.Keyword, 'var'):
             var_list.append(self.var())
-            token = self.lx.next()
+            token = self.ts.next()
             while token.val != ';' and token.val == ',':
                 var_list.append(self.var())
-                token = self.lx.next()
+                token = self.ts.next()
             if token.val != ';':
                 raise SyntaxError('invalid line end syntax')
         while self.check(TokenKind.Keyword, 'procedure'):
@@ -811,225 +1064,219 @@ class Parser:
         return Program(block)
 
 
+# 每条指令一个处理函数，按IrOpCode下标查表分派，不用再一路if/elif比下去
+# 处理函数都是 (ir, sp, ctx, pc) -> 下一条指令的pc
+HALT_PC = 1 << 62
+
+# 就是从末尾pop的
+def _ir_add(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    sp.append(v1 + v2)
+    return pc
+
+def _ir_sub(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    sp.append(v1 - v2)
+    return pc
+
+def _ir_mul(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    sp.append(v1 * v2)
+    return pc
+
+# 状态机的感觉，报错在状态机里报错
+def _ir_div(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    if v2 == 0:
+        raise RuntimeError('divided by zero')
+    sp.append(v1 / v2)
+    return pc
+
+def _ir_neg(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    sp.append(-sp.pop())
+    return pc
+
+def _ir_eq(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    sp.append(1 if v1 == v2 else 0)
+    return pc
+
+def _ir_ne(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    sp.append(1 if v1 != v2 else 0)
+    return pc
+
+def _ir_lt(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    sp.append(1 if v1 < v2 else 0)
+    return pc
+
+def _ir_lte(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    sp.append(1 if v1 <= v2 else 0)
+    return pc
+
+def _ir_gt(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    sp.append(1 if v1 > v2 else 0)
+    return pc
+
+def _ir_gte(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    sp.append(1 if v1 >= v2 else 0)
+    return pc
+
+def _ir_odd(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    sp.append(sp.pop() & 1)
+    return pc
+
+# 这里的load是从数据结构里load，store也是存到数据结构里
+def _ir_loadvar(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    key = ir.args
+    if not isinstance(key, str):
+        raise RuntimeError('invalid loadvar args')
+
+    found = ctx.lookup(key)
+    if found is None:
+        raise RuntimeError('undefined variable: ' + key)
+
+    val = found[0][0]
+    if val is None:
+        raise RuntimeError('variable %s referenced before initialization' % key)
+    sp.append(val)
+    return pc
+
+def _ir_loadlit(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    if not isinstance(ir.args, int):
+        raise RuntimeError('invalid loadlit args')
+    sp.append(ir.args)
+    return pc
+
+def _ir_store(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    v = sp.pop()
+    if not isinstance(ir.args, str):
+        raise RuntimeError('invalid store args')
+    found = ctx.lookup(ir.args)
+    if found is None or found[1]: # 这里默认常量不可修改
+        raise RuntimeError('change before define vars')
+    slot = found[0]
+    slot[0] = v
+    slot[2] = True
+    return pc
+
+def _ir_jump(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    if not isinstance(ir.args, int):
+        raise RuntimeError('invalid jump args')
+    return ir.args
+
+# 条件为0才跳，不是0就接着往下走
+def _ir_brfalse(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    if not isinstance(ir.args, int):
+        raise RuntimeError('invalid brfalse args')
+    if sp.pop() == 0:
+        return ir.args
+    return pc
+
+def _ir_defvar(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    if not isinstance(ir.args, str):
+        raise RuntimeError('invalid defvar args')
+
+    key = ir.args
+    # 这一层没定义过就行，上一层定义过的在别的帧里，会被这个挡住
+    if key not in ctx.vars and key not in ctx.consts:
+        ctx.vars[key] = [None, 0, False]
+    else:
+        raise RuntimeError('multiply definition :' + ir.args)
+    return pc
+
+# 定义即覆盖
+def _ir_deflit(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    if not isinstance(ir.args, str):
+        raise RuntimeError('invalid deflit args')
+
+    if not isinstance(ir.value, int):
+        raise RuntimeError('invalid deflit value')
+
+    key = ir.args
+    if key not in ctx.vars and key not in ctx.consts:
+        ctx.consts[key] = [ir.value, 0, False]
+    else:
+        raise RuntimeError('multiply definition :' + ir.args)
+    return pc
+
+def _ir_defproc(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    if not isinstance(ir.args, str):
+        raise RuntimeError('invalid defproc args')
+    elif not isinstance(ir.value, list):
+        raise RuntimeError('invalid defproc value')
+    ctx.procs[ir.args] = ir.value
+    return pc
+
+def _ir_call(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    found = ctx.lookup_proc(ir.args)
+    if found is None:
+        raise RuntimeError('call procedure before definition')
+    # 新帧只装被调过程自己的定义，静态链指向定义它的那一层，调用的开销只和被调过程的局部变量有关
+    body, owner = found
+    # 此处我的理解是sp不用变换
+    ir_eval(body, EvalContext({}, {}, {}, owner, ctx.out))
+    ctx.out.call(ir.args, body)
+    return pc
+
+# 怎么判断啥时候halt？返回一个比任何buf都长的pc，主循环自然就退出了
+def _ir_halt(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    return HALT_PC
+
+def _ir_invalid(ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+    raise RuntimeError('invalid instruction')
+
+IR_DISPATCH = [_ir_invalid] * 256
+for _op, _fn in (
+    (IrOpCode.Add,     _ir_add),
+    (IrOpCode.Sub,     _ir_sub),
+    (IrOpCode.Mul,     _ir_mul),
+    (IrOpCode.Div,     _ir_div),
+    (IrOpCode.Neg,     _ir_neg),
+    (IrOpCode.Eq,      _ir_eq),
+    (IrOpCode.Ne,      _ir_ne),
+    (IrOpCode.Lt,      _ir_lt),
+    (IrOpCode.Lte,     _ir_lte),
+    (IrOpCode.Gt,      _ir_gt),
+    (IrOpCode.Gte,     _ir_gte),
+    (IrOpCode.Odd,     _ir_odd),
+    (IrOpCode.LoadVar, _ir_loadvar),
+    (IrOpCode.LoadLit, _ir_loadlit),
+    (IrOpCode.Store,   _ir_store),
+    (IrOpCode.Jump,    _ir_jump),
+    (IrOpCode.BrFalse, _ir_brfalse),
+    (IrOpCode.DefVar,  _ir_defvar),
+    (IrOpCode.DefLit,  _ir_deflit),
+    (IrOpCode.DefProc, _ir_defproc),
+    (IrOpCode.Call,    _ir_call),
+    (IrOpCode.Halt,    _ir_halt),
+):
+    IR_DISPATCH[_op] = _fn
+del _op, _fn
+
 def ir_eval(buf: list[Ir], ctx: EvalContext):
     pc = 0 # 因为是模拟cpu，所以是pc，模拟的指令计数器，运算符从调用栈里搞，操作数暂存到sp里
     sp = [] # 模拟的调用栈
-    while pc < len(buf):
+    n = len(buf)
+    dispatch = IR_DISPATCH
+    while pc < n:
         ir = buf[pc]
-        pc += 1
-
-        # 就是从末尾pop的
-        if ir.op == IrOpCode.Add:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(v1 + v2)
-
-        elif ir.op == IrOpCode.Sub:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(v1 - v2)
-
-        elif ir.op == IrOpCode.Mul:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            sp.append(v1 * v2)
-
-        # 状态机的感觉，报错在状态机里报错
-        elif ir.op == IrOpCode.Div:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            if v2 == 0:
-                raise RuntimeError('divided by zero')
-            else:
-                sp.append(v1 / v2)
-
-        elif ir.op == IrOpCode.Neg:
-            v = sp.pop()
-            sp.append(-v)
+        pc = dispatch[ir.op](ir, sp, ctx, pc + 1)
 
-        elif ir.op == IrOpCode.Eq:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            if v1 == v2:
-                sp.append(1)
-            else:
-                sp.append(0)
-        
-        elif ir.op == IrOpCode.Ne:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            if v1 != v2:
-                sp.append(1)
-            else:
-                sp.append(0)
-
-        elif ir.op == IrOpCode.Gt:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            if v1 > v2:
-                sp.append(1)
-            else:
-                sp.append(0)
-        
-        elif ir.op == IrOpCode.Lt:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            if v1 < v2:
-                sp.append(1)
-            else:
-                sp.append(0)
-            
-        elif ir.op == IrOpCode.Gte:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            if v1 >= v2:
-                sp.append(1)
-            else:
-                sp.append(0)
-
-        elif ir.op == IrOpCode.Lte:
-            v2 = sp.pop()
-            v1 = sp.pop()
-            if v1 <= v2:
-                sp.append(1)
-            else:
-                sp.append(0)
-        
-        elif ir.op == IrOpCode.Odd:
-            v = sp.pop()
-            sp.append(v & 1)
-            
-        # 这是数据结构重复利用了下！为什么还要重复利用呢？
-        # 对这个数据结构的利用是相当于CPU里的堆吗
-        # 这里的load是从数据结构里load，store也是存到数据结构里
-        elif ir.op == IrOpCode.LoadVar:
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid loadvar args')
-            
-            elif ir.args in ctx.vars:
-                key = ir.args
-                val = ctx.vars[key][0]
-
-                if val is None:
-                    raise RuntimeError('variable %s referenced before initialization' % key)
-                else:
-                    sp.append(val)
-
-            elif ir.args in ctx.consts:
-                sp.append(ctx.consts[ir.args][0])
-            
-            else:
-                raise RuntimeError('undefined variable: ' + ir.args)
-            
-        elif ir.op == IrOpCode.LoadLit:
-            if not isinstance(ir.args, int):
-                raise RuntimeError('invalid loadlit args')
-            else:
-                sp.append(ir.args)
-                
-        elif ir.op == IrOpCode.Store:
-            v = sp.pop()
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid store args')
-            elif ir.args not in ctx.vars: # 这里默认常量不可修改
-                raise RuntimeError('change before define vars')
-            else:
-                ctx.vars[ir.args][0] = v
-                ctx.vars[ir.args][2] = True
-
-        elif ir.op == IrOpCode.Jump:
-            if not isinstance(ir.args, int):
-                raise RuntimeError('invalid jump args')
-            else:
-                pc = ir.args
-
-        elif ir.op == IrOpCode.BrFalse:
-            if not isinstance(ir.args, int):
-                raise RuntimeError('invalid brfalse args')
-            else:
-                pc = ir.args
-
-        elif ir.op == IrOpCode.DefVar:
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid defvar args')
-
-            key = ir.args
-            # 在上一层以及之前都没定义过
-            if key not in ctx.vars and key not in ctx.consts:
-                ctx.vars[key] = [None, 0, False]
-            # 在上一层的变量里定义过
-            elif key in ctx.vars and ctx.vars[key][1] != 0:
-                ctx.vars[key] = [None, 0, False]
-            # 在上一层的常量里定义过
-            elif key in ctx.consts and ctx.consts[key][1] != 0:
-                ctx.vars[key] = [None, 0, False]
-                del ctx.consts[key]
-            else:
-                raise RuntimeError('multiply definition :' + ir.args)
-
-        elif ir.op == IrOpCode.DefLit:
-            # 定义即覆盖
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid deflit args')
-
-            if not isinstance(ir.value, int):
-                raise RuntimeError('invalid deflit value')
-
-            key = ir.args
-            if key not in ctx.vars and key not in ctx.consts:
-                ctx.consts[key] = [ir.value, 0, False]
-            elif key in ctx.vars and ctx.vars[key][1] != 0:
-                ctx.consts[key] = [ir.value, 0, False]
-                del ctx.vars[key]
-            elif key in ctx.consts and ctx.consts[key][1] != 0:
-                ctx.consts[key] = [ir.value, 0, False]
-            else:
-                raise RuntimeError('multiply definition :' + ir.args)
-
-        elif ir.op == IrOpCode.DefProc:
-            if not isinstance(ir.args, str):
-                raise RuntimeError('invalid defproc args')
-            elif not isinstance(ir.value, list):
-                raise RuntimeError('invalid defproc value')
-            else:
-                ctx.procs[ir.args] = ir.value
-
-        elif ir.op == IrOpCode.Call:
-            if ir.args not in ctx.procs:
-                raise RuntimeError('call procedure before definition')
-            tctx = copy.deepcopy(ctx)
-            ctx = EvalContext({}, {}, {})
-            for each in tctx.vars:
-                ctx.vars[each] = [tctx.vars[each][0], tctx.vars[each][1]+1, False]
-            for each in tctx.consts:
-                ctx.consts[each] = [tctx.consts[each][0], tctx.consts[each][1]+1, False]
-            for each in tctx.procs:
-                ctx.procs[each] = tctx.procs[each]
-            pbuf = copy.deepcopy(buf)
-            buf = copy.deepcopy(ctx.procs[ir.args])
-            # 此处我的理解是sp不用变换
-            ir_eval(buf, ctx)
-            for each in tctx.vars:
-                # 在下一层修改了一个全局变量
-                if each in ctx.vars and ctx.vars[each][1] == tctx.vars[each][1]+1 and ctx.vars[each][2] == True:
-                    tctx.vars[each] = [tctx.vars[each][0], tctx.vars[each][1], True]
-                # 在下一层定义了与全局变量同名的局部变量，在下一层没有修改全局变量，在下一层去掉了这个变量
-                else:
-                    continue
-            ctx = copy.deepcopy(tctx)
-            # 常量不可以变化，把之前的弄回来就好
-            # procs都用之前的就好
-            for index in range(0, len(buf)):
-                print(index, end=' ')
-                print(buf[index])
-            buf = copy.deepcopy(pbuf)
-
-        elif ir.op == IrOpCode.Halt: # 怎么判断啥时候halt？
-            break
-
-        else:
-            raise RuntimeError('invalid instruction')
-        
 
 # parser = Parser(Lexer(TEST_PROGRAM))
 # prog = parser.program()
@@ -1041,10 +1288,11 @@ def ir_eval(buf: list[Ir], ctx: EvalContext):
 # ctx = EvalContext({}, {}, {})
 # ir_eval(buf, ctx)
 
-parser = Parser(Lexer(TEST_PROGRAM))
-prog = parser.program()
-ctx = EvalContext({}, {}, {})
-prog.eval(ctx)
+if __name__ == '__main__':
+    parser = Parser(Lexer(TEST_PROGRAM))
+    prog = parser.program()
+    ctx = EvalContext({}, {}, {})
+    prog.eval(ctx)
 
 # 只有在assign的时候会修改变量
 # 数据结构改变涉及到的操作有：loadvar,store,defvar,deflit,defproc,halt,call
@@ -0,0 +1,385 @@
+# 给编辑器用的增量编译：改一处文本，只重新lex改坏的那几个token，只重新解析包住它的那条块语句或者那个过程，
+# 只重新gen那一个过程的指令
+# Document留着上一次的token列表、每个token在源码里的位置、AST、每个过程的指令，还有一棵过程树，
+# 树上每个节点记着过程在token列表里的范围和它的块语句从哪个token开始。
+#
+# 重新lex：从改动前面最后一个没碰到的token的结尾开始用TOKEN_PATTERN一个一个往后匹配，
+# 匹配到的token开头正好落在改动后面某个旧token(挪过位置之后)的开头上，后面的文本一样，lex出来也一样，就停下接上旧的。
+# 新token和被换掉的旧token一样(只改了空白、或者改完又改回来)，AST和指令都不用动。
+#
+# 重新解析：从过程树上找包住改动的最里层节点，
+#   改动都在它的块语句里，就从块语句开头重新parse一条语句，必须正好停在原来的结尾(过程的';'、主程序的'.')上；
+#   不行就从'procedure'后面重新parse这整个过程，也必须正好停在原来的';'上，还不行就往外一层。
+# 递归下降的Parser是确定的，改动前面的token没变，整体parse走到这里的时候调的也是同一个statement()/procedure()，
+# 所以局部parse的结果放回去和整体parse一样；整个过程parse报的SyntaxError整体parse也一定会报，直接抛出去；
+# 块语句parse报的错只有开头不是'const'/'var'/'procedure'的时候才一定会报(是的话整体parse会当成声明)，否则往外一层。
+# 主程序的声明、或者改动跨过了最外层的过程，就在已有的token上整体parse一遍。
+#
+# 新的AST和指令是复制出来的：从改了的节点往上，每一层的procs和指令list都复制一份再换掉那一项，
+# 以前拿到的prog和buf不会被改，正在跑的ir_eval不受影响。
+#
+# token的位置：改了一处之后后面每个token都要挪，几十万个token一个一个挪比重新parse一个过程还慢，
+# 所以下标从lag_from开始的位置都先欠着lag没加，下次改的时候只把两次改动之间那一段补上或者改成欠着，
+# 一直在同一个地方打字，每次只动几个token。
+#
+# 出错的时候(parse的SyntaxError、gen的RuntimeError，和整体编译一样)：src和token照样更新，prog/buf还是上一次好的，error是这次的错误，
+# 没重新parse成功的token范围记在dirty里，下次改的时候和新的改动合在一起重新parse。
+from bisect import bisect_left
+
+from demo2 import (TOKEN_PATTERN, Block, Ir, IrOpCode, Parser, Procedure, Program, Statement, Token, TokenStream,
+                   make_token, tokenize)
+
+# 过程树上的一个节点，主程序也是一个
+class Node:
+    # 过程名，主程序是None
+    name     : str | None
+    # 'procedure'这个token的下标，主程序是-1；整个节点作废了是-2，什么都包不住
+    lo       : int
+    # 块语句第一个token的下标
+    stmt     : int
+    # 过程结尾的';'、主程序的'.'再往后一个
+    hi       : int
+    block    : Block
+    buf      : list[Ir]
+    parent   : 'Node | None'
+    children : list['Node']
+
+    def __init__(self, name: str | None, lo: int, stmt: int, hi: int, block: Block, children: list['Node']):
+        self.name = name
+        self.lo = lo
+        self.stmt = stmt
+        self.hi = hi
+        self.block = block
+        self.buf = []
+        self.parent = None
+        self.children = children
+        for child in children:
+            child.parent = self
+
+    # 块语句的指令在buf里从哪开始：前面是每个常量、变量、过程各一条定义
+    @property
+    def stmt_pc(self) -> int:
+        block = self.block
+        return len(block.const) + len(block.vars) + len(block.procs)
+
+    # [a, b)里的token都在这个节点里面，不碰'procedure'、过程名前面和结尾的';'/'.'
+    def contains(self, a: int, b: int) -> bool:
+        return self.lo < a and b <= self.hi - 1
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+# 边parse边记下过程树：每个过程的token范围，每个块语句从哪个token开始
+class _TreeParser(Parser):
+    children  : list[Node]
+    # 最近一条最外层(不在别的语句里面)的语句从哪个token开始，块parse完的时候就是这个块的语句
+    stmt_mark : int
+    depth     : int
+
+    def __init__(self, ts: TokenStream):
+        super().__init__(ts)
+        self.children = []
+        self.stmt_mark = 0
+        self.depth = 0
+
+    def statement(self) -> Statement:
+        mark = self.ts.pos
+        self.depth += 1
+        stmt = super().statement()
+        self.depth -= 1
+        if self.depth == 0:
+            self.stmt_mark = mark
+        return stmt
+
+    def procedure(self) -> Procedure:
+        # 'procedure'已经被block()吃掉了
+        lo = self.ts.pos - 1
+        outer, self.children = self.children, []
+        proc = super().procedure()
+        outer.append(Node(proc.name, lo, self.stmt_mark, self.ts.pos, proc.body, self.children))
+        self.children = outer
+        return proc
+
+# 块语句前面还能接着写的声明的开头
+_DECL_KEYWORDS = (Token.keyword('const'), Token.keyword('var'), Token.keyword('procedure'))
+
+# 节点和它下面的子过程挂上gen出来的指令
+def _attach(node: Node, buf: list[Ir]):
+    node.buf = buf
+    base = len(node.block.const) + len(node.block.vars)
+    for k, child in enumerate(node.children):
+        _attach(child, buf[base + k].value)
+
+# 整体编译，给Document当对照
+def compile_full(src: str) -> tuple[Program, list[Ir]]:
+    prog = Parser(TokenStream(buf = tokenize(src))).program()
+    buf = []
+    prog.gen(buf)
+    return prog, buf
+
+class Document:
+    src      : str
+    # token和位置，lex失败了是None，下次改的时候整体重新lex
+    toks     : list[Token] | None
+    offs     : list[tuple[int, int]]
+    # offs里下标>=lag_from的位置都还差lag没加
+    lag_from : int
+    lag      : int
+    # 过程树，parse失败了是None，下次改的时候在token上整体parse
+    root     : Node | None
+    # 还没parse成功的token范围
+    dirty    : tuple[int, int] | None
+    # 最后一次编译成功的结果
+    prog     : Program | None
+    buf      : list[Ir] | None
+    # 最后一次编译的错误：parse的SyntaxError，或者gen的RuntimeError
+    error    : Exception | None
+    # 上一次edit走的是哪条路：'tokens'(token没变)、'stmt'、'proc'、'full'、'lex'(整体重新lex再parse)、'error'
+    last     : str
+
+    def __init__(self, src: str):
+        self.src = src
+        self.toks = None
+        self.offs = []
+        self.lag_from = 0
+        self.lag = 0
+        self.root = None
+        self.dirty = None
+        self.prog = None
+        self.buf = None
+        self.error = None
+        self.last = 'lex'
+        # 打开的时候就有错也照样建出来，错误在error里
+        try:
+            self._relex_all()
+        except (SyntaxError, RuntimeError):
+            pass
+
+    # 把src[start:end]换成text，重新编译；出错抛SyntaxError/RuntimeError，这时候的状态见文件开头
+    def edit(self, start: int, end: int, text: str):
+        if not 0 <= start <= end <= len(self.src):
+            raise ValueError('edit range out of bounds')
+        self.src = self.src[:start] + text + self.src[end:]
+        dc = len(text) - (end - start)
+        if self.toks is None:
+            self._relex_all()
+            return
+
+        try:
+            i, j, toks, offs = self._relex(start, end, dc)
+        except SyntaxError as e:
+            self.toks = None
+            self.root = None
+            self.dirty = None
+            self._fail(e)
+
+        n = len(toks)
+        same = toks == self.toks[i:j]
+        self._splice(i, j, toks, offs, dc)
+        if self.root is None:
+            self._parse_all()
+            return
+
+        dt = n - (j - i)
+        self._shift(i, j, dt)
+        if same and self.dirty is None:
+            self.last = 'tokens'
+            return
+        # 只删了token的话，改动前面那个token也算进来，否则删掉块语句前面的';'看起来像是只改了块语句
+        a, b = (i - 1, i) if n == 0 else (i, i + n)
+        if self.dirty is not None:
+            da, db = self.dirty
+            a = min(a, da if da < i else i if da < j else da + dt)
+            b = max(b, db if db <= i else i + n if db < j else db + dt)
+        self.dirty = a, b
+        self._reparse(a, b)
+
+    def _fail(self, e: Exception):
+        self.error = e
+        self.last = 'error'
+        raise e
+
+    def _relex_all(self):
+        self.root = None
+        self.dirty = None
+        offs = []
+        try:
+            self.toks = tokenize(self.src, offs)
+        except SyntaxError as e:
+            self.toks = None
+            self._fail(e)
+        self.offs = offs
+        self.lag_from = len(offs)
+        self.lag = 0
+        self._parse_all()
+        self.last = 'lex'
+
+    def _parse_all(self):
+        self.root = None
+        self.dirty = None
+        ps = _TreeParser(TokenStream(buf = self.toks))
+        buf = []
+        try:
+            prog = ps.program()
+            prog.gen(buf)
+        except (SyntaxError, RuntimeError) as e:
+            self._fail(e)
+        root = Node(None, -1, ps.stmt_mark, ps.ts.pos, prog.block, ps.children)
+        _attach(root, buf)
+        self.root = root
+        self.dirty = None
+        self.prog = prog
+        self.buf = buf
+        self.error = None
+        self.last = 'full'
+
+    # 第k个token在源码里的[开始, 结束)
+    def _span(self, k: int) -> tuple[int, int]:
+        s, e = self.offs[k]
+        if k >= self.lag_from:
+            return s + self.lag, e + self.lag
+        return s, e
+
+    # 第一个end(或者start)>=pos的token，位置都是改之前的
+    def _find(self, pos: int, end: bool) -> int:
+        key = (lambda t: t[1]) if end else (lambda t: t[0])
+        k = bisect_left(self.offs, pos, 0, self.lag_from, key = key)
+        if k < self.lag_from:
+            return k
+        return bisect_left(self.offs, pos - self.lag, self.lag_from, len(self.offs), key = key)
+
+    # 返回旧token里被换掉的[i, j)和换上去的新token、新位置
+    def _relex(self, start: int, end: int, dc: int) -> tuple[int, int, list[Token], list[tuple[int, int]]]:
+        src = self.src
+        # 结尾挨着改动的token也可能变，比如在名字后面接着打字
+        i = self._find(start, True)
+        pos = self._span(i - 1)[1] if i > 0 else 0
+        # 开头在改动后面的旧token才能接上
+        j = self._find(end, False)
+        eof = len(self.toks) - 1
+        toks = []
+        offs = []
+        while True:
+            m = TOKEN_PATTERN.match(src, pos)
+            if m is None:
+                # 后面只剩空白，接上Eof
+                return i, eof, toks, offs
+            s = m.start(m.lastindex)
+            while j < eof and self._span(j)[0] + dc < s:
+                j += 1
+            if self._span(j)[0] + dc == s:
+                return i, j, toks, offs
+            toks.append(make_token(*m.groups()))
+            offs.append((s, m.end()))
+            pos = m.end()
+
+    # 把token的[i, j)换掉，后面的位置都挪dc
+    def _splice(self, i: int, j: int, toks: list[Token], offs: list[tuple[int, int]], dc: int):
+        lag_from, lag = self.lag_from, self.lag
+        stored = self.offs
+        if lag:
+            # 先让[0, i)都是真值、j往后都欠着lag
+            if lag_from < i:
+                stored[lag_from:i] = [(s + lag, e + lag) for s, e in stored[lag_from:i]]
+            elif lag_from > j:
+                stored[j:lag_from] = [(s - lag, e - lag) for s, e in stored[j:lag_from]]
+        self.toks[i:j] = toks
+        stored[i:j] = offs
+        self.lag_from = i + len(toks)
+        self.lag = lag + dc
+
+    # token下标跟着挪；开头或者结尾的token被换掉的节点作废
+    def _shift(self, i: int, j: int, dt: int):
+        for node in self.root.walk():
+            if node.lo == -2:
+                continue
+            if i <= node.lo < j or i <= node.hi - 1 < j:
+                node.lo = node.hi = -2
+                continue
+            if node.lo >= j:
+                node.lo += dt
+            if node.stmt >= j:
+                node.stmt += dt
+            if node.hi > i:
+                node.hi += dt
+
+    def _reparse(self, a: int, b: int):
+        node = self.root
+        if not node.contains(a, b):
+            self._parse_all()
+            return
+        while True:
+            for child in node.children:
+                if child.contains(a, b):
+                    node = child
+                    break
+            else:
+                break
+
+        if node.stmt <= a:
+            ts = TokenStream(buf = self.toks)
+            ts.pos = node.stmt
+            try:
+                stmt = Parser(ts).statement()
+            except SyntaxError as e:
+                # 块语句开头不是'const'/'var'/'procedure'的话，整体parse走到这里调的也是statement()，报的是同一个错，
+                # 不用再往外一层一层重新parse；是的话整体parse会把它当声明，得往外一层
+                if self.toks[node.stmt] not in _DECL_KEYWORDS:
+                    self._fail(e)
+                stmt = None
+            if stmt is not None and ts.pos == node.hi - 1:
+                block = node.block._replace(stmt = stmt)
+                buf = node.buf[:node.stmt_pc]
+                try:
+                    stmt.gen(buf)
+                except RuntimeError as e:
+                    self._fail(e)
+                if node.parent is None:
+                    buf.append(Ir(IrOpCode.Halt))
+                node.block = block
+                node.buf = buf
+                self._commit(node)
+                self.last = 'stmt'
+                return
+
+        while node.parent is not None:
+            ps = _TreeParser(TokenStream(buf = self.toks))
+            ps.ts.pos = node.lo + 1
+            buf = []
+            try:
+                proc = ps.procedure()
+                if ps.ts.pos == node.hi:
+                    proc.gen(buf)
+            except (SyntaxError, RuntimeError) as e:
+                self._fail(e)
+            if buf:
+                fresh = ps.children[0]
+                _attach(fresh, buf[0].value)
+                parent = node.parent
+                parent.children[parent.children.index(node)] = fresh
+                fresh.parent = parent
+                self._commit(fresh)
+                self.last = 'proc'
+                return
+            node = node.parent
+        self._parse_all()
+
+    # node的block和buf换成了新的，往上一层一层复制出新的procs和指令list
+    def _commit(self, node: Node):
+        while node.parent is not None:
+            parent = node.parent
+            k = parent.children.index(node)
+            block = parent.block
+            procs = block.procs[:]
+            procs[k] = Procedure(node.name, node.block)
+            buf = parent.buf[:]
+            buf[len(block.const) + len(block.vars) + k] = Ir(IrOpCode.DefProc, node.name, node.buf)
+            parent.block = block._replace(procs = procs)
+            parent.buf = buf
+            node = parent
+        self.prog = Program(node.block)
+        self.buf = node.buf
+        self.dirty = None
+        self.error = None
@@ -0,0 +1,166 @@
+# ir_eval的性能剖析
+# 要剖析的时候不用ir_eval，用Profiler.eval：同一张分派表、同一套语义，只是循环里每条指令前后各掐一次表，
+# 按操作码、按(过程, pc)、按过程记下执行次数和累计时间。ir_eval本身一行没改，不剖析的时候没有任何额外开销。
+# 时间的算法：
+#   操作码和pc上记的是独占时间，Call那一条不包括被调过程里面花的时间，但包括交给ctx.out输出的时间；
+#   过程上记的total是从进去到出来的全部时间，self是扣掉它再调别的过程之后剩下的。
+# 过程按它的指令list归类(id(buf))，报告里的名字带上外层过程，主程序叫'<main>'，它的过程a里的f叫a.f，
+# 不同层里同名的过程分开记；同一层里又定义了一个同名的，第二个叫f#2。递归时外层的total已经包含了内层的。
+import json
+import time
+
+from demo2 import IR_DISPATCH, EvalContext, Ir, IrOpCode
+
+MAIN = '<main>'
+
+# 报告里一条指令的样子：操作码加上不是None的参数
+def _fmt(ir: Ir) -> str:
+    parts = [IrOpCode(ir.op).name]
+    if ir.args is not None:
+        parts.append(str(ir.args))
+    if ir.value is not None and not isinstance(ir.value, list):
+        parts.append(str(ir.value))
+    return ' '.join(parts)
+
+class Profiler:
+    # 操作码 -> [次数, 独占时间]
+    ops      : dict[IrOpCode, list]
+    # (id(过程的指令), pc) -> [次数, 独占时间]
+    pcs      : dict[tuple[int, int], list]
+    # id(过程的指令) -> [调用次数, 总时间, 独占时间, 执行的指令数]
+    procs    : dict[int, list]
+    # id(过程的指令) -> 指令，报告里按pc把指令找回来，也让这些list活着，id不会被别的list复用
+    code     : dict[int, list[Ir]]
+    # id(过程的指令) -> 报告里的名字
+    names    : dict[int, str]
+    dispatch : list
+    # 当前这条Call在被调过程里花掉的时间，循环里从这一条上扣掉
+    callee   : float
+
+    def __init__(self):
+        self.ops = {}
+        self.pcs = {}
+        self.procs = {}
+        self.code = {}
+        self.names = {}
+        self.dispatch = IR_DISPATCH[:]
+        self.dispatch[IrOpCode.Call] = self._call
+        self.callee = 0.0
+
+    # 第一次见到这段指令就给它和它里面定义的过程都起好名字
+    def _name(self, buf: list[Ir], name: str):
+        self.code[id(buf)] = buf
+        self.names[id(buf)] = name
+        taken = set(self.names.values())
+        for ir in buf:
+            if ir.op == IrOpCode.DefProc and id(ir.value) not in self.names:
+                label = ir.args if name == MAIN else name + '.' + ir.args
+                k = 2
+                while label in taken:
+                    label = '%s#%d' % (label.rsplit('#', 1)[0], k)
+                    k += 1
+                taken.add(label)
+                self._name(ir.value, label)
+
+    def eval(self, buf: list[Ir], ctx: EvalContext, proc: str = MAIN):
+        if id(buf) not in self.names:
+            self._name(buf, proc)
+        proc = id(buf)
+        stat = self.procs.setdefault(proc, [0, 0.0, 0.0, 0])
+        stat[0] += 1
+        ops = self.ops
+        pcs = self.pcs
+        dispatch = self.dispatch
+        clock = time.perf_counter
+        pc = 0
+        sp = []
+        n = len(buf)
+        steps = 0
+        inner = 0.0
+        start = clock()
+        try:
+            while pc < n:
+                ir = buf[pc]
+                t = clock()
+                next_pc = dispatch[ir.op](ir, sp, ctx, pc + 1)
+                dt = clock() - t
+                if self.callee:
+                    dt -= self.callee
+                    inner += self.callee
+                    self.callee = 0.0
+                rec = ops.get(ir.op)
+                if rec is None:
+                    rec = ops[ir.op] = [0, 0.0]
+                rec[0] += 1
+                rec[1] += dt
+                rec = pcs.get((proc, pc))
+                if rec is None:
+                    rec = pcs[(proc, pc)] = [0, 0.0]
+                rec[0] += 1
+                rec[1] += dt
+                steps += 1
+                pc = next_pc
+        finally:
+            total = clock() - start
+            stat[1] += total
+            stat[2] += total - inner
+            stat[3] += steps
+            # 报给调用者那一条Call：被调过程一共花了多久
+            self.callee = total
+
+    # 和_ir_call一样，只是被调过程也在这个Profiler里跑
+    def _call(self, ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+        found = ctx.lookup_proc(ir.args)
+        if found is None:
+            raise RuntimeError('call procedure before definition')
+        body, owner = found
+        self.eval(body, EvalContext({}, {}, {}, owner, ctx.out), ir.args)
+        # 输出算在Call自己头上，先把被调过程的时间取出来，免得输出途中被覆盖
+        callee, self.callee = self.callee, 0.0
+        ctx.out.call(ir.args, body)
+        self.callee = callee
+        return pc
+
+    def to_json(self) -> dict:
+        return {
+            'ops': [
+                {'op': IrOpCode(op).name, 'count': c, 'time': t}
+                for op, (c, t) in sorted(self.ops.items(), key = lambda kv: -kv[1][1])
+            ],
+            'pcs': [
+                {'proc': self.names[proc], 'pc': pc, 'ir': _fmt(self.code[proc][pc]), 'count': c, 'time': t}
+                for (proc, pc), (c, t) in sorted(self.pcs.items(), key = lambda kv: -kv[1][1])
+            ],
+            'procs': [
+                {'proc': self.names[proc], 'calls': calls, 'total': total, 'self': own, 'steps': steps}
+                for proc, (calls, total, own, steps) in sorted(self.procs.items(), key = lambda kv: -kv[1][1])
+            ],
+        }
+
+    def dump_json(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent = 2)
+
+    # 三张表都按时间从大到小排，limit限制pc那张表的行数
+    def table(self, limit: int = 20) -> str:
+        data = self.to_json()
+        total = sum(r['time'] for r in data['ops']) or 1.0
+        lines = ['%-10s %10s %10s %6s' % ('opcode', 'count', 'time', '%')]
+        for r in data['ops']:
+            lines.append('%-10s %10d %9.4fs %5.1f%%' % (r['op'], r['count'], r['time'], 100 * r['time'] / total))
+
+        lines.append('')
+        lines.append('%-12s %5s %-24s %10s %10s' % ('proc', 'pc', 'ir', 'count', 'time'))
+        for r in data['pcs'][:limit]:
+            lines.append('%-12s %5d %-24s %10d %9.4fs' % (r['proc'], r['pc'], r['ir'][:24], r['count'], r['time']))
+
+        lines.append('')
+        lines.append('%-12s %8s %10s %10s %10s' % ('proc', 'calls', 'total', 'self', 'steps'))
+        for r in data['procs']:
+            lines.append('%-12s %8d %9.4fs %9.4fs %10d' % (r['proc'], r['calls'], r['total'], r['self'], r['steps']))
+        return '\n'.join(lines)
+
+def profile_eval(buf: list[Ir], ctx: EvalContext) -> Profiler:
+    prof = Profiler()
+    prof.eval(buf, ctx)
+    return prof
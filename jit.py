@@ -0,0 +1,298 @@
+# ir_eval上的热循环JIT
+# Jit.eval和ir_eval是同一个循环、同一张分派表，只把Jump和Call换掉：
+#   每次往回跳的Jump按(哪段代码, 跳到哪)计数，循环头到这条Jump之间就是一个循环；
+#   计数过了threshold，就把这一段按基本块翻译成一个Python函数，compile()之后以后每次直接调它。
+# 生成的函数进来先做守卫：循环里用到的名字都要在当前帧链上找得到，要写的都得是变量不能是常量，
+# 守卫不过就返回None，这一圈照常回解释器跑，名字找不到、给常量赋值这些错由解释器来报。
+# 过了守卫，变量的那一项[值, 0, dirty]只查一次，循环里直接读写，每次Store都立刻写回去，
+# 中途调过程或者抛异常时ctx里的状态和解释器一模一样；读没初始化的变量、除0报的错也一样。
+# 跳出循环范围时返回目标pc，解释器从那里接着跑。
+# 循环头处栈不是空的、或者循环里有Def*/Halt这种指令的，不编译，一直解释执行。
+import time
+
+from demo2 import IR_DISPATCH, EvalContext, Ir, IrOpCode
+
+_BINARY = {
+    IrOpCode.Add : '%s + %s',
+    IrOpCode.Sub : '%s - %s',
+    IrOpCode.Mul : '%s * %s',
+    IrOpCode.Eq  : '1 if %s == %s else 0',
+    IrOpCode.Ne  : '1 if %s != %s else 0',
+    IrOpCode.Lt  : '1 if %s < %s else 0',
+    IrOpCode.Lte : '1 if %s <= %s else 0',
+    IrOpCode.Gt  : '1 if %s > %s else 0',
+    IrOpCode.Gte : '1 if %s >= %s else 0',
+}
+
+_TRACEABLE = set(_BINARY) | {
+    IrOpCode.Div, IrOpCode.Neg, IrOpCode.Odd, IrOpCode.LoadVar, IrOpCode.LoadLit,
+    IrOpCode.Store, IrOpCode.Jump, IrOpCode.BrFalse, IrOpCode.Call,
+}
+
+def _uninit(name: str):
+    raise RuntimeError('variable %s referenced before initialization' % name)
+
+def _div0():
+    raise RuntimeError('divided by zero')
+
+class JitStats:
+    loops_compiled : int
+    loops_rejected : int
+    entries        : int
+    guard_exits    : int
+    # 'interp'解释执行, 'compiled'跑编译出来的代码, 'compile'生成和编译代码本身
+    time           : dict[str, float]
+
+    def __init__(self):
+        self.loops_compiled = 0
+        self.loops_rejected = 0
+        self.entries = 0
+        self.guard_exits = 0
+        self.time = {'interp': 0.0, 'compiled': 0.0, 'compile': 0.0}
+
+    def report(self) -> str:
+        return '\n'.join([
+            'loops compiled %d, rejected %d' % (self.loops_compiled, self.loops_rejected),
+            'compiled code entered %d times, %d guard exits' % (self.entries, self.guard_exits),
+            'time: interpreter %.4fs, compiled %.4fs, compiling %.4fs'
+                % (self.time['interp'], self.time['compiled'], self.time['compile']),
+        ])
+
+class Jit:
+    threshold : int
+    stats     : JitStats
+    # 键是(id(代码), 循环头)，traces里顺便留着代码本身，免得id被别的list复用
+    counts    : dict[tuple[int, int], int]
+    traces    : dict[tuple[int, int], tuple[list[Ir], object]]
+    buf       : list[Ir] | None
+    dispatch  : list
+    mode      : str
+    since     : float
+
+    def __init__(self, threshold: int = 50):
+        self.threshold = threshold
+        self.stats = JitStats()
+        self.counts = {}
+        self.traces = {}
+        self.buf = None
+        self.dispatch = IR_DISPATCH[:]
+        self.dispatch[IrOpCode.Jump] = self._jump
+        self.dispatch[IrOpCode.Call] = self._call
+        self.mode = 'interp'
+        self.since = time.perf_counter()
+
+    # 切换计时的归属，返回原来的
+    def _switch(self, mode: str) -> str:
+        now = time.perf_counter()
+        self.stats.time[self.mode] += now - self.since
+        prev, self.mode, self.since = self.mode, mode, now
+        return prev
+
+    def eval(self, buf: list[Ir], ctx: EvalContext):
+        saved = self.buf
+        self.buf = buf
+        # 最外层进来时重新开始计时，前面闲着的时间不算
+        if saved is None:
+            self.since = time.perf_counter()
+        try:
+            pc = 0
+            sp = []
+            n = len(buf)
+            dispatch = self.dispatch
+            while pc < n:
+                ir = buf[pc]
+                pc = dispatch[ir.op](ir, sp, ctx, pc + 1)
+        finally:
+            self.buf = saved
+            if saved is None:
+                self._switch(self.mode)
+
+    # 和_ir_call一样，只是被调过程也在这个Jit里跑
+    def _call(self, ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+        found = ctx.lookup_proc(ir.args)
+        if found is None:
+            raise RuntimeError('call procedure before definition')
+        body, owner = found
+        prev = self._switch('interp')
+        try:
+            self.eval(body, EvalContext({}, {}, {}, owner, ctx.out))
+        finally:
+            self._switch(prev)
+        ctx.out.call(ir.args, body)
+        return pc
+
+    def _jump(self, ir: Ir, sp: list, ctx: EvalContext, pc: int) -> int:
+        head = ir.args
+        if head >= pc or sp:
+            return head
+
+        key = (id(self.buf), head)
+        trace = self.traces.get(key)
+        if trace is None:
+            count = self.counts.get(key, 0) + 1
+            self.counts[key] = count
+            if count < self.threshold:
+                return head
+            prev = self._switch('compile')
+            try:
+                trace = self.traces[key] = (self.buf, compile_loop(self.buf, head, pc - 1, self._call))
+            finally:
+                self._switch(prev)
+            if trace[1] is None:
+                self.stats.loops_rejected += 1
+            else:
+                self.stats.loops_compiled += 1
+
+        fn = trace[1]
+        if fn is None:
+            return head
+
+        self.stats.entries += 1
+        prev = self._switch('compiled')
+        try:
+            target = fn(ctx)
+        finally:
+            self._switch(prev)
+        if target is None:
+            self.stats.guard_exits += 1
+            return head
+        return target
+
+def jit_eval(buf: list[Ir], ctx: EvalContext, threshold: int = 50) -> JitStats:
+    jit = Jit(threshold)
+    jit.eval(buf, ctx)
+    return jit.stats
+
+# 把buf[head..end]这个循环(end是往回跳的那条Jump)翻译成Python函数，fn(ctx) -> 出口pc，守卫不过返回None
+# 翻译不了返回None
+def compile_loop(buf: list[Ir], head: int, end: int, call) -> object | None:
+    src = loop_source(buf, head, end)
+    if src is None:
+        return None
+    ns = {'_uninit': _uninit, '_div0': _div0, '_call': call, '_irs': buf}
+    exec(compile(src, '<jit %d-%d>' % (head, end), 'exec'), ns)
+    return ns['_loop']
+
+def loop_source(buf: list[Ir], head: int, end: int) -> str | None:
+    region = range(head, end + 1)
+    if any(buf[i].op not in _TRACEABLE for i in region):
+        return None
+
+    # 基本块的开头：循环头、循环里的跳转目标、每条跳转后面那条
+    leaders = {head}
+    for i in region:
+        if buf[i].op in (IrOpCode.Jump, IrOpCode.BrFalse):
+            if buf[i].args in region:
+                leaders.add(buf[i].args)
+            if i + 1 in region:
+                leaders.add(i + 1)
+    leaders = sorted(leaders)
+
+    names = {}
+    stores = set()
+    for i in region:
+        if buf[i].op in (IrOpCode.LoadVar, IrOpCode.Store):
+            names.setdefault(buf[i].args, 'e%d' % len(names))
+            if buf[i].op == IrOpCode.Store:
+                stores.add(buf[i].args)
+
+    lines = ['def _loop(ctx):']
+    for name, e in names.items():
+        lines.append('    f = ctx.lookup(%r)' % name)
+        if name in stores:
+            lines.append('    if f is None or f[1]: return None')
+        else:
+            lines.append('    if f is None: return None')
+        lines.append('    %s = f[0]' % e)
+
+    lines.append('    pc = %d' % head)
+    lines.append('    while True:')
+    for k, start in enumerate(leaders):
+        stop = leaders[k + 1] if k + 1 < len(leaders) else end + 1
+        body = _block_source(buf, start, stop, region, names)
+        if body is None:
+            return None
+        lines.append('        %s pc == %d:' % ('if' if k == 0 else 'elif', start))
+        lines.extend('            ' + line for line in body)
+    return '\n'.join(lines) + '\n'
+
+def _goto(target: int, region: range) -> str:
+    if target in region:
+        return 'pc = %d; continue' % target
+    return 'return %d' % target
+
+def _lit(v) -> str:
+    return '(%r)' % v if v < 0 else repr(v)
+
+# 一个基本块翻译成直线代码，栈在编译时模拟掉，每个中间结果一个局部变量；块边上栈得是空的
+def _block_source(buf: list[Ir], start: int, stop: int, region: range, names: dict[str, str]) -> list[str] | None:
+    out = []
+    stack = []
+    temps = 0
+
+    def temp() -> str:
+        nonlocal temps
+        temps += 1
+        return 't%d' % temps
+
+    for i in range(start, stop):
+        ir = buf[i]
+        op = ir.op
+        need = 2 if op in _BINARY or op == IrOpCode.Div else 1 if op in (
+            IrOpCode.Neg, IrOpCode.Odd, IrOpCode.Store, IrOpCode.BrFalse) else 0
+        if len(stack) < need:
+            return None
+
+        if op == IrOpCode.LoadLit:
+            if not isinstance(ir.args, int):
+                return None
+            stack.append(_lit(ir.args))
+        elif op == IrOpCode.LoadVar:
+            t = temp()
+            out.append('%s = %s[0]' % (t, names[ir.args]))
+            out.append('if %s is None: _uninit(%r)' % (t, ir.args))
+            stack.append(t)
+        elif op == IrOpCode.Store:
+            e = names[ir.args]
+            out.append('%s[0] = %s' % (e, stack.pop()))
+            out.append('%s[2] = True' % e)
+        elif op in _BINARY:
+            b = stack.pop()
+            a = stack.pop()
+            t = temp()
+            out.append('%s = %s' % (t, _BINARY[op] % (a, b)))
+            stack.append(t)
+        elif op == IrOpCode.Div:
+            b = stack.pop()
+            a = stack.pop()
+            t = temp()
+            out.append('if %s == 0: _div0()' % b)
+            out.append('%s = %s / %s' % (t, a, b))
+            stack.append(t)
+        elif op == IrOpCode.Neg:
+            t = temp()
+            out.append('%s = -%s' % (t, stack.pop()))
+            stack.append(t)
+        elif op == IrOpCode.Odd:
+            t = temp()
+            out.append('%s = %s & 1' % (t, stack.pop()))
+            stack.append(t)
+        elif op == IrOpCode.Call:
+            if stack:
+                return None
+            out.append('_call(_irs[%d], [], ctx, 0)' % i)
+        elif op == IrOpCode.BrFalse:
+            c = stack.pop()
+            if stack:
+                return None
+            out.append('if %s == 0: %s' % (c, _goto(ir.args, region)))
+        elif op == IrOpCode.Jump:
+            if stack:
+                return None
+            out.append(_goto(ir.args, region))
+            return out
+
+    if stack:
+        return None
+    out.append(_goto(stop, region))
+    return out
@@ -0,0 +1,254 @@
+# 一个程序同时跑很多组输入：IrOpCode栈机的NumPy多路版本
+# 每一路(lane)是一组输入，变量里放的不是一个数而是一个长度为lanes的数组，算术和比较都按元素一起算。
+# 控制流按路分开：每一路有自己的pc，每一步挑还没跑完的路里最小的pc，pc等于它的那些路是这一步的active，
+# 只有active的路会被写进变量、被跳转改掉pc。BrFalse/Jump之后各路的pc就分开了，
+# 往回跳的那些路pc小，会先被挑中接着转圈，出了循环的在后面等着，全部出来之后再一起往下走。
+# gen出来的代码在BrFalse/Jump处栈都是空的，所以同一个pc上各路的栈一样深，栈可以共用，
+# 栈上每一项是整宽的数组，不在active里的那几路算出来的是垃圾，不会被写回去。
+# Call让active的路一起进被调过程，被调过程里各路再分开跑，递归深度不一样也没关系。
+#
+# 和ir_eval对照：每一路跑完的主程序变量、报的错和单独用ir_eval跑这一路一样，只是
+#   报错只让出错的那几路停下，别的路接着跑，错误信息记在errors里；
+#   整数是int64，超出范围会回绕，ir_eval是Python的大整数；除法的结果是float64；
+#   ir_eval的Call打印的指令清单是调试输出，这里不打。
+# 值除了数组还带一个flt掩码，记哪几路是除法算出来的小数，这样跑出来的int和float和ir_eval一一对应，
+# 对小数做odd在ir_eval里是TypeError，这里只让那几路出错。
+import numpy as np
+
+from demo2 import Ir, IrOpCode
+
+class LaneContext:
+    # 变量 -> [值, 小数掩码, 赋过值的掩码]
+    vars   : dict[str, list]
+    consts : dict[str, int]
+    procs  : dict[str, list[Ir]]
+    parent : 'LaneContext | None'
+
+    def __init__(self, parent: 'LaneContext | None' = None):
+        self.vars = {}
+        self.consts = {}
+        self.procs = {}
+        self.parent = parent
+
+    # 返回(变量的那一项, 常量的值)，两个里面只有一个不是None；都找不到返回None
+    def lookup(self, key: str) -> tuple[list | None, int | None] | None:
+        ctx = self
+        while ctx is not None:
+            if key in ctx.vars:
+                return ctx.vars[key], None
+            if key in ctx.consts:
+                return None, ctx.consts[key]
+            ctx = ctx.parent
+        return None
+
+    def lookup_proc(self, key: str) -> tuple[list[Ir], 'LaneContext'] | None:
+        ctx = self
+        while ctx is not None:
+            if key in ctx.procs:
+                return ctx.procs[key], ctx
+            ctx = ctx.parent
+        return None
+
+class LaneVM:
+    lanes  : int
+    # 主程序变量的初始值，每个是一个长度为lanes的数组，DefVar的时候放进去
+    init   : dict[str, np.ndarray]
+    # 还没出错的路
+    alive  : np.ndarray
+    errors : list[str | None]
+    main   : LaneContext | None
+
+    def __init__(self, lanes: int, init: dict[str, object] | None = None):
+        self.lanes = lanes
+        self.init = {k: np.broadcast_to(np.asarray(v, dtype = np.int64), (lanes,)) for k, v in (init or {}).items()}
+        self.alive = np.ones(lanes, dtype = bool)
+        self.errors = [None] * lanes
+        self.main = None
+
+    def fail(self, mask: np.ndarray, msg: str):
+        for i in np.flatnonzero(mask & self.alive):
+            self.errors[i] = msg
+        self.alive &= ~mask
+
+    def run(self, buf: list[Ir]) -> LaneContext:
+        self.main = LaneContext()
+        with np.errstate(all = 'ignore'):
+            self.eval(buf, self.main, self.alive.copy())
+        return self.main
+
+    def eval(self, buf: list[Ir], ctx: LaneContext, lanes: np.ndarray):
+        n = len(buf)
+        pcs = np.where(lanes, 0, n)
+        sp = []
+        dispatch = LANE_DISPATCH
+        while True:
+            live = self.alive & (pcs < n)
+            if not live.any():
+                return
+            pc = int(pcs[live].min())
+            active = live & (pcs == pc)
+            ir = buf[pc]
+            pcs = np.where(active, dispatch[ir.op](ir, sp, ctx, active, self, pc + 1), pcs)
+
+    # 第i路跑完的主程序变量，和vm.frame_vars一个样子
+    def lane_vars(self, i: int) -> dict[str, int | float | None]:
+        out = {}
+        for name, (val, flt, isset) in self.main.vars.items():
+            if not isset[i]:
+                out[name] = None
+            elif np.broadcast_to(flt, (self.lanes,))[i]:
+                out[name] = float(np.broadcast_to(val, (self.lanes,))[i])
+            else:
+                out[name] = int(np.broadcast_to(val, (self.lanes,))[i])
+        return out
+
+def run_lanes(buf: list[Ir], lanes: int, init: dict[str, object] | None = None) -> LaneVM:
+    vm = LaneVM(lanes, init)
+    vm.run(buf)
+    return vm
+
+# 处理函数是 (ir, sp, ctx, active, vm, 下一条的pc) -> 下一条的pc，可以是一个数，也可以是每一路一个的数组
+# 栈上每一项是(值, 哪几路是小数)，值和掩码都可以是标量，算的时候自动广播
+def _binary(fn):
+    def handler(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+        b, fb = sp.pop()
+        a, fa = sp.pop()
+        sp.append((fn(a, b), fa | fb))
+        return pc
+    return handler
+
+def _compare(fn):
+    def handler(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+        b, _ = sp.pop()
+        a, _ = sp.pop()
+        sp.append((np.where(fn(a, b), 1, 0), False))
+        return pc
+    return handler
+
+def _lane_div(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    b, _ = sp.pop()
+    a, _ = sp.pop()
+    zero = np.asarray(b) == 0
+    if (active & zero).any():
+        vm.fail(active & zero, 'divided by zero')
+    sp.append((np.true_divide(a, np.where(zero, 1, b)), True))
+    return pc
+
+def _lane_neg(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    v, f = sp.pop()
+    sp.append((np.negative(v), f))
+    return pc
+
+def _lane_odd(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    v, f = sp.pop()
+    bad = active & f
+    if np.any(bad):
+        vm.fail(bad, "unsupported operand type(s) for &: 'float' and 'int'")
+    sp.append((np.bitwise_and(np.asarray(v).astype(np.int64), 1), False))
+    return pc
+
+def _lane_loadvar(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    key = ir.args
+    found = ctx.lookup(key)
+    if found is None:
+        vm.fail(active, 'undefined variable: ' + key)
+        sp.append((0, False))
+        return pc
+    slot, const = found
+    if slot is None:
+        sp.append((const, False))
+        return pc
+    unset = active & ~slot[2]
+    if unset.any():
+        vm.fail(unset, 'variable %s referenced before initialization' % key)
+    sp.append((slot[0], slot[1]))
+    return pc
+
+def _lane_loadlit(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    sp.append((ir.args, False))
+    return pc
+
+def _lane_store(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    v, f = sp.pop()
+    found = ctx.lookup(ir.args)
+    if found is None or found[0] is None:
+        vm.fail(active, 'change before define vars')
+        return pc
+    slot = found[0]
+    slot[0] = np.where(active, v, slot[0])
+    slot[1] = np.where(active, f, slot[1])
+    slot[2] = slot[2] | active
+    return pc
+
+def _lane_jump(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    return ir.args
+
+def _lane_brfalse(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    v, _ = sp.pop()
+    return np.where(np.asarray(v) == 0, ir.args, pc)
+
+def _lane_defvar(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    key = ir.args
+    if key in ctx.vars or key in ctx.consts:
+        vm.fail(active, 'multiply definition :' + key)
+    elif ctx.parent is None and key in vm.init:
+        ctx.vars[key] = [vm.init[key], False, np.ones(vm.lanes, dtype = bool)]
+    else:
+        ctx.vars[key] = [0, False, np.zeros(vm.lanes, dtype = bool)]
+    return pc
+
+def _lane_deflit(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    key = ir.args
+    if key in ctx.vars or key in ctx.consts:
+        vm.fail(active, 'multiply definition :' + key)
+    else:
+        ctx.consts[key] = ir.value
+    return pc
+
+def _lane_defproc(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    ctx.procs[ir.args] = ir.value
+    return pc
+
+def _lane_call(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    found = ctx.lookup_proc(ir.args)
+    if found is None:
+        vm.fail(active, 'call procedure before definition')
+        return pc
+    body, owner = found
+    vm.eval(body, LaneContext(owner), active)
+    return pc
+
+# 返回一个比任何buf都长的pc，这几路就算跑完了
+def _lane_halt(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    return 1 << 62
+
+def _lane_invalid(ir: Ir, sp: list, ctx: LaneContext, active: np.ndarray, vm: LaneVM, pc: int):
+    raise RuntimeError('invalid instruction')
+
+LANE_DISPATCH = [_lane_invalid] * 256
+for _op, _fn in (
+    (IrOpCode.Add,     _binary(np.add)),
+    (IrOpCode.Sub,     _binary(np.subtract)),
+    (IrOpCode.Mul,     _binary(np.multiply)),
+    (IrOpCode.Div,     _lane_div),
+    (IrOpCode.Neg,     _lane_neg),
+    (IrOpCode.Eq,      _compare(np.equal)),
+    (IrOpCode.Ne,      _compare(np.not_equal)),
+    (IrOpCode.Lt,      _compare(np.less)),
+    (IrOpCode.Lte,     _compare(np.less_equal)),
+    (IrOpCode.Gt,      _compare(np.greater)),
+    (IrOpCode.Gte,     _compare(np.greater_equal)),
+    (IrOpCode.Odd,     _lane_odd),
+    (IrOpCode.LoadVar, _lane_loadvar),
+    (IrOpCode.LoadLit, _lane_loadlit),
+    (IrOpCode.Store,   _lane_store),
+    (IrOpCode.Jump,    _lane_jump),
+    (IrOpCode.BrFalse, _lane_brfalse),
+    (IrOpCode.DefVar,  _lane_defvar),
+    (IrOpCode.DefLit,  _lane_deflit),
+    (IrOpCode.DefProc, _lane_defproc),
+    (IrOpCode.Call,    _lane_call),
+    (IrOpCode.Halt,    _lane_halt),
+):
+    LANE_DISPATCH[_op] = _fn
+del _op, _fn
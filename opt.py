@@ -0,0 +1,303 @@
+# 生成之前和之后、执行之前的优化
+# fold_consts在AST上做常量传播，fuse在vm.resolve之后合并超级指令，见文件末尾
+# peephole在Program.gen出来的Ir上做窥孔优化，输出还是同样的Ir，ir_eval和vm.resolve都能直接吃：
+#   常量折叠         LoadLit a; LoadLit b; Add  ->  LoadLit a+b，Neg/Odd一个字面量也直接算掉
+#   代数化简         x*1、x+0、x-0、1*x、0+x、Neg; Neg 都去掉多余的指令
+#   常量条件         LoadLit c; BrFalse t  ->  c是0就是Jump t，不是0就整个去掉
+#   跳转穿线         跳到Jump上的Jump/BrFalse直接跳到最终目标，跳到下一条的Jump去掉
+#   死代码           Jump/Halt后面到下一个跳转目标之前的指令去掉
+# 除法不折叠：结果是小数，除数是0还得留到运行时报错。
+# 被跳转目标打断的指令序列不合并，删掉指令之后所有跳转目标都会重新算。
+from demo2 import (Assign, Begin, Block, Condition, Expression, Factor, If, Ir, IrOpCode, OddCondition,
+                   Procedure, Program, Statement, StdCondition, Term, While)
+
+_FOLD = {
+    IrOpCode.Add : lambda a, b: a + b,
+    IrOpCode.Sub : lambda a, b: a - b,
+    IrOpCode.Mul : lambda a, b: a * b,
+    IrOpCode.Eq  : lambda a, b: 1 if a == b else 0,
+    IrOpCode.Ne  : lambda a, b: 1 if a != b else 0,
+    IrOpCode.Lt  : lambda a, b: 1 if a < b else 0,
+    IrOpCode.Lte : lambda a, b: 1 if a <= b else 0,
+    IrOpCode.Gt  : lambda a, b: 1 if a > b else 0,
+    IrOpCode.Gte : lambda a, b: 1 if a >= b else 0,
+}
+
+# x op 字面量 就等于x的
+_RIGHT_IDENTITY = {
+    IrOpCode.Add : 0,
+    IrOpCode.Sub : 0,
+    IrOpCode.Mul : 1,
+}
+
+# 字面量 op x 就等于x的
+_LEFT_IDENTITY = {
+    IrOpCode.Add : 0,
+    IrOpCode.Mul : 1,
+}
+
+_BRANCHES = (IrOpCode.Jump, IrOpCode.BrFalse)
+
+def peephole(buf: list[Ir]) -> list[Ir]:
+    code = []
+    for ir in buf:
+        if ir.op == IrOpCode.DefProc:
+            code.append(Ir(IrOpCode.DefProc, ir.args, peephole(ir.value)))
+        else:
+            code.append(ir)
+
+    while True:
+        new = _fold(_thread(code))
+        if new == code:
+            return new
+        code = new
+
+def _thread(code: list[Ir]) -> list[Ir]:
+    out = []
+    for ir in code:
+        if ir.op in _BRANCHES:
+            t = ir.args
+            seen = set()
+            while t < len(code) and code[t].op == IrOpCode.Jump and t not in seen:
+                seen.add(t)
+                t = code[t].args
+            ir = Ir(ir.op, t)
+        out.append(ir)
+    return out
+
+def _is_lit(ir: Ir) -> bool:
+    return ir.op == IrOpCode.LoadLit
+
+# 在输出的末尾找能改写的模式，返回(窗口长度, 替换成什么)，没有就是None。
+# 窗口里除了第一条以外都不能是跳转目标，不然从中间跳进来的路径就被改坏了
+def _match(out: list[Ir], lab: list[bool]) -> tuple[int, list[Ir]] | None:
+    n = len(out)
+    if n >= 3 and not lab[-2] and not lab[-1]:
+        a, b, c = out[-3], out[-2], out[-1]
+        if _is_lit(a) and _is_lit(b) and c.op in _FOLD:
+            return 3, [Ir(IrOpCode.LoadLit, _FOLD[c.op](a.args, b.args))]
+        if _is_lit(a) and c.op in _LEFT_IDENTITY and a.args == _LEFT_IDENTITY[c.op] \
+                and b.op in (IrOpCode.LoadLit, IrOpCode.LoadVar):
+            return 3, [b]
+
+    if n >= 2 and not lab[-1]:
+        a, b = out[-2], out[-1]
+        if _is_lit(a):
+            if b.op == IrOpCode.Neg:
+                return 2, [Ir(IrOpCode.LoadLit, -a.args)]
+            if b.op == IrOpCode.Odd:
+                return 2, [Ir(IrOpCode.LoadLit, a.args & 1)]
+            if b.op in _RIGHT_IDENTITY and a.args == _RIGHT_IDENTITY[b.op]:
+                return 2, []
+            if b.op == IrOpCode.BrFalse:
+                return 2, [] if a.args != 0 else [Ir(IrOpCode.Jump, b.args)]
+        if a.op == IrOpCode.Neg and b.op == IrOpCode.Neg:
+            return 2, []
+
+    return None
+
+def _fold(code: list[Ir]) -> list[Ir]:
+    targets = {ir.args for ir in code if ir.op in _BRANCHES}
+    out = []
+    lab = []
+    remap = [0] * (len(code) + 1)
+    # 整个窗口被删掉、而窗口开头又是跳转目标时，目标落到下一条进来的指令上
+    pending = False
+    dead = False
+
+    for i, ir in enumerate(code):
+        remap[i] = len(out)
+        is_label = i in targets or pending
+
+        if dead and not is_label:
+            continue
+        dead = False
+
+        if ir.op == IrOpCode.Jump and ir.args == i + 1:
+            pending = is_label
+            continue
+
+        out.append(ir)
+        lab.append(is_label)
+        pending = False
+
+        m = _match(out, lab)
+        while m is not None:
+            k, rep = m
+            start_label = lab[-k]
+            del out[-k:]
+            del lab[-k:]
+            out.extend(rep)
+            lab.extend([start_label] + [False] * (len(rep) - 1) if rep else [])
+            if not rep and start_label:
+                pending = True
+            m = _match(out, lab)
+
+        if out and out[-1].op in (IrOpCode.Jump, IrOpCode.Halt):
+            dead = True
+
+    remap[len(code)] = len(out)
+
+    # 跳转目标还是老的下标，统一换成新的
+    for j, ir in enumerate(out):
+        if ir.op in _BRANCHES:
+            out[j] = Ir(ir.op, remap[ir.args])
+    return out
+
+
+# AST上的常量传播：const的值在解析完就全知道了，把对常量的引用直接换成字面量，
+# 再把因此变成全是字面量的子表达式算掉，Program.eval和Program.gen都能直接用折叠之后的树。
+# 内层过程里同名的var会挡住外层的const；const声明本身留着，给常量赋值照样在运行时报错。
+# 和peephole一样不折叠除法，也不重新结合(x*2*3不会变成x*6)，只折叠从左边开始连续的字面量。
+def fold_consts(prog: Program) -> Program:
+    return Program(_fold_block(prog.block, {}))
+
+def _fold_block(block: Block, env: dict[str, int]) -> Block:
+    env = dict(env)
+    for const in block.const:
+        env[const.name] = const.value
+    for var in block.vars:
+        env.pop(var.name, None)
+
+    procs = [Procedure(p.name, _fold_block(p.body, env)) for p in block.procs]
+    return Block(block.const, block.vars, procs, _fold_stmt(block.stmt, env))
+
+def _fold_stmt(node, env: dict[str, int]):
+    if isinstance(node, Statement):
+        return Statement(_fold_stmt(node.stmt, env), node.span)
+    elif isinstance(node, Assign):
+        return Assign(node.name, _fold_expr(node.expr, env))
+    elif isinstance(node, Begin):
+        return Begin([_fold_stmt(s, env) for s in node.body])
+    elif isinstance(node, If):
+        return If(_fold_cond(node.cond, env), _fold_stmt(node.then, env))
+    elif isinstance(node, While):
+        return While(_fold_cond(node.cond, env), _fold_stmt(node.do, env))
+    else:
+        return node
+
+def _fold_cond(cond: Condition, env: dict[str, int]) -> Condition:
+    c = cond.cond
+    if isinstance(c, OddCondition):
+        return Condition(OddCondition(_fold_expr(c.expr, env)))
+    return Condition(StdCondition(c.op, _fold_expr(c.lhs, env), _fold_expr(c.rhs, env)))
+
+def _lit(node) -> int | None:
+    if isinstance(node, Factor) and isinstance(node.value, int):
+        return node.value
+    if isinstance(node, Term) and not node.rhs:
+        return _lit(node.lhs)
+    if isinstance(node, Expression) and node.mod in {'', '+'} and not node.rhs:
+        return _lit(node.term)
+    return None
+
+def _fold_factor(fac: Factor, env: dict[str, int]) -> Factor:
+    if isinstance(fac.value, str) and fac.value in env:
+        return Factor(env[fac.value])
+    if isinstance(fac.value, Expression):
+        expr = _fold_expr(fac.value, env)
+        v = _lit(expr)
+        return Factor(expr if v is None else v)
+    return fac
+
+def _fold_term(term, env: dict[str, int]):
+    # Parser.term在碰到'.'时会返回一个Factor
+    if isinstance(term, Factor):
+        return _fold_factor(term, env)
+
+    lhs = _fold_factor(term.lhs, env)
+    rhs = [(op, _fold_factor(f, env)) for op, f in term.rhs]
+    while rhs and rhs[0][0] == '*' and _lit(lhs) is not None and _lit(rhs[0][1]) is not None:
+        lhs = Factor(lhs.value * rhs[0][1].value)
+        rhs = rhs[1:]
+    return Term(lhs, rhs)
+
+def _fold_expr(expr: Expression, env: dict[str, int]) -> Expression:
+    term = _fold_term(expr.term, env)
+    mod = expr.mod
+    v = _lit(term)
+    if v is not None and mod == '-':
+        term, mod = Term(Factor(-v), []), ''
+
+    rhs = [(op, _fold_term(t, env)) for op, t in expr.rhs]
+    v = _lit(term)
+    while rhs and v is not None and mod in {'', '+'} and _lit(rhs[0][1]) is not None:
+        op, t = rhs[0]
+        v = v + _lit(t) if op == '+' else v - _lit(t)
+        term, mod = Term(Factor(v), []), ''
+        rhs = rhs[1:]
+    return Expression(mod, term, rhs)
+
+
+# 超级指令：vm.resolve之后每个过程体里最常见的几种指令序列合并成一条，VM少分派几次。
+#   LoadLocal s; LoadLit k; Add/Sub; StoreLocal s  ->  IncLocal s, ±k      (i := i + 1)
+#   LoadLocal a; LoadLocal b; Add/Sub/Mul          ->  AddLocals a, b 等    (i * i)
+#   Add; StoreLocal s                              ->  AddStoreLocal s     (s := s + ...)
+#   Lt; BrFalse t 等六种比较                        ->  CmpLtBrFalse t 等   (while i < 5 do)
+# 和peephole一样，窗口里除了第一条都不能是跳转目标。外层变量要多带一个层数，列里放不下，不合并。
+_LOCALS_OP = {
+    IrOpCode.Add : IrOpCode.AddLocals,
+    IrOpCode.Sub : IrOpCode.SubLocals,
+    IrOpCode.Mul : IrOpCode.MulLocals,
+}
+
+_CMP_BRFALSE = {
+    IrOpCode.Eq  : IrOpCode.CmpEqBrFalse,
+    IrOpCode.Ne  : IrOpCode.CmpNeBrFalse,
+    IrOpCode.Lt  : IrOpCode.CmpLtBrFalse,
+    IrOpCode.Lte : IrOpCode.CmpLteBrFalse,
+    IrOpCode.Gt  : IrOpCode.CmpGtBrFalse,
+    IrOpCode.Gte : IrOpCode.CmpGteBrFalse,
+}
+
+# IncLocal的步长直接放在CodeObject的vals列里，得是array('i')存得下的
+_INT32 = range(-2 ** 31, 2 ** 31)
+
+def fuse(code: list[Ir]) -> list[Ir]:
+    targets = {ir.args for ir in code if ir.op in _BRANCHES}
+    out = []
+    remap = []
+    i = 0
+    while i < len(code):
+        k, ir = _superinstruction(code, i, targets)
+        remap.extend([len(out)] * k)
+        out.append(ir)
+        i += k
+    remap.append(len(out))
+
+    for j, ir in enumerate(out):
+        if ir.op in _BRANCHES or ir.op in _CMP_BRFALSE.values():
+            out[j] = Ir(ir.op, remap[ir.args])
+    return out
+
+def _window(code: list[Ir], i: int, k: int, targets: set[int]) -> list[Ir] | None:
+    if i + k > len(code) or any(j in targets for j in range(i + 1, i + k)):
+        return None
+    return code[i:i + k]
+
+# 从code[i]开始能合并就返回(吃掉几条, 超级指令)，不能就原样返回(1, code[i])
+def _superinstruction(code: list[Ir], i: int, targets: set[int]) -> tuple[int, Ir]:
+    w = _window(code, i, 4, targets)
+    if w is not None:
+        a, b, c, d = w
+        if a.op == IrOpCode.LoadLocal and b.op == IrOpCode.LoadLit and isinstance(b.args, int) \
+                and c.op in (IrOpCode.Add, IrOpCode.Sub) and d.op == IrOpCode.StoreLocal and d.args == a.args:
+            step = b.args if c.op == IrOpCode.Add else -b.args
+            if step in _INT32:
+                return 4, Ir(IrOpCode.IncLocal, a.args, step)
+
+    w = _window(code, i, 3, targets)
+    if w is not None:
+        a, b, c = w
+        if a.op == IrOpCode.LoadLocal and b.op == IrOpCode.LoadLocal and c.op in _LOCALS_OP:
+            return 3, Ir(_LOCALS_OP[c.op], a.args, b.args)
+
+    w = _window(code, i, 2, targets)
+    if w is not None:
+        a, b = w
+        if a.op == IrOpCode.Add and b.op == IrOpCode.StoreLocal:
+            return 2, Ir(IrOpCode.AddStoreLocal, b.args)
+        if a.op in _CMP_BRFALSE and b.op == IrOpCode.BrFalse:
+            return 2, Ir(_CMP_BRFALSE[a.op], b.args)
+
+    return 1, code[i]
@@ -0,0 +1,511 @@
+# 寄存器虚拟机和三地址IR，和栈式的IrOpCode并列的另一条路
+# 栈机器每条算术指令都是两次sp.pop()加一次sp.append()，纯粹在倒腾栈。
+# 这里直接从AST生成三地址码 RegIr(op, d, a, b)：d、a、b都是当前帧里的寄存器号，
+# 帧就是一个list，寄存器分配很简单：
+#   frame[0]        这个RegProc自己，报错时拿变量名
+#   1..变量个数     PL/0的变量，赋值直接写进去，读变量不用任何指令
+#   后面            常量寄存器，每个用到的字面量一个，新帧从proc.template拷出来时就已经填好了
+#   再后面          临时寄存器，按表达式的嵌套深度分配，用完就还
+# 所以所有操作数都是寄存器，处理函数不用分辨是立即数还是变量。
+# 外层变量和vm.VM一样走display：LoadOuter d, 槽位, 层数 / StoreOuter 槽位, 源寄存器, 层数。
+# 名字错误和vm.resolve一样在编译时就报，报的话和ir_eval一样；
+# 读没初始化的变量在运行时报同样的错，只是同一个表达式里有好几处出错时，先报哪一处可能和栈机器不一样。
+from enum import IntEnum
+from typing import NamedTuple
+
+from demo2 import (HALT_PC, Assign, Begin, Block, Call, Condition, Expression, Factor, If, OddCondition,
+                   Parser, Program, Statement, Term, TokenStream, While, tokenize)
+from vm import Scope
+
+class RegOp(IntEnum):
+    Move       = 0   # d = a
+    Add        = 1   # d = a + b
+    Sub        = 2
+    Mul        = 3
+    Div        = 4
+    Neg        = 5   # d = -a
+    Odd        = 6   # d = a & 1
+    Eq         = 7   # d = 1 if a == b else 0
+    Ne         = 8
+    Lt         = 9
+    Lte        = 10
+    Gt         = 11
+    Gte        = 12
+    LoadOuter  = 13  # d = display[b][a]
+    StoreOuter = 14  # display[b][d] = a
+    Jump       = 15  # goto d
+    BrFalse    = 16  # if a == 0 goto d
+    Call       = 17  # 调过程a，入口是d
+    Ret        = 18
+    Halt       = 19
+
+class RegIr(NamedTuple):
+    op : RegOp
+    d  : int = 0
+    a  : int = 0
+    b  : int = 0
+
+class RegProc(NamedTuple):
+    name     : str
+    level    : int
+    names    : list[str]
+    template : list
+    code     : list[RegIr]
+
+_ARITH = {
+    '+' : RegOp.Add,
+    '-' : RegOp.Sub,
+    '*' : RegOp.Mul,
+    '/' : RegOp.Div,
+}
+
+_CMP = {
+    '='  : RegOp.Eq,
+    '#'  : RegOp.Ne,
+    '<'  : RegOp.Lt,
+    '<=' : RegOp.Lte,
+    '>'  : RegOp.Gt,
+    '>=' : RegOp.Gte,
+}
+
+# 一个块(主程序或者一个过程)的代码生成状态
+class _Builder:
+    scope  : Scope
+    names  : list[str]
+    consts : dict[int, int]
+    code   : list[RegIr]
+    temp   : int
+    nregs  : int
+
+    def __init__(self, scope: Scope, names: list[str]):
+        self.scope = scope
+        self.names = names
+        self.consts = {}
+        self.code = []
+        self.temp = 0
+        self.nregs = 0
+
+    def emit(self, op: RegOp, d: int = 0, a: int = 0, b: int = 0) -> int:
+        self.code.append(RegIr(op, d, a, b))
+        return len(self.code) - 1
+
+    def const(self, value: int) -> int:
+        # 常量寄存器先记个负的编号，块编完知道变量和常量各有多少以后再统一换成真的
+        reg = self.consts.get(value)
+        if reg is None:
+            reg = self.consts[value] = -1 - len(self.consts)
+        return reg
+
+    # 临时寄存器也先用负的一段编号，和常量分开
+    def alloc(self) -> int:
+        self.temp += 1
+        self.nregs = max(self.nregs, self.temp)
+        return _TEMP_BASE - self.temp
+
+    def free(self, reg: int):
+        if self.is_temp(reg):
+            self.temp -= 1
+
+    def is_temp(self, reg: int) -> bool:
+        return reg <= _TEMP_BASE - 1
+
+_TEMP_BASE = -(1 << 20)
+
+def compile_program(src: str) -> 'RegImage':
+    return compile_ast(Parser(TokenStream(buf = tokenize(src))).program())
+
+def compile_ast(prog: Program) -> 'RegImage':
+    procs = [None]
+    _compile_block('', prog.block, None, 0, 0, procs)
+    return link(procs)
+
+def _compile_block(name: str, block: Block, parent: Scope | None, level: int, index: int, procs: list):
+    scope = Scope(parent, level, {}, {})
+    names = [name]
+    for const in block.const:
+        if const.name in scope.syms:
+            raise RuntimeError('multiply definition :' + const.name)
+        scope.syms[const.name] = ('const', const.value)
+    for var in block.vars:
+        if var.name in scope.syms:
+            raise RuntimeError('multiply definition :' + var.name)
+        scope.syms[var.name] = ('var', len(names))
+        names.append(var.name)
+
+    bodies = []
+    for proc in block.procs:
+        scope.procs[proc.name] = len(procs)
+        bodies.append((proc.name, proc.body, len(procs)))
+        procs.append(None)
+    for pname, pbody, pindex in bodies:
+        _compile_block(pname, pbody, scope, level + 1, pindex, procs)
+
+    b = _Builder(scope, names)
+    _stmt(b, block.stmt)
+
+    # 定下寄存器布局：变量、常量、临时
+    nconst = len(b.consts)
+    template = [None] * (len(names) + nconst + b.nregs)
+    for value, reg in b.consts.items():
+        template[len(names) - 1 - reg] = value
+
+    def place(reg: int) -> int:
+        if reg <= _TEMP_BASE - 1:
+            return len(names) + nconst + (_TEMP_BASE - 1 - reg)
+        if reg < 0:
+            return len(names) - 1 - reg
+        return reg
+
+    code = []
+    for ir in b.code:
+        if ir.op in _JUMPS:
+            code.append(RegIr(ir.op, ir.d, place(ir.a), ir.b))
+        elif ir.op == RegOp.Call:
+            code.append(ir)
+        elif ir.op == RegOp.LoadOuter:
+            code.append(RegIr(ir.op, place(ir.d), ir.a, ir.b))
+        elif ir.op == RegOp.StoreOuter:
+            code.append(RegIr(ir.op, ir.d, place(ir.a), ir.b))
+        else:
+            code.append(RegIr(ir.op, place(ir.d), place(ir.a), place(ir.b)))
+
+    proc = RegProc(name, level, names, template, code)
+    template[0] = proc
+    procs[index] = proc
+
+_JUMPS = (RegOp.Jump, RegOp.BrFalse)
+
+def _stmt(b: _Builder, node):
+    if isinstance(node, Statement):
+        _stmt(b, node.stmt)
+
+    elif isinstance(node, Assign):
+        reg = _expr(b, node.expr)
+        sym = b.scope.lookup(node.name)
+        if sym is None or sym[1] == 'const': # 这里默认常量不可修改
+            raise RuntimeError('change before define vars')
+        lvl, _, slot = sym
+        if lvl != b.scope.level:
+            b.emit(RegOp.StoreOuter, slot, reg, lvl)
+        elif b.is_temp(reg) and b.code and b.code[-1].d == reg and b.code[-1].op not in _JUMPS:
+            # 表达式最后一条直接写进变量，省一条Move
+            last = b.code[-1]
+            b.code[-1] = RegIr(last.op, slot, last.a, last.b)
+        else:
+            b.emit(RegOp.Move, slot, reg)
+        b.free(reg)
+
+    elif isinstance(node, Call):
+        target = b.scope.lookup_proc(node.name)
+        if target is None:
+            raise RuntimeError('call procedure before definition')
+        b.emit(RegOp.Call, 0, target)
+
+    elif isinstance(node, Begin):
+        for stmt in node.body:
+            _stmt(b, stmt)
+
+    elif isinstance(node, If):
+        br = _cond_branch(b, node.cond)
+        _stmt(b, node.then)
+        b.code[br] = b.code[br]._replace(d = len(b.code))
+
+    elif isinstance(node, While):
+        head = len(b.code)
+        br = _cond_branch(b, node.cond)
+        _stmt(b, node.do)
+        b.emit(RegOp.Jump, head)
+        b.code[br] = b.code[br]._replace(d = len(b.code))
+
+    else:
+        raise RuntimeError('invalid statement')
+
+# 算条件，发一条目标待填的BrFalse，返回它的下标
+def _cond_branch(b: _Builder, node: Condition) -> int:
+    cond = node.cond
+    if isinstance(cond, OddCondition):
+        reg = _expr(b, cond.expr)
+        b.free(reg)
+        t = b.alloc()
+        b.emit(RegOp.Odd, t, reg)
+    else:
+        if cond.op not in _CMP:
+            raise RuntimeError('invalid op type (%s)' % cond.op)
+        lhs = _expr(b, cond.lhs)
+        rhs = _expr(b, cond.rhs)
+        b.free(rhs)
+        b.free(lhs)
+        t = b.alloc()
+        b.emit(_CMP[cond.op], t, lhs, rhs)
+    b.free(t)
+    return b.emit(RegOp.BrFalse, 0, t)
+
+def _binary(b: _Builder, op: RegOp, lhs: int, rhs: int) -> int:
+    b.free(rhs)
+    b.free(lhs)
+    t = b.alloc()
+    b.emit(op, t, lhs, rhs)
+    return t
+
+def _expr(b: _Builder, node: Expression) -> int:
+    reg = _term(b, node.term)
+    if node.mod == '-':
+        b.free(reg)
+        t = b.alloc()
+        b.emit(RegOp.Neg, t, reg)
+        reg = t
+    elif node.mod not in {'', '+'}:
+        raise RuntimeError('invalid expression sign')
+
+    for op, rhs in node.rhs:
+        if op not in {'+', '-'}:
+            raise RuntimeError('invalid expression operator')
+        reg = _binary(b, _ARITH[op], reg, _term(b, rhs))
+    return reg
+
+def _term(b: _Builder, node: Term) -> int:
+    # Parser.term在碰到'.'时会返回一个Factor
+    if isinstance(node, Factor):
+        return _factor(b, node)
+
+    reg = _factor(b, node.lhs)
+    for op, rhs in node.rhs:
+        if op not in {'*', '/'}:
+            raise RuntimeError('invalid expression operator')
+        reg = _binary(b, _ARITH[op], reg, _factor(b, rhs))
+    return reg
+
+def _factor(b: _Builder, node: Factor) -> int:
+    value = node.value
+    if isinstance(value, int):
+        return b.const(value)
+
+    elif isinstance(value, str):
+        sym = b.scope.lookup(value)
+        if sym is None:
+            raise RuntimeError('undefined variable: ' + value)
+        lvl, kind, val = sym
+        if kind == 'const':
+            return b.const(val)
+        if lvl == b.scope.level:
+            return val
+        t = b.alloc()
+        b.emit(RegOp.LoadOuter, t, val, lvl)
+        return t
+
+    elif isinstance(value, Expression):
+        return _expr(b, value)
+
+    else:
+        raise RuntimeError('invalid factor value')
+
+
+# 链接和vm.link一样：主程序在前以Halt结尾，过程体依次摆在后面以Ret结尾
+class RegImage(NamedTuple):
+    code  : list[RegIr]
+    procs : list[RegProc]
+
+def link(procs: list[RegProc]) -> RegImage:
+    entry = []
+    size = 0
+    for proc in procs:
+        entry.append(size)
+        size += len(proc.code) + 1
+
+    code = []
+    for i, proc in enumerate(procs):
+        base = len(code)
+        for ir in proc.code:
+            if ir.op in _JUMPS:
+                code.append(ir._replace(d = base + ir.d))
+            elif ir.op == RegOp.Call:
+                code.append(ir._replace(d = entry[ir.a]))
+            else:
+                code.append(ir)
+        code.append(RegIr(RegOp.Halt if i == 0 else RegOp.Ret))
+    return RegImage(code, procs)
+
+
+def _uninit(frame: list, reg: int):
+    raise RuntimeError('variable %s referenced before initialization' % frame[0].names[reg])
+
+# 变量寄存器还是None的话，算术和大小比较自己就会抛TypeError，RegVM.run里再翻译成未初始化的错；
+# Move、==、#、除法碰上None不会出错，只能自己查
+class RegVM:
+    __slots__ = ('code', 'procs', 'display', 'frame', 'rets')
+
+    code    : list[RegIr]
+    procs   : list[RegProc]
+    display : list[list | None]
+    frame   : list
+    rets    : list[tuple[int, list, list | None]]
+
+    def __init__(self, image: RegImage):
+        self.code = image.code
+        self.procs = image.procs
+        self.display = [None] * (max(p.level for p in image.procs) + 1)
+        self.frame = None
+        self.rets = []
+
+    def run(self) -> list:
+        main = self.procs[0]
+        frame = main.template[:]
+        self.display[0] = frame
+        self.frame = frame
+
+        code = self.code
+        n = len(code)
+        dispatch = REG_DISPATCH
+        pc = 0
+        try:
+            while pc < n:
+                op, d, a, b = code[pc]
+                pc = dispatch[op](self.frame, d, a, b, self, pc + 1)
+        except TypeError:
+            op, d, a, b = code[pc]
+            f = self.frame
+            if op not in (RegOp.LoadOuter, RegOp.StoreOuter, RegOp.Call):
+                for reg in (a, b):
+                    if 0 < reg < len(f[0].names) and f[reg] is None:
+                        _uninit(f, reg)
+            raise
+        return frame
+
+def _r_move(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    v = f[a]
+    if v is None:
+        _uninit(f, a)
+    f[d] = v
+    return pc
+
+def _r_add(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    f[d] = f[a] + f[b]
+    return pc
+
+def _r_sub(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    f[d] = f[a] - f[b]
+    return pc
+
+def _r_mul(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    f[d] = f[a] * f[b]
+    return pc
+
+def _r_div(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    v1 = f[a]
+    v2 = f[b]
+    if v1 is None:
+        _uninit(f, a)
+    if v2 is None:
+        _uninit(f, b)
+    if v2 == 0:
+        raise RuntimeError('divided by zero')
+    f[d] = v1 / v2
+    return pc
+
+def _r_neg(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    f[d] = -f[a]
+    return pc
+
+def _r_odd(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    f[d] = f[a] & 1
+    return pc
+
+def _r_eq(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    v1 = f[a]
+    v2 = f[b]
+    if v1 is None:
+        _uninit(f, a)
+    if v2 is None:
+        _uninit(f, b)
+    f[d] = 1 if v1 == v2 else 0
+    return pc
+
+def _r_ne(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    v1 = f[a]
+    v2 = f[b]
+    if v1 is None:
+        _uninit(f, a)
+    if v2 is None:
+        _uninit(f, b)
+    f[d] = 1 if v1 != v2 else 0
+    return pc
+
+def _r_lt(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    f[d] = 1 if f[a] < f[b] else 0
+    return pc
+
+def _r_lte(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    f[d] = 1 if f[a] <= f[b] else 0
+    return pc
+
+def _r_gt(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    f[d] = 1 if f[a] > f[b] else 0
+    return pc
+
+def _r_gte(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    f[d] = 1 if f[a] >= f[b] else 0
+    return pc
+
+def _r_loadouter(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    frame = vm.display[b]
+    v = frame[a]
+    if v is None:
+        _uninit(frame, a)
+    f[d] = v
+    return pc
+
+def _r_storeouter(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    v = f[a]
+    if v is None:
+        _uninit(f, a)
+    vm.display[b][d] = v
+    return pc
+
+def _r_jump(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    return d
+
+def _r_brfalse(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    if f[a] == 0:
+        return d
+    return pc
+
+def _r_call(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    proc = vm.procs[a]
+    frame = proc.template[:]
+    vm.rets.append((pc, f, vm.display[proc.level]))
+    vm.display[proc.level] = frame
+    vm.frame = frame
+    return d
+
+def _r_ret(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    pc, vm.frame, vm.display[f[0].level] = vm.rets.pop()
+    return pc
+
+def _r_halt(f: list, d: int, a: int, b: int, vm: RegVM, pc: int) -> int:
+    return HALT_PC
+
+REG_DISPATCH = [None] * len(RegOp)
+for _op, _fn in (
+    (RegOp.Move,       _r_move),
+    (RegOp.Add,        _r_add),
+    (RegOp.Sub,        _r_sub),
+    (RegOp.Mul,        _r_mul),
+    (RegOp.Div,        _r_div),
+    (RegOp.Neg,        _r_neg),
+    (RegOp.Odd,        _r_odd),
+    (RegOp.Eq,         _r_eq),
+    (RegOp.Ne,         _r_ne),
+    (RegOp.Lt,         _r_lt),
+    (RegOp.Lte,        _r_lte),
+    (RegOp.Gt,         _r_gt),
+    (RegOp.Gte,        _r_gte),
+    (RegOp.LoadOuter,  _r_loadouter),
+    (RegOp.StoreOuter, _r_storeouter),
+    (RegOp.Jump,       _r_jump),
+    (RegOp.BrFalse,    _r_brfalse),
+    (RegOp.Call,       _r_call),
+    (RegOp.Ret,        _r_ret),
+    (RegOp.Halt,       _r_halt),
+):
+    REG_DISPATCH[_op] = _fn
+del _op, _fn
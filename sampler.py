@@ -0,0 +1,83 @@
+# ir_eval的采样剖析，结果对回PL/0源码的行
+# 解释器一行不改，也不换插桩的循环：setitimer(ITIMER_PROF)每隔interval秒CPU时间发一次SIGPROF，
+# 信号处理函数拿到当前的Python帧，往外找最内层的ir_eval帧，直接读它的局部变量buf和pc，
+# 再按gen产出的SpanTable找到这条指令是哪条语句生成的，算在那条语句开头的那一行上。
+# Python只在主线程、字节码之间处理信号，开销只和采样次数有关，和执行了多少条指令无关。
+# 要有SIGPROF，只能在Unix上用。
+import signal
+
+from demo2 import EvalContext, Ir, LineTable, Parser, SpanTable, TokenStream, ir_eval, tokenize
+
+_IR_EVAL = ir_eval.__code__
+
+# 编译的同时记下位置：返回指令、pc -> 源码区间表、行表
+def compile_source(src: str) -> tuple[list[Ir], SpanTable, LineTable]:
+    offs = []
+    prog = Parser(TokenStream(buf = tokenize(src, offs), offs = offs)).program()
+    buf = []
+    spans = SpanTable()
+    prog.gen(buf, spans)
+    return buf, spans, LineTable(src)
+
+class Sampler:
+    spans    : SpanTable
+    lines    : LineTable
+    interval : float
+    # 行号 -> 采样数；0是对不上源码的：定义、Halt这种没有语句的指令，或者采样时根本不在ir_eval里
+    counts   : dict[int, int]
+    samples  : int
+    prev     : object
+
+    def __init__(self, spans: SpanTable, lines: LineTable, interval: float = 0.001):
+        self.spans = spans
+        self.lines = lines
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self.prev = None
+
+    def _sample(self, signum, frame):
+        self.samples += 1
+        while frame is not None and frame.f_code is not _IR_EVAL:
+            frame = frame.f_back
+        line = 0
+        if frame is not None:
+            local = frame.f_locals
+            buf = local['buf']
+            # 分派的时候pc还是当前这条，两条之间是下一条，越过末尾的算最后一条
+            pc = min(local['pc'], len(buf) - 1)
+            span = self.spans.lookup(buf, pc)
+            if span is not None:
+                line = self.lines.locate(span[0])[0]
+        self.counts[line] = self.counts.get(line, 0) + 1
+
+    def start(self):
+        self.prev = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.prev)
+
+    def __enter__(self) -> 'Sampler':
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # 按采样数从多到少，每行带上源码
+    def report(self, src: str, limit: int = 10) -> str:
+        text = src.split('\n')
+        total = self.samples or 1
+        out = ['%6s %8s %6s  %s' % ('line', 'samples', '%', 'source')]
+        for line, n in sorted(self.counts.items(), key = lambda kv: -kv[1])[:limit]:
+            source = text[line - 1].strip() if line else '<no source>'
+            out.append('%6s %8d %5.1f%%  %s' % (line or '-', n, 100 * n / total, source))
+        return '\n'.join(out)
+
+def sample_eval(src: str, interval: float = 0.001) -> Sampler:
+    buf, spans, lines = compile_source(src)
+    with Sampler(spans, lines, interval) as sampler:
+        ir_eval(buf, EvalContext({}, {}, {}))
+    return sampler
@@ -0,0 +1,174 @@
+# 跑到一半的程序存成快照，以后(换个进程也行)从快照接着跑
+# 存的是aiovm.ResumableEval片和片之间的状态：帧栈(每帧的代码、pc、操作数栈、ctx)、
+# 从帧能走到的所有EvalContext(变量、常量、过程表、静态链)，还有已经执行的指令数。
+# 代码本身不存，只存它在CodeTable里的编号，恢复时拿同一个程序编出来的buf重新建CodeTable对上号，
+# 头里记着代码的摘要，对不上就拒绝恢复。所以快照的大小和花的时间只跟活着的状态有关，和程序多长无关。
+# ctx.out不存，恢复时另给。
+#
+# 格式(全部小端，整数和名字的编码和cache一样)：
+#   头      magic 'PL0S', 版本号 u16, 保留 u16, 代码的sha256 32字节, 已执行指令数 u64
+#   ctx表   u32个数, 每个是 父ctx的下标+1(0是没有) u32,
+#           变量 u32个数 + (名字, 值, dirty u8), 常量 u32个数 + (名字, 值), 过程 u32个数 + (名字, 代码编号 u32)
+#   帧栈    u32个数, 每个是 代码编号 u32, pc u32, ctx下标 u32, 过程名(主程序是空串), 操作数栈 u32个数 + 值
+#   值      tag u8：0是None, 1是整数(同cache), 2是小数(f64)
+import hashlib
+import os
+import struct
+from typing import Callable
+
+from aiovm import Frame, ResumableEval
+from cache import U32, Reader, put_int, put_str
+from demo2 import STDOUT, EvalContext, Ir, IrOpCode, Sink
+
+SNAPSHOT_MAGIC = b'PL0S'
+SNAPSHOT_VERSION = 1
+
+_HEADER = struct.Struct('<4sHH32sQ')
+_F64 = struct.Struct('<d')
+
+# 一个程序的所有代码段编上号：主程序是0，过程体按DefProc在代码里出现的先后
+class CodeTable:
+    codes  : list[list[Ir]]
+    index  : dict[int, int]
+    digest : bytes
+
+    def __init__(self, buf: list[Ir]):
+        self.codes = []
+        self.index = {}
+        h = hashlib.sha256()
+        todo = [buf]
+        while todo:
+            code = todo.pop(0)
+            self.index[id(code)] = len(self.codes)
+            self.codes.append(code)
+            for ir in code:
+                # 过程体单独成段，DefProc这一条只记名字
+                if ir.op == IrOpCode.DefProc:
+                    h.update(repr((ir.op, ir.args)).encode('utf-8'))
+                    todo.append(ir.value)
+                else:
+                    h.update(repr(ir).encode('utf-8'))
+            h.update(b'\0')
+        self.digest = h.digest()
+
+def _put_value(out: list[bytes], v):
+    if v is None:
+        out.append(b'\0')
+    elif isinstance(v, int):
+        out.append(b'\1')
+        put_int(out, v)
+    elif isinstance(v, float):
+        out.append(b'\2')
+        out.append(_F64.pack(v))
+    else:
+        raise RuntimeError('cannot snapshot value %r' % (v,))
+
+def _get_value(rd: Reader):
+    tag = rd.take(1)
+    if tag == b'\0':
+        return None
+    if tag == b'\1':
+        return rd.integer()
+    if tag == b'\2':
+        return _F64.unpack(rd.take(8))[0]
+    raise ValueError('bad value tag in snapshot')
+
+def dump_snapshot(r: ResumableEval, table: CodeTable) -> bytes:
+    # 从帧出发顺着静态链把ctx收齐，父ctx排在前面
+    ctxs = []
+    seen = {}
+
+    def visit(ctx: EvalContext) -> int:
+        if id(ctx) not in seen:
+            parent = visit(ctx.parent) + 1 if ctx.parent is not None else 0
+            seen[id(ctx)] = len(ctxs)
+            ctxs.append((ctx, parent))
+        return seen[id(ctx)]
+
+    visit(r.ctx)
+    frames = [(f, visit(f.ctx)) for f in r.frames]
+
+    out = [_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, table.digest, r.steps)]
+    out.append(U32.pack(len(ctxs)))
+    for ctx, parent in ctxs:
+        out.append(U32.pack(parent))
+        out.append(U32.pack(len(ctx.vars)))
+        for name, (v, _, dirty) in ctx.vars.items():
+            put_str(out, name)
+            _put_value(out, v)
+            out.append(b'\1' if dirty else b'\0')
+        out.append(U32.pack(len(ctx.consts)))
+        for name, (v, _, _) in ctx.consts.items():
+            put_str(out, name)
+            _put_value(out, v)
+        out.append(U32.pack(len(ctx.procs)))
+        for name, body in ctx.procs.items():
+            put_str(out, name)
+            out.append(U32.pack(table.index[id(body)]))
+
+    out.append(U32.pack(len(frames)))
+    for f, ci in frames:
+        out.append(U32.pack(table.index[id(f.buf)]))
+        out.append(U32.pack(f.pc))
+        out.append(U32.pack(ci))
+        put_str(out, f.name or '')
+        out.append(U32.pack(len(f.sp)))
+        for v in f.sp:
+            _put_value(out, v)
+    return b''.join(out)
+
+# 代码对不上、格式不对都抛ValueError
+def load_snapshot(data: bytes, table: CodeTable, out: Sink = STDOUT) -> ResumableEval:
+    if len(data) < _HEADER.size:
+        raise ValueError('truncated snapshot')
+    magic, version, _, digest, steps = _HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError('not a snapshot of this version')
+    if digest != table.digest:
+        raise ValueError('snapshot was taken from a different program')
+
+    rd = Reader(data, _HEADER.size)
+    ctxs = []
+    for _ in range(rd.u32()):
+        parent = rd.u32()
+        ctx = EvalContext({}, {}, {}, ctxs[parent - 1] if parent else None, out)
+        for _ in range(rd.u32()):
+            name = rd.text()
+            v = _get_value(rd)
+            ctx.vars[name] = [v, 0, rd.take(1) == b'\1']
+        for _ in range(rd.u32()):
+            name = rd.text()
+            ctx.consts[name] = [_get_value(rd), 0, False]
+        for _ in range(rd.u32()):
+            name = rd.text()
+            ctx.procs[name] = table.codes[rd.u32()]
+        ctxs.append(ctx)
+
+    r = ResumableEval(table.codes[0], ctxs[0])
+    r.frames = []
+    for _ in range(rd.u32()):
+        code = table.codes[rd.u32()]
+        pc = rd.u32()
+        f = Frame(code, ctxs[rd.u32()], rd.text() or None)
+        f.pc = pc
+        f.sp = [_get_value(rd) for _ in range(rd.u32())]
+        r.frames.append(f)
+    r.steps = steps
+    return r
+
+# 先写临时文件再改名，进程在写的时候被杀掉，上一个快照还是好的
+def write_snapshot(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+# 每跑every条指令存一次快照，交给save；跑完返回主程序的ctx
+def run_checkpointed(r: ResumableEval, table: CodeTable, every: int,
+                     save: Callable[[bytes], None]) -> EvalContext:
+    while not r.done:
+        r.step(every)
+        if not r.done:
+            save(dump_snapshot(r, table))
+    return r.ctx
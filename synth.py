@@ -0,0 +1,217 @@
+# 造PL/0程序的生成器，给伸缩性测试用
+# 同一个seed和同一组Knobs一定生成同一份源码。生成的程序不光能过Parser，还一定能跑完、不报错：
+#   每个块一进来先把自己的变量和循环计数器都赋上值，不会读到没初始化的变量；
+#   循环都是 c := 0; while c < 次数 do begin ...; c := c + 1 end，计数器别处不写，
+#     每个块用自己的计数器，调过程不会把外面循环的计数器改掉；
+#   过程只调自己的子过程和排在自己前面的兄弟过程，调用图没有环，不会无限递归；
+#     每个子过程至少在外层不在if里的地方被调一次，过程都会跑到；
+#   一条表达式里最多出现一个普通变量而且系数是±1，数值只会线性增长，不会越算越大；
+#   每个块边生成边估算一次调用会执行多少条语句(循环乘圈数，调用加上被调过程的)，
+#     超过size*work就把循环圈数减半、调用换成赋值，跑一遍执行的语句数和size成正比；
+#   除数都是不为0的字面量或者常量，odd只用在计数器上(除法会算出小数，小数不能odd)。
+import random
+from typing import NamedTuple
+
+class Knobs(NamedTuple):
+    size  : int = 200   # 全程序大概多少条语句
+    depth : int = 3     # 语句最多嵌套几层，过程最多也嵌套这么多层
+    procs : int = 5     # 过程个数
+    width : int = 4     # 表达式顶层有几项
+    trips : int = 10    # 每个循环最多转几圈
+    work  : int = 50    # 跑一遍执行的语句数最多是size的几倍
+
+# 生成时的一个块：names都是全程序唯一的，不用管遮蔽
+class _Block:
+    bid      : int
+    level    : int
+    parent   : '_Block | None'
+    children : list['_Block']
+    consts   : list[tuple[str, int]]
+    vars     : list[str]
+    counters : list[str]
+    budget   : int
+    # 调一次这个块估计会执行多少条语句
+    cost     : int
+    called   : set[str]
+
+    def __init__(self, bid: int, level: int, parent: '_Block | None'):
+        self.bid = bid
+        self.level = level
+        self.parent = parent
+        self.children = []
+        self.consts = []
+        self.vars = []
+        self.counters = []
+        self.budget = 1
+        self.cost = 0
+        self.called = set()
+
+    @property
+    def name(self) -> str:
+        return 'p%d' % self.bid
+
+    # 从这个块里看得见的东西，自己的在前
+    def visible(self, attr: str) -> list:
+        out = []
+        blk = self
+        while blk is not None:
+            out.extend(getattr(blk, attr))
+            blk = blk.parent
+        return out
+
+    # 能调的过程：自己的子过程，加上排在自己前面的兄弟过程
+    def callable(self) -> list['_Block']:
+        out = list(self.children)
+        if self.parent is not None:
+            for sib in self.parent.children:
+                if sib is self:
+                    break
+                out.append(sib)
+        return out
+
+class _Gen:
+    rnd   : random.Random
+    knobs : Knobs
+    work  : int
+
+    def __init__(self, seed: int, knobs: Knobs):
+        self.rnd = random.Random(seed)
+        self.knobs = knobs
+        self.work = max(1, knobs.size * knobs.work)
+
+    def program(self) -> str:
+        k = self.knobs
+        main = _Block(0, 0, None)
+        blocks = [main]
+        for bid in range(1, k.procs + 1):
+            parent = self.rnd.choice([b for b in blocks if b.level < k.depth])
+            blk = _Block(bid, parent.level + 1, parent)
+            parent.children.append(blk)
+            blocks.append(blk)
+
+        # 语句预算：主程序多拿一点，剩下的随机分给各个过程
+        share = max(1, k.size // (k.procs + 2))
+        main.budget = max(1, k.size - share * k.procs)
+        for blk in blocks[1:]:
+            blk.budget = max(1, share + self.rnd.randint(-share // 2, share // 2))
+
+        for blk in blocks:
+            for j in range(self.rnd.randint(0, 2)):
+                blk.consts.append(('k%d_%d' % (blk.bid, j), self.rnd.randint(1, 9)))
+            for j in range(self.rnd.randint(2, 4)):
+                blk.vars.append('v%d_%d' % (blk.bid, j))
+            for j in range(k.depth):
+                blk.counters.append('c%d_%d' % (blk.bid, j))
+
+        return self.block(main, '') + '.\n'
+
+    def block(self, blk: _Block, ind: str) -> str:
+        out = []
+        if blk.consts:
+            out.append('%sconst %s;\n' % (ind, ', '.join('%s = %d' % c for c in blk.consts)))
+        out.append('%svar %s;\n' % (ind, ', '.join(blk.vars + blk.counters)))
+        for child in blk.children:
+            out.append('%sprocedure %s;\n' % (ind, child.name))
+            out.append(self.block(child, ind + '    '))
+            out.append(';\n')
+
+        stmts = ['%s := %d' % (v, self.rnd.randint(0, 9)) for v in blk.vars]
+        stmts += ['%s := 0' % c for c in blk.counters]
+        blk.cost = len(stmts)
+        stmts += self.stmts(blk, blk.budget, 0, 1, False, ind + '    ')
+        # 没有一定会被调到的子过程，在最后补调一次
+        for child in blk.children:
+            if child.name not in blk.called:
+                blk.cost += child.cost + 1
+                stmts.append('call ' + child.name)
+        out.append('%sbegin\n%s\n%send' % (ind, ';\n'.join(ind + '    ' + s for s in stmts), ind))
+        return ''.join(out)
+
+    # 生成一串语句，一共大约budget条，d是当前嵌套层数，mult是这里的语句每次调用要执行几遍，
+    # guarded表示在if里面，不一定会执行
+    def stmts(self, blk: _Block, budget: int, d: int, mult: int, guarded: bool, ind: str) -> list[str]:
+        out = []
+        while budget > 0:
+            r = self.rnd.random()
+            calls = [c for c in blk.callable() if blk.cost + mult * (c.cost + 1) <= self.work]
+            if d < self.knobs.depth and budget > 2 and r < 0.15 and blk.cost + mult * 4 <= self.work:
+                inner = self.rnd.randint(1, min(budget - 1, 8))
+                out.append(self.while_(blk, inner, d, mult, guarded, ind))
+                budget -= inner + 1
+            elif d < self.knobs.depth and budget > 1 and r < 0.3:
+                inner = self.rnd.randint(1, min(budget - 1, 6))
+                out.append(self.if_(blk, inner, d, mult, ind))
+                budget -= inner + 1
+            elif calls and r < 0.4:
+                callee = self.rnd.choice(calls)
+                blk.cost += mult * (callee.cost + 1)
+                if not guarded:
+                    blk.called.add(callee.name)
+                out.append('call ' + callee.name)
+                budget -= 1
+            else:
+                blk.cost += mult
+                out.append(self.assign(blk))
+                budget -= 1
+        return out
+
+    def compound(self, stmts: list[str], ind: str) -> str:
+        if len(stmts) == 1:
+            return stmts[0]
+        inner = ind + '    '
+        return 'begin\n%s\n%send' % (';\n'.join(inner + s for s in stmts), ind)
+
+    def while_(self, blk: _Block, budget: int, d: int, mult: int, guarded: bool, ind: str) -> str:
+        c = blk.counters[d]
+        # 至少留出循环体里每圈一条语句的量，圈数大了就减半
+        trips = self.rnd.randint(1, self.knobs.trips)
+        while trips > 1 and blk.cost + mult * (2 + 2 * trips) > self.work:
+            trips //= 2
+        blk.cost += mult * (2 + trips)
+        body = self.stmts(blk, budget, d + 1, mult * trips, guarded, ind + '    ') + ['%s := %s + 1' % (c, c)]
+        return '%s := 0;\n%swhile %s < %d do %s' % (c, ind, c, trips, self.compound(body, ind))
+
+    def if_(self, blk: _Block, budget: int, d: int, mult: int, ind: str) -> str:
+        if self.rnd.random() < 0.3:
+            cond = 'odd ' + self.rnd.choice(blk.visible('counters'))
+        else:
+            cond = '%s %s %s' % (self.expr(blk, 2), self.rnd.choice(['=', '#', '<', '<=', '>', '>=']), self.expr(blk, 2))
+        blk.cost += mult
+        body = self.stmts(blk, budget, d + 1, mult, True, ind + '    ')
+        return 'if %s then %s' % (cond, self.compound(body, ind))
+
+    def assign(self, blk: _Block) -> str:
+        return '%s := %s' % (self.rnd.choice(blk.visible('vars')), self.expr(blk, self.knobs.width, True))
+
+    # 不含普通变量的因子：字面量、常量、计数器，偶尔一个括号
+    def factor(self, blk: _Block, nest: int = 0) -> str:
+        r = self.rnd.random()
+        consts = blk.visible('consts')
+        if r < 0.3:
+            return str(self.rnd.randint(0, 20))
+        if r < 0.45 and consts:
+            return self.rnd.choice(consts)[0]
+        if r < 0.9 or nest > 1:
+            return self.rnd.choice(blk.visible('counters'))
+        return '(%s)' % self.expr(blk, 2, False, nest + 1)
+
+    def term(self, blk: _Block, nest: int = 0) -> str:
+        r = self.rnd.random()
+        if r < 0.6:
+            return self.factor(blk, nest)
+        if r < 0.9:
+            return '%s * %s' % (self.factor(blk, nest), self.factor(blk, nest))
+        divisor = self.rnd.choice([str(self.rnd.randint(1, 9))] + [c[0] for c in blk.visible('consts')])
+        return '%s / %s' % (self.factor(blk, nest), divisor)
+
+    def expr(self, blk: _Block, width: int, with_var: bool = False, nest: int = 0) -> str:
+        terms = [self.term(blk, nest) for _ in range(max(1, width))]
+        if with_var:
+            terms[self.rnd.randrange(len(terms))] = self.rnd.choice(blk.visible('vars'))
+        out = ('- ' if self.rnd.random() < 0.1 else '') + terms[0]
+        for t in terms[1:]:
+            out += ' %s %s' % (self.rnd.choice('+-'), t)
+        return out
+
+def generate(seed: int = 0, knobs: Knobs = Knobs()) -> str:
+    return _Gen(seed, knobs).program()
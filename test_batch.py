@@ -0,0 +1,19 @@
+# batch里一组初始值跑出错，只记在它自己的JobResult上，别的组照样跑完
+from batch import run_batch, run_serial
+
+# x > 3 才会走到odd (x / 2)，'/'得到的是小数，odd就抛TypeError
+SRC = 'var x, y;\nbegin y := x; if x > 3 then if odd (x / 2) then y := 0 end.'
+INITS = [{'x': 1}, {'x': 4}, {'x': 2}]
+
+def check(results):
+    assert [r.index for r in results] == [0, 1, 2]
+    assert results[0].error is None and results[0].vars['y'] == 1
+    assert results[1].vars is None and results[1].error.startswith('TypeError: ')
+    assert results[2].error is None and results[2].vars['y'] == 2
+
+def test_serial_bad_input():
+    check(run_serial(SRC, INITS))
+
+def test_batch_bad_input():
+    results = [r for chunk in run_batch(SRC, INITS, workers = 2, chunksize = 1) for r in chunk]
+    check(sorted(results))
@@ -0,0 +1,38 @@
+# incr.Document一个字一个字地打，每打一个字都和整体编译比：编译成功的prog/buf一样，失败的错误一样
+import pytest
+
+from incr import Document, compile_full
+
+def full(src: str):
+    try:
+        return compile_full(src), None
+    except (SyntaxError, RuntimeError) as e:
+        return None, str(e)
+
+def type_in(src: str, anchor: str, text: str):
+    doc = Document(src)
+    pos = src.index(anchor)
+    for k, ch in enumerate(text):
+        try:
+            doc.edit(pos + k, pos + k, ch)
+            error = None
+        except (SyntaxError, RuntimeError) as e:
+            error = str(e)
+        expect, expect_error = full(doc.src)
+        assert error == expect_error, doc.src
+        if expect is not None:
+            assert (doc.prog, doc.buf) == expect, doc.src
+
+SRC = 'var x; procedure p; begin x := 1 end; begin call p end.'
+
+# 在块语句前面打声明：块语句开头的token变成了'const'/'var'/'procedure'
+@pytest.mark.parametrize('anchor, text', [
+    ('begin x', 'var t; '),
+    ('begin x', 'const c = 3; var t; procedure q; x := c; '),
+    ('begin call', 'procedure q; x := 2; '),
+])
+def test_type_declaration(anchor: str, text: str):
+    type_in(SRC, anchor, text)
+
+def test_type_statement():
+    type_in(SRC, 'x := 1', 'x := x * 2; ')
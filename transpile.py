@@ -0,0 +1,230 @@
+# PL/0 -> Python源码的提前编译
+# 长时间跑的数值程序，字节码循环再快也比不上CPython直接跑等价的Python代码。
+# 这里把Program翻译成一段Python源码，compile()/exec之后直接调用：
+#   主程序和每个过程都是一个Python函数，过程定义在它外层那个块的函数里面，
+#   PL/0的变量就是这个函数的局部变量，内层过程读外层变量靠闭包，写外层变量加nonlocal，
+#   常量在翻译时按作用域解析好直接换成字面量。
+# 名字前面加v_/p_前缀，不会和Python的关键字、内置函数、这里的辅助函数撞上。
+# 语义跟ir_eval走：读没赋过值的变量、除以0、给常量或没定义的名字赋值、重复定义，报的错都一样，
+# 而且都是执行到那里才报；ir_eval的Call顺手打印的被调过程指令清单是调试输出，这里不打。
+# CPython编译的时候有嵌套上限：一个函数里最多套20层循环，缩进最多100层，括号最多套200层。
+# 套得太深的while放进一个局部函数里再调它，循环就不受限制；+ - *连着写不再每一步加一层括号。
+# 缩进和括号还是超了(几十层的if/while、上百层的除法或者括号)，compile_program报RuntimeError。
+from typing import Callable, NamedTuple
+
+from demo2 import (Assign, Begin, Block, Call, Condition, Expression, Factor, If, OddCondition, Program,
+                   Statement, Term, While)
+
+_CMP = {
+    '='  : '==',
+    '#'  : '!=',
+    '<'  : '<',
+    '<=' : '<=',
+    '>'  : '>',
+    '>=' : '>=',
+}
+
+# 生成的代码里用到的辅助函数，exec时放进全局命名空间
+PRELUDE = '''\
+def _uninit(name):
+    raise RuntimeError('variable %s referenced before initialization' % name)
+
+def _fail(msg):
+    raise RuntimeError(msg)
+
+def _div(a, b):
+    if b == 0:
+        raise RuntimeError('divided by zero')
+    return a / b
+'''
+
+# 翻译时的作用域，一层对应一个生成出来的Python函数：syms里变量是('var', None)，常量是('const', 值)
+class Scope(NamedTuple):
+    parent   : 'Scope | None'
+    syms     : dict[str, tuple[str, int | None]]
+    procs    : set[str]
+    # 这个函数里赋值过的外层变量，要写进nonlocal
+    nonlocal_ : set[str]
+
+    def lookup(self, name: str) -> tuple['Scope', str, int | None] | None:
+        scope = self
+        while scope is not None:
+            if name in scope.syms:
+                return (scope,) + scope.syms[name]
+            scope = scope.parent
+        return None
+
+    def has_proc(self, name: str) -> bool:
+        scope = self
+        while scope is not None:
+            if name in scope.procs:
+                return True
+            scope = scope.parent
+        return False
+
+def transpile(prog: Program) -> str:
+    lines = [PRELUDE]
+    scope = _emit_function('_pl0_main', prog.block, None, lines, 0)
+    # 主函数最后把主程序的变量按PL/0的名字交出去，和vm.frame_vars一个样子
+    body = ', '.join("%r: v_%s" % (name, name) for name, (kind, _) in scope.syms.items() if kind == 'var')
+    lines.append('    return {%s}' % body)
+    return '\n'.join(lines) + '\n'
+
+# 一个Python函数里最多套几层while，再往里就放进局部函数，CPython的上限是20
+MAX_LOOPS = 18
+
+def compile_program(prog: Program) -> Callable[[], dict[str, int | None]]:
+    src = transpile(prog)
+    ns = {}
+    try:
+        code = compile(src, '<pl0>', 'exec')
+    except SyntaxError as e:
+        # 生成的代码本身不会有语法错，只可能是碰到了CPython的嵌套上限
+        raise RuntimeError('program nests too deeply to transpile: %s' % e.msg) from e
+    exec(code, ns)
+    return ns['_pl0_main']
+
+def _emit_function(fname: str, block: Block, parent: Scope | None, lines: list[str], depth: int) -> Scope:
+    ind = '    ' * depth
+    lines.append('%sdef %s():' % (ind, fname))
+    ind += '    '
+    head = len(lines)
+
+    scope = Scope(parent, {}, set(), set())
+    # 和DefLit/DefVar一样，这一层重复定义就在进到这个块的时候报错，后面什么都不做
+    for name, kind, value in [(c.name, 'const', c.value) for c in block.const] + \
+                             [(v.name, 'var', None) for v in block.vars]:
+        if name in scope.syms:
+            lines.append("%s_fail(%r)" % (ind, 'multiply definition :' + name))
+            return scope
+        scope.syms[name] = (kind, value)
+
+    for name, (kind, _) in scope.syms.items():
+        if kind == 'var':
+            lines.append('%sv_%s = None' % (ind, name))
+
+    for proc in block.procs:
+        scope.procs.add(proc.name)
+    for proc in block.procs:
+        _emit_function('p_' + proc.name, proc.body, scope, lines, depth + 1)
+
+    _emit_stmt(block.stmt, scope, lines, ind)
+
+    if scope.nonlocal_:
+        lines.insert(head, '%snonlocal %s' % (ind, ', '.join('v_' + n for n in sorted(scope.nonlocal_))))
+    if len(lines) == head:
+        lines.append(ind + 'pass')
+    return scope
+
+# loops是这条语句外面、同一个Python函数里已经套了几层while
+def _emit_stmt(node, scope: Scope, lines: list[str], ind: str, loops: int = 0):
+    if isinstance(node, Statement):
+        _emit_stmt(node.stmt, scope, lines, ind, loops)
+
+    elif isinstance(node, Assign):
+        expr = _expr(node.expr, scope)
+        sym = scope.lookup(node.name)
+        # 和Store一样，先把右边算完再报错
+        if sym is None or sym[1] == 'const':
+            lines.append('%s%s' % (ind, expr))
+            lines.append("%s_fail('change before define vars')" % ind)
+        else:
+            if sym[0] is not scope:
+                scope.nonlocal_.add(node.name)
+            lines.append('%sv_%s = %s' % (ind, node.name, expr))
+
+    elif isinstance(node, Call):
+        if scope.has_proc(node.name):
+            lines.append('%sp_%s()' % (ind, node.name))
+        else:
+            lines.append("%s_fail('call procedure before definition')" % ind)
+
+    elif isinstance(node, Begin):
+        for stmt in node.body:
+            _emit_stmt(stmt, scope, lines, ind, loops)
+
+    elif isinstance(node, If):
+        lines.append('%sif %s:' % (ind, _cond(node.cond, scope)))
+        _emit_body(node.then, scope, lines, ind, loops)
+
+    elif isinstance(node, While) and loops >= MAX_LOOPS:
+        # 局部函数的作用域里什么都不定义，写到的变量都在外面，和过程一样记进nonlocal
+        inner = Scope(scope, {}, set(), set())
+        fname = '_loop%d' % len(lines)
+        lines.append('%sdef %s():' % (ind, fname))
+        head = len(lines)
+        _emit_stmt(node, inner, lines, ind + '    ')
+        if inner.nonlocal_:
+            lines.insert(head, '%s    nonlocal %s' % (ind, ', '.join('v_' + n for n in sorted(inner.nonlocal_))))
+        lines.append('%s%s()' % (ind, fname))
+
+    elif isinstance(node, While):
+        lines.append('%swhile %s:' % (ind, _cond(node.cond, scope)))
+        _emit_body(node.do, scope, lines, ind, loops + 1)
+
+    else:
+        raise RuntimeError('invalid statement')
+
+def _emit_body(node, scope: Scope, lines: list[str], ind: str, loops: int):
+    n = len(lines)
+    _emit_stmt(node, scope, lines, ind + '    ', loops)
+    if len(lines) == n:
+        lines.append(ind + '    pass')
+
+# 条件和BrFalse一样只看是不是0，比较的结果直接当真假用
+def _cond(node: Condition, scope: Scope) -> str:
+    cond = node.cond
+    if isinstance(cond, OddCondition):
+        return '%s & 1' % _expr(cond.expr, scope)
+    if cond.op not in _CMP:
+        raise RuntimeError('invalid op type (%s)' % cond.op)
+    return '%s %s %s' % (_expr(cond.lhs, scope), _CMP[cond.op], _expr(cond.rhs, scope))
+
+# 表达式整个加一层括号，里面的+ -和Python一样从左往右结合，求值顺序和栈上一样从左到右
+def _expr(node: Expression, scope: Scope) -> str:
+    ret = _term(node.term, scope)
+    if node.mod == '-':
+        ret = '-' + ret
+    elif node.mod not in {'', '+'}:
+        raise RuntimeError('invalid expression sign')
+
+    for op, rhs in node.rhs:
+        if op not in {'+', '-'}:
+            raise RuntimeError('invalid expression operator')
+        ret = '%s %s %s' % (ret, op, _term(rhs, scope))
+    return '(%s)' % ret
+
+def _term(node: Term, scope: Scope) -> str:
+    # Parser.term在碰到'.'时会返回一个Factor
+    if isinstance(node, Factor):
+        return _factor(node, scope)
+
+    ret = _factor(node.lhs, scope)
+    for op, rhs in node.rhs:
+        if op == '*':
+            ret = '%s * %s' % (ret, _factor(rhs, scope))
+        elif op == '/':
+            ret = '_div(%s, %s)' % (ret, _factor(rhs, scope))
+        else:
+            raise RuntimeError('invalid expression operator')
+    return '(%s)' % ret if node.rhs else ret
+
+def _factor(node: Factor, scope: Scope) -> str:
+    value = node.value
+    if isinstance(value, int):
+        return '(%d)' % value if value < 0 else '%d' % value
+
+    elif isinstance(value, str):
+        sym = scope.lookup(value)
+        if sym is None:
+            return '_fail(%r)' % ('undefined variable: ' + value)
+        _, kind, const = sym
+        if kind == 'const':
+            return '(%d)' % const if const < 0 else '%d' % const
+        return '(v_%s if v_%s is not None else _uninit(%r))' % (value, value, value)
+
+    elif isinstance(value, Expression):
+        return _expr(value, scope)
+
+    else:
+        raise RuntimeError('invalid factor value')
@@ -0,0 +1,488 @@
+# 名字解析之后的虚拟机
+# Program.gen出来的Ir里变量都是名字，ir_eval每次LoadVar/Store都要查ctx.vars/ctx.consts。
+# resolve在编译期把每个名字绑到(层数, 槽位)：常量直接换成LoadLit，变量换成
+# LoadLocal/StoreLocal(当前帧)或LoadOuter/StoreOuter(外层帧)，运行时只按下标取。
+from array import array
+from typing import NamedTuple
+
+from demo2 import IR_DISPATCH, Ir, IrOpCode, Parser, TokenStream, tokenize
+from opt import fold_consts, fuse, peephole
+
+# 一个过程编译之后的样子，主程序也算一个，是procs[0]
+# 帧就是一个list：frame[0]放Proc自己，变量从槽位1开始，names[槽位]是变量名，报错时用
+class Proc(NamedTuple):
+    name  : str
+    level : int
+    names : list[str]
+    code  : list[Ir]
+
+# 解析时的作用域：syms里常量是('const', 值)，变量是('var', 槽位)；过程名单独一个命名空间
+class Scope(NamedTuple):
+    parent : 'Scope | None'
+    level  : int
+    syms   : dict[str, tuple[str, int]]
+    procs  : dict[str, int]
+
+    def lookup(self, name: str) -> tuple[int, str, int] | None:
+        scope = self
+        while scope is not None:
+            if name in scope.syms:
+                kind, val = scope.syms[name]
+                return scope.level, kind, val
+            scope = scope.parent
+        return None
+
+    def lookup_proc(self, name: str) -> int | None:
+        scope = self
+        while scope is not None:
+            if name in scope.procs:
+                return scope.procs[name]
+            scope = scope.parent
+        return None
+
+def resolve(buf: list[Ir]) -> list[Proc]:
+    procs = [None]
+    _resolve_block('', buf, None, 0, 0, procs)
+    return procs
+
+def _resolve_block(name: str, buf: list[Ir], parent: Scope | None, level: int, index: int, procs: list):
+    scope = Scope(parent, level, {}, {})
+    names = [name]
+    bodies = []
+
+    # 第一遍只收集定义，这样过程体里可以调用后面才定义的兄弟过程
+    for ir in buf:
+        if ir.op == IrOpCode.DefLit or ir.op == IrOpCode.DefVar:
+            if ir.args in scope.syms:
+                raise RuntimeError('multiply definition :' + ir.args)
+            if ir.op == IrOpCode.DefLit:
+                scope.syms[ir.args] = ('const', ir.value)
+            else:
+                scope.syms[ir.args] = ('var', len(names))
+                names.append(ir.args)
+
+        elif ir.op == IrOpCode.DefProc:
+            # 同名过程后定义的覆盖先定义的，和ir_eval里DefProc一样
+            scope.procs[ir.args] = len(procs)
+            bodies.append((ir.args, ir.value, len(procs)))
+            procs.append(None)
+
+    for pname, pbuf, pindex in bodies:
+        _resolve_block(pname, pbuf, scope, level + 1, pindex, procs)
+
+    # 第二遍生成代码，Def*指令都去掉了，所以跳转目标要重新算
+    code = []
+    remap = []
+    for ir in buf:
+        remap.append(len(code))
+        op = ir.op
+
+        if op == IrOpCode.DefLit or op == IrOpCode.DefVar or op == IrOpCode.DefProc:
+            continue
+
+        elif op == IrOpCode.LoadVar:
+            sym = scope.lookup(ir.args)
+            if sym is None:
+                raise RuntimeError('undefined variable: ' + ir.args)
+            lvl, kind, val = sym
+            if kind == 'const':
+                code.append(Ir(IrOpCode.LoadLit, val))
+            elif lvl == level:
+                code.append(Ir(IrOpCode.LoadLocal, val))
+            else:
+                code.append(Ir(IrOpCode.LoadOuter, val, lvl))
+
+        elif op == IrOpCode.Store:
+            sym = scope.lookup(ir.args)
+            if sym is None or sym[1] == 'const': # 这里默认常量不可修改
+                raise RuntimeError('change before define vars')
+            lvl, kind, val = sym
+            if lvl == level:
+                code.append(Ir(IrOpCode.StoreLocal, val))
+            else:
+                code.append(Ir(IrOpCode.StoreOuter, val, lvl))
+
+        elif op == IrOpCode.Call:
+            target = scope.lookup_proc(ir.args)
+            if target is None:
+                raise RuntimeError('call procedure before definition')
+            code.append(Ir(IrOpCode.Call, target))
+
+        else:
+            code.append(ir)
+    remap.append(len(code))
+
+    for i, ir in enumerate(code):
+        if ir.op == IrOpCode.Jump or ir.op == IrOpCode.BrFalse:
+            code[i] = Ir(ir.op, remap[ir.args])
+
+    procs[index] = Proc(name, level, names, code)
+
+
+# 按列存的代码：每条指令拆成ops/args/vals三个array('i')里的同一个下标，
+# 不是整数的操作数(名字、字面量、嵌套的过程体)放进names/consts池子里，列里只存下标，没有就是-1。
+# 实现了append/len/下标读写，Program.gen可以直接往里面生成，VM直接读这几列
+# 每个操作数放哪由指令决定：'n'是名字池，'c'是常量池，'i'是直接存的整数
+_OPERAND_KINDS = {
+    IrOpCode.LoadLit : ('c', 'i'),
+    IrOpCode.LoadVar : ('n', 'i'),
+    IrOpCode.Store   : ('n', 'i'),
+    IrOpCode.DefVar  : ('n', 'i'),
+    IrOpCode.DefLit  : ('n', 'c'),
+    IrOpCode.DefProc : ('n', 'c'),
+}
+
+class CodeObject:
+    __slots__ = ('ops', 'args', 'vals', 'consts', 'names', '_const_index', '_name_index')
+
+    ops    : array
+    args   : array
+    vals   : array
+    consts : list
+    names  : list[str]
+
+    def __init__(self):
+        self.ops = array('i')
+        self.args = array('i')
+        self.vals = array('i')
+        self.consts = []
+        self.names = []
+        self._const_index = {}
+        self._name_index = {}
+
+    @classmethod
+    def of(cls, buf) -> 'CodeObject':
+        code = cls()
+        for ir in buf:
+            code.append(ir)
+        return code
+
+    # gen阶段的Call带的是过程名，链接之后带的是入口地址(vals里还有过程下标)
+    def _kinds(self, op: int, args) -> tuple[str, str]:
+        if op == IrOpCode.Call and isinstance(args, str):
+            return 'n', 'i'
+        return _OPERAND_KINDS.get(op, ('i', 'i'))
+
+    def _encode(self, kind: str, x) -> int:
+        if x is None:
+            return -1
+        if kind == 'i':
+            return x
+        if kind == 'n':
+            index, pool = self._name_index, self.names
+        else:
+            index, pool = self._const_index, self.consts
+            # 嵌套的过程体这种不能当字典键的，不去重
+            if not isinstance(x, int):
+                pool.append(x)
+                return len(pool) - 1
+        i = index.get(x)
+        if i is None:
+            i = index[x] = len(pool)
+            pool.append(x)
+        return i
+
+    def _decode(self, kind: str, x: int):
+        if x == -1:
+            return None
+        if kind == 'i':
+            return x
+        return (self.names if kind == 'n' else self.consts)[x]
+
+    def append(self, ir: Ir):
+        ka, kv = self._kinds(ir.op, ir.args)
+        self.ops.append(ir.op)
+        self.args.append(self._encode(ka, ir.args))
+        self.vals.append(self._encode(kv, ir.value))
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+    def __getitem__(self, i: int) -> Ir:
+        op = IrOpCode(self.ops[i])
+        ka, kv = _OPERAND_KINDS.get(op, ('i', 'i'))
+        if op == IrOpCode.Call and self.vals[i] == -1:
+            ka = 'n'
+        return Ir(op, self._decode(ka, self.args[i]), self._decode(kv, self.vals[i]))
+
+    def __setitem__(self, i: int, ir: Ir):
+        ka, kv = self._kinds(ir.op, ir.args)
+        self.ops[i] = ir.op
+        self.args[i] = self._encode(ka, ir.args)
+        self.vals[i] = self._encode(kv, ir.value)
+
+    def __iter__(self):
+        for i in range(len(self.ops)):
+            yield self[i]
+
+
+# 链接：主程序在最前面(以Halt结尾)，后面依次摆每个过程体(以Ret结尾)，
+# 跳转目标加上各自的起始地址，Call直接带上被调过程的入口地址，vals里是过程下标
+_JUMPS = {
+    IrOpCode.Jump, IrOpCode.BrFalse,
+    IrOpCode.CmpEqBrFalse, IrOpCode.CmpNeBrFalse, IrOpCode.CmpLtBrFalse,
+    IrOpCode.CmpLteBrFalse, IrOpCode.CmpGtBrFalse, IrOpCode.CmpGteBrFalse,
+}
+
+class Image(NamedTuple):
+    code  : CodeObject
+    procs : list[Proc]
+
+def link(procs: list[Proc]) -> Image:
+    entry = []
+    size = 0
+    for proc in procs:
+        entry.append(size)
+        size += len(proc.code) + (proc is not procs[0])
+
+    code = CodeObject()
+    for proc in procs:
+        base = len(code)
+        for ir in proc.code:
+            if ir.op in _JUMPS:
+                code.append(Ir(ir.op, base + ir.args))
+            elif ir.op == IrOpCode.Call:
+                code.append(Ir(IrOpCode.Call, entry[ir.args], ir.args))
+            else:
+                code.append(ir)
+        if proc is not procs[0]:
+            code.append(Ir(IrOpCode.Ret))
+    return Image(code, procs)
+
+def compile_ir(buf: list[Ir]) -> Image:
+    return link(resolve(buf))
+
+# 源码一路到能跑的Image：
+# tokenize -> Parser.program -> (fold_consts) -> Program.gen -> (peephole) -> resolve -> (fuse) -> link
+def compile_program(src: str, optimize: bool = False) -> Image:
+    buf = []
+    prog = Parser(TokenStream(buf = tokenize(src))).program()
+    if optimize:
+        prog = fold_consts(prog)
+    prog.gen(buf)
+    if not optimize:
+        return compile_ir(buf)
+    procs = resolve(peephole(buf))
+    return link([p._replace(code = fuse(p.code)) for p in procs])
+
+
+# 虚拟机本身。所有过程都在同一个code里，Call/Ret只是改pc、换帧，在同一个循环里跑完，
+# 不会因为PL/0递归太深撞上Python的递归上限
+# display[层数]是这一层当前活着的那个帧，访问外层变量不用沿着链往上找；
+# rets是返回栈，每项是(返回地址, 调用者的帧, 被调过程那一层原来的display)
+# 处理函数是 (args列里的操作数, sp, vm, pc) -> 下一条指令的pc，要vals列的自己去vm.vals[pc-1]拿
+class VM:
+    __slots__ = ('vals', 'consts', 'procs', 'code', 'display', 'frame', 'sp', 'rets')
+
+    code    : CodeObject
+    vals    : array
+    consts  : list
+    procs   : list[Proc]
+    display : list[list | None]
+    frame   : list
+    sp      : list
+    rets    : list[tuple[int, list, list | None]]
+
+    def __init__(self, image: Image):
+        self.code = image.code
+        self.vals = image.code.vals
+        self.consts = image.code.consts
+        self.procs = image.procs
+        self.display = [None] * (max(p.level for p in image.procs) + 1)
+        self.frame = None
+        self.sp = []
+        self.rets = []
+
+    # init按名字给主程序的变量一个初始值，程序自己赋值之前读到的就是它
+    def run(self, init: dict[str, int] | None = None) -> list:
+        main = self.procs[0]
+        frame = [main] + [None] * (len(main.names) - 1)
+        if init:
+            for name, v in init.items():
+                if name not in main.names[1:]:
+                    raise RuntimeError('undefined variable: ' + name)
+                frame[main.names.index(name, 1)] = v
+        self.display[0] = frame
+        self.frame = frame
+
+        ops = self.code.ops
+        args = self.code.args
+        n = len(ops)
+        sp = self.sp
+        dispatch = VM_DISPATCH
+        pc = 0
+        while pc < n:
+            pc = dispatch[ops[pc]](args[pc], sp, self, pc + 1)
+        return frame
+
+def _vm_loadlocal(a: int, sp: list, vm: VM, pc: int) -> int:
+    v = vm.frame[a]
+    if v is None:
+        raise RuntimeError('variable %s referenced before initialization' % vm.frame[0].names[a])
+    sp.append(v)
+    return pc
+
+def _vm_storelocal(a: int, sp: list, vm: VM, pc: int) -> int:
+    vm.frame[a] = sp.pop()
+    return pc
+
+def _vm_loadouter(a: int, sp: list, vm: VM, pc: int) -> int:
+    frame = vm.display[vm.vals[pc - 1]]
+    v = frame[a]
+    if v is None:
+        raise RuntimeError('variable %s referenced before initialization' % frame[0].names[a])
+    sp.append(v)
+    return pc
+
+def _vm_storeouter(a: int, sp: list, vm: VM, pc: int) -> int:
+    vm.display[vm.vals[pc - 1]][a] = sp.pop()
+    return pc
+
+def _vm_loadlit(a: int, sp: list, vm: VM, pc: int) -> int:
+    sp.append(vm.consts[a])
+    return pc
+
+def _vm_jump(a: int, sp: list, vm: VM, pc: int) -> int:
+    return a
+
+def _vm_brfalse(a: int, sp: list, vm: VM, pc: int) -> int:
+    if sp.pop() == 0:
+        return a
+    return pc
+
+def _vm_call(a: int, sp: list, vm: VM, pc: int) -> int:
+    proc = vm.procs[vm.vals[pc - 1]]
+    frame = [proc] + [None] * (len(proc.names) - 1)
+    vm.rets.append((pc, vm.frame, vm.display[proc.level]))
+    vm.display[proc.level] = frame
+    vm.frame = frame
+    return a
+
+def _vm_ret(a: int, sp: list, vm: VM, pc: int) -> int:
+    level = vm.frame[0].level
+    pc, vm.frame, vm.display[level] = vm.rets.pop()
+    return pc
+
+# opt.fuse合并出来的超级指令，每个都和展开之后的那几条指令做的事一模一样，报错也一样
+def _vm_inclocal(a: int, sp: list, vm: VM, pc: int) -> int:
+    frame = vm.frame
+    v = frame[a]
+    if v is None:
+        raise RuntimeError('variable %s referenced before initialization' % frame[0].names[a])
+    frame[a] = v + vm.vals[pc - 1]
+    return pc
+
+def _load_locals(a: int, vm: VM, pc: int):
+    frame = vm.frame
+    b = vm.vals[pc - 1]
+    v1 = frame[a]
+    if v1 is None:
+        raise RuntimeError('variable %s referenced before initialization' % frame[0].names[a])
+    v2 = frame[b]
+    if v2 is None:
+        raise RuntimeError('variable %s referenced before initialization' % frame[0].names[b])
+    return v1, v2
+
+def _vm_addlocals(a: int, sp: list, vm: VM, pc: int) -> int:
+    v1, v2 = _load_locals(a, vm, pc)
+    sp.append(v1 + v2)
+    return pc
+
+def _vm_sublocals(a: int, sp: list, vm: VM, pc: int) -> int:
+    v1, v2 = _load_locals(a, vm, pc)
+    sp.append(v1 - v2)
+    return pc
+
+def _vm_mullocals(a: int, sp: list, vm: VM, pc: int) -> int:
+    v1, v2 = _load_locals(a, vm, pc)
+    sp.append(v1 * v2)
+    return pc
+
+def _vm_addstorelocal(a: int, sp: list, vm: VM, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    vm.frame[a] = v1 + v2
+    return pc
+
+def _vm_cmpeq_brfalse(a: int, sp: list, vm: VM, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    if v1 == v2:
+        return pc
+    return a
+
+def _vm_cmpne_brfalse(a: int, sp: list, vm: VM, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    if v1 != v2:
+        return pc
+    return a
+
+def _vm_cmplt_brfalse(a: int, sp: list, vm: VM, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    if v1 < v2:
+        return pc
+    return a
+
+def _vm_cmplte_brfalse(a: int, sp: list, vm: VM, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    if v1 <= v2:
+        return pc
+    return a
+
+def _vm_cmpgt_brfalse(a: int, sp: list, vm: VM, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    if v1 > v2:
+        return pc
+    return a
+
+def _vm_cmpgte_brfalse(a: int, sp: list, vm: VM, pc: int) -> int:
+    v2 = sp.pop()
+    v1 = sp.pop()
+    if v1 >= v2:
+        return pc
+    return a
+
+def _vm_invalid(a: int, sp: list, vm: VM, pc: int) -> int:
+    raise RuntimeError('invalid instruction')
+
+# 算术、比较和Halt不看操作数，和ir_eval一模一样，直接借IR_DISPATCH里的处理函数；
+# 按名字操作的指令在这里都不该出现
+VM_DISPATCH = IR_DISPATCH[:]
+for _op, _fn in (
+    (IrOpCode.LoadVar,    _vm_invalid),
+    (IrOpCode.Store,      _vm_invalid),
+    (IrOpCode.DefVar,     _vm_invalid),
+    (IrOpCode.DefLit,     _vm_invalid),
+    (IrOpCode.DefProc,    _vm_invalid),
+    (IrOpCode.LoadLit,    _vm_loadlit),
+    (IrOpCode.Jump,       _vm_jump),
+    (IrOpCode.BrFalse,    _vm_brfalse),
+    (IrOpCode.Call,       _vm_call),
+    (IrOpCode.Ret,        _vm_ret),
+    (IrOpCode.LoadLocal,  _vm_loadlocal),
+    (IrOpCode.StoreLocal, _vm_storelocal),
+    (IrOpCode.LoadOuter,  _vm_loadouter),
+    (IrOpCode.StoreOuter, _vm_storeouter),
+    (IrOpCode.IncLocal,      _vm_inclocal),
+    (IrOpCode.AddLocals,     _vm_addlocals),
+    (IrOpCode.SubLocals,     _vm_sublocals),
+    (IrOpCode.MulLocals,     _vm_mullocals),
+    (IrOpCode.AddStoreLocal, _vm_addstorelocal),
+    (IrOpCode.CmpEqBrFalse,  _vm_cmpeq_brfalse),
+    (IrOpCode.CmpNeBrFalse,  _vm_cmpne_brfalse),
+    (IrOpCode.CmpLtBrFalse,  _vm_cmplt_brfalse),
+    (IrOpCode.CmpLteBrFalse, _vm_cmplte_brfalse),
+    (IrOpCode.CmpGtBrFalse,  _vm_cmpgt_brfalse),
+    (IrOpCode.CmpGteBrFalse, _vm_cmpgte_brfalse),
+):
+    VM_DISPATCH[_op] = _fn
+del _op, _fn
+
+# 把帧里的变量按名字摊开，方便和ir_eval的ctx.vars对照
+def frame_vars(frame: list) -> dict[str, int | None]:
+    names = frame[0].names
+    return {names[i]: frame[i] for i in range(1, len(names))}